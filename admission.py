@@ -0,0 +1,199 @@
+"""
+Admission control for WaterBuddy
+This module rate-limits and load-sheds expensive routes so cheap writes like /add_water stay fast under load
+"""
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request, session
+
+# Limits per route class. Rates are requests per second, bursts are bucket sizes,
+# concurrency counts requests (or Gemini generations, for 'gemini') in flight, and
+# max_queue_depth sheds work once the background task queue is that deep.
+DEFAULT_LIMITS = {
+    # Cheap writes get generous limits and are never shed for queue depth
+    'write': {'rate': 500, 'burst': 1000, 'user_rate': 20, 'user_burst': 100, 'concurrency': 64},
+    # Chat requests themselves; kept to a few server threads so writes always find one free
+    'chat': {'rate': 20, 'burst': 40, 'user_rate': 1, 'user_burst': 5, 'concurrency': 4},
+    # Gemini generations, held from enqueue until the reply is ready
+    'gemini': {'rate': 10, 'burst': 20, 'user_rate': 0.2, 'user_burst': 3, 'concurrency': 8,
+               'max_queue_depth': 50},
+}
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted"""
+
+    def __init__(self, route_class, reason, retry_after=1.0):
+        super().__init__(f"{route_class} rejected ({reason})")
+        self.route_class = route_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait(self):
+        """
+        Check for a token without taking it.
+
+        Returns:
+            0 when a token is available, otherwise the seconds until one is
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """
+        Take one token if available.
+
+        Returns:
+            0 when a token was taken, otherwise the seconds until one is available
+        """
+        wait = self.wait()
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+
+class AdmissionControl:
+    """
+    Flask extension applying per-user and global limits to classes of routes.
+
+    Views are protected with the limit() decorator, or by calling acquire()
+    and release() around a specific piece of work. Each class has a global
+    token bucket, a token bucket per user (or per client address when not
+    logged in), a concurrency limit and, optionally, a task queue depth
+    above which new work is shed. Rejected requests get a 429 from limit();
+    callers of acquire() decide their own fallback.
+    """
+
+    def __init__(self, app=None, max_keys=10000):
+        self.enabled = True
+        self.max_keys = max_keys
+        self.limits = {}
+        self._buckets = {}
+        self._user_buckets = OrderedDict()
+        self._in_flight = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_ENABLED', True)
+        limits = {route_class: dict(values) for route_class, values in DEFAULT_LIMITS.items()}
+        for route_class, overrides in app.config.get('ADMISSION_LIMITS', {}).items():
+            limits.setdefault(route_class, {}).update(overrides)
+        self.limits = limits
+        self._buckets = {route_class: TokenBucket(values['rate'], values['burst'])
+                         for route_class, values in limits.items()}
+        self._user_buckets.clear()
+        self._in_flight = {route_class: 0 for route_class in limits}
+        self._counters = {}
+        app.extensions['admission_control'] = self
+
+    def acquire(self, route_class, key=None, queue_depth=0):
+        """
+        Admit one unit of work, which must be paired with release(route_class).
+
+        Args:
+            route_class: A key of the configured limits, e.g. 'gemini'
+            key: The user (or client) the work is for
+            queue_depth: Current depth of the background queue the work will join
+
+        Raises:
+            Overloaded: if any limit for the class is exceeded
+        """
+        if not self.enabled:
+            return
+        limits = self.limits[route_class]
+
+        with self._lock:
+            try:
+                max_depth = limits.get('max_queue_depth')
+                if max_depth is not None and queue_depth >= max_depth:
+                    raise Overloaded(route_class, 'queue')
+                if self._in_flight[route_class] >= limits['concurrency']:
+                    raise Overloaded(route_class, 'concurrency')
+
+                user_bucket = None
+                if key is not None:
+                    user_bucket = self._user_buckets.get((route_class, key))
+                    if user_bucket is None:
+                        user_bucket = TokenBucket(limits['user_rate'], limits['user_burst'])
+                        self._user_buckets[(route_class, key)] = user_bucket
+                        while len(self._user_buckets) > self.max_keys:
+                            self._user_buckets.popitem(last=False)
+                    self._user_buckets.move_to_end((route_class, key))
+                    wait = user_bucket.wait()
+                    if wait:
+                        raise Overloaded(route_class, 'user_rate', wait)
+
+                # Both buckets are checked before either is charged, so a request
+                # shed by the global limit does not cost the user a token
+                wait = self._buckets[route_class].wait()
+                if wait:
+                    raise Overloaded(route_class, 'rate', wait)
+            except Overloaded as e:
+                self._count(route_class, e.reason)
+                raise
+
+            if user_bucket is not None:
+                user_bucket.take()
+            self._buckets[route_class].take()
+            self._in_flight[route_class] += 1
+            self._count(route_class, 'admitted')
+
+    def release(self, route_class):
+        if not self.enabled:
+            return
+        with self._lock:
+            # Never below zero, e.g. for durable tasks replayed after a restart
+            self._in_flight[route_class] = max(0, self._in_flight[route_class] - 1)
+
+    def limit(self, route_class):
+        """Decorator admitting a view's requests through the limits of route_class"""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                key = session.get('user_id') or request.remote_addr
+                try:
+                    self.acquire(route_class, key)
+                except Overloaded as e:
+                    response = jsonify({'success': False, 'message': 'Too many requests, please try again shortly'})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(1, round(e.retry_after)))
+                    return response
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release(route_class)
+            return wrapper
+        return decorator
+
+    def _count(self, route_class, outcome):
+        counter = self._counters.setdefault(route_class, {})
+        counter[outcome] = counter.get(outcome, 0) + 1
+
+    def stats(self):
+        """Admitted and rejected counts (by reason) and work in flight, per route class"""
+        with self._lock:
+            return {
+                route_class: {'in_flight': self._in_flight[route_class],
+                              **self._counters.get(route_class, {})}
+                for route_class in self.limits
+            }
@@ -1,45 +1,308 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify, session, redirect, url_for
 import os
+import hmac
 import json
 from datetime import datetime, timedelta
-import random
+import click
+from jinja2 import FileSystemBytecodeCache
 
 # Import database and models
-from database import db, User, WaterIntake, DailyGoal, WaterReminder
+from database import db, User, WaterIntake, IntakeEvent, DailyGoal, WaterReminder, bump_data_version
 # Import local response generator
-from gemini_helper import generate_response, set_api_key
+from gemini_helper import generate_response, local_response, fallback_reply, set_api_key
+# Import background task queue
+from task_queue import TaskQueue, QueueFullError
+# Import write-behind buffer for intake logging
+from write_buffer import IntakeBuffer, apply_intake_deltas
+# Import timezone helpers and migrations
+from timezones import local_today, to_local_date, is_valid_timezone
+from migrations import upgrade_schema, change_user_timezone
+# Import fingerprinted static asset helper
+from assets import Assets
+from fragments import FragmentCacheExtension
+# Import per-user chat history
+from conversation import ConversationMemory
+# Import rate limiting and load shedding
+from admission import AdmissionControl, Overloaded
+# Import cohort rankings
+from cohorts import CohortStats, ACTIVE_PROFESSIONS, SEDENTARY_PROFESSIONS
+# Import the columnar archive for old intake history
+from archive import IntakeArchive, MIN_HORIZON_DAYS
+# Import the on-demand sampling profiler
+from profiler import SamplingProfiler
+# Import reminder pacing
+from reminders import ReminderPlanner, reminder_message
+# Import the opt-in traffic recorder (replayed with replay.py)
+from recorder import TrafficRecorder
+# Import server-side sessions and the cached user context
+from sessions import ServerSessions
 
-# Create Flask app
-app = Flask(__name__)
+# Largest single intake accepted by /add_water and the event APIs, in milliliters
+MAX_INTAKE_AMOUNT = 5000
 
-# Configure the app
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///water_tracker.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = 'water_intake_tracker_secret_key'
+# Routes live on a blueprint so create_app() can build as many app instances as needed
+main = Blueprint('main', __name__, cli_group=None)
 
-# Initialize the database with the app
-db.init_app(app)
+# Extensions, bound to an app in create_app()
+task_queue = TaskQueue()
+intake_buffer = IntakeBuffer()
+assets = Assets()
+conversation_memory = ConversationMemory()
+admission = AdmissionControl()
+cohort_stats = CohortStats()
+intake_archive = IntakeArchive()
+profiler = SamplingProfiler()
+reminder_planner = ReminderPlanner()
+traffic_recorder = TrafficRecorder()
+server_sessions = ServerSessions()
 
-# Create database tables
-with app.app_context():
+def create_app(config=None):
+    """Create and configure a WaterBuddy app instance"""
+    app = Flask(__name__)
+    
+    # Configure the app
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///water_tracker.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.secret_key = 'water_intake_tracker_secret_key'
+    
+    # Per-user tables split over SHARD_COUNT SQLite files by hashed user id (see shards.py; change with `flask reshard`)
+    app.config['SHARD_COUNT'] = int(os.environ.get('SHARD_COUNT', 1))
+    app.config['SHARD_DIR'] = os.environ.get('SHARD_DIR', app.instance_path)
+    app.config['SHARD_POOL_SIZE'] = 5
+    
+    # Shared secret for device integrations posting to /api/intake/batch without a browser session
+    app.config['DEVICE_API_TOKEN'] = os.environ.get('DEVICE_API_TOKEN')
+    app.config['INTAKE_BATCH_MAX_EVENTS'] = 5000
+    # Event timestamps must fall within this window around now; kept below the archive's MIN_HORIZON_DAYS
+    app.config['INTAKE_EVENT_MAX_AGE_DAYS'] = 30
+    app.config['INTAKE_EVENT_MAX_SKEW_SECONDS'] = 300
+    
+    # Background task queue (set TASK_QUEUE_DURABLE_PATH to keep queued tasks across restarts)
+    app.config['TASK_QUEUE_WORKERS'] = int(os.environ.get('TASK_QUEUE_WORKERS', 4))
+    app.config['TASK_QUEUE_MAX_DEPTH'] = int(os.environ.get('TASK_QUEUE_MAX_DEPTH', 100))
+    app.config['TASK_QUEUE_DURABLE_PATH'] = os.environ.get('TASK_QUEUE_DURABLE_PATH')
+    # Task states and results live in the session store, so /task_status works from any worker
+    app.config['TASK_RESULT_TTL'] = 3600
+    
+    # Write-behind buffer for high-frequency /add_water traffic (off by default)
+    app.config['WRITE_BUFFER_ENABLED'] = os.environ.get('WRITE_BUFFER_ENABLED', '').lower() in ('1', 'true', 'yes')
+    app.config['WRITE_BUFFER_FLUSH_MS'] = int(os.environ.get('WRITE_BUFFER_FLUSH_MS', 500))
+    app.config['WRITE_BUFFER_MAX_EVENTS'] = int(os.environ.get('WRITE_BUFFER_MAX_EVENTS', 50))
+    app.config['WRITE_BUFFER_DURABILITY'] = os.environ.get('WRITE_BUFFER_DURABILITY', 'memory')
+    app.config['WRITE_BUFFER_JOURNAL_PATH'] = os.environ.get(
+        'WRITE_BUFFER_JOURNAL_PATH', os.path.join(app.instance_path, 'intake_buffer.journal'))
+    
+    # Compiled templates are cached on disk so every worker shares them (fill it with `flask precompile-templates`)
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 256))
+    
+    # Chat history kept per user, and the size limit for prompts sent to Gemini
+    app.config['CHAT_MEMORY_TURNS'] = int(os.environ.get('CHAT_MEMORY_TURNS', 12))
+    app.config['CHAT_MEMORY_TTL_HOURS'] = int(os.environ.get('CHAT_MEMORY_TTL_HOURS', 24))
+    app.config['CHAT_MAX_MESSAGE_CHARS'] = 1000
+    app.config['CHAT_PROMPT_TOKEN_BUDGET'] = int(os.environ.get('CHAT_PROMPT_TOKEN_BUDGET', 800))
+    
+    # Admission control: per-user and global limits for chat and write routes (see admission.DEFAULT_LIMITS)
+    app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    app.config['ADMISSION_LIMITS'] = {}
+    
+    # Cohort rankings on /insights, rebuilt by `flask refresh-cohorts` (cron) into a snapshot every worker loads;
+    # COHORT_REFRESH_SECONDS runs the refresh in a thread instead, for single-process deployments (0 disables it)
+    app.config['COHORT_REFRESH_SECONDS'] = int(os.environ.get('COHORT_REFRESH_SECONDS', 0))
+    app.config['COHORT_SNAPSHOT'] = os.environ.get('COHORT_SNAPSHOT', os.path.join(app.instance_path, 'cohorts.json'))
+    app.config['COHORT_LEADERBOARD_SIZE'] = 10
+    app.config['COHORT_MIN_SIZE'] = 5
+    
+    # Intake older than the horizon is moved out of water_intakes by `flask archive-intake`
+    app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+    app.config['ARCHIVE_HORIZON_DAYS'] = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 365))
+    app.config['ARCHIVE_BATCH_USERS'] = 1000
+    
+    # Sampling profiler behind /admin/profiler; the routes return 404 unless PROFILER_TOKEN is set
+    app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+    app.config['PROFILER_INTERVAL_MS'] = int(os.environ.get('PROFILER_INTERVAL_MS', 10))
+    app.config['PROFILER_MAX_SECONDS'] = 300
+    app.config['PROFILER_MAX_OVERHEAD'] = 0.02
+    
+    # Reminders paced against expected intake, scheduled by `flask plan-reminders` (cron); REMINDER_PLAN_SECONDS
+    # runs the planner in a thread instead, for single-process deployments (0 disables it)
+    app.config['REMINDER_PLAN_SECONDS'] = int(os.environ.get('REMINDER_PLAN_SECONDS', 0))
+    app.config['REMINDER_MIN_GAP_MINUTES'] = 20
+    
+    # Sanitized request log for replay.py; recording is off unless TRAFFIC_LOG is set
+    app.config['TRAFFIC_LOG'] = os.environ.get('TRAFFIC_LOG')
+    app.config['TRAFFIC_LOG_MAX_BYTES'] = int(os.environ.get('TRAFFIC_LOG_MAX_BYTES', 50 * 1024 * 1024))
+    app.config['TRAFFIC_LOG_BACKUPS'] = 5
+    app.config['TRAFFIC_SAMPLE_RATE'] = float(os.environ.get('TRAFFIC_SAMPLE_RATE', 1.0))
+    # Key for hashing user ids and event ids in the log (random per process when unset)
+    app.config['TRAFFIC_HASH_KEY'] = os.environ.get('TRAFFIC_HASH_KEY')
+    
+    # Sessions and each user's name, goal and timezone kept server-side ('sqlite' file shared by
+    # workers, 'memory' for a single process, 'cookie' for signed cookies and no caching)
+    app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'sqlite')
+    app.config['SESSION_DB'] = os.environ.get('SESSION_DB', os.path.join(app.instance_path, 'sessions.db'))
+    app.config['SESSION_LIFETIME_DAYS'] = 31
+    app.config['USER_CONTEXT_TTL'] = 3600
+    
+    if config:
+        app.config.update(config)
+    
+    # Initialize the database with the app. Tables are created by `flask init-db`,
+    # not here, so booting a worker never runs DDL.
+    db.init_app(app)
+    
+    # Registered first so recorded timings cover the other extensions' hooks
+    traffic_recorder.init_app(app)
+    server_sessions.init_app(app)
+    
+    # Start the task queue and the intake write buffer
+    task_queue.init_app(app)
+    intake_buffer.init_app(app)
+    conversation_memory.init_app(app)
+    admission.init_app(app)
+    cohort_stats.init_app(app)
+    intake_archive.init_app(app)
+    profiler.init_app(app)
+    reminder_planner.init_app(app)
+    
+    # Serve built assets from static/dist with immutable caching
+    assets.init_app(app)
+    
+    # Template bytecode cache and {% cache %} fragments
+    init_templates(app)
+    
+    app.register_blueprint(main)
+    
+    # Try to load Gemini API key from environment variable (the SDK itself loads on first use)
+    gemini_api_key = os.environ.get('GEMINI_API_KEY')
+    if gemini_api_key:
+        try:
+            if set_api_key(gemini_api_key):
+                print("Gemini API key loaded from environment variable")
+        except Exception as e:
+            print(f"Error loading Gemini API key from environment: {str(e)}")
+    
+    return app
+
+def init_templates(app):
+    """Attach the shared bytecode cache and the fragment cache to the app's Jinja environment"""
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache.max_entries = app.config['FRAGMENT_CACHE_SIZE']
+
+@main.cli.command('init-db')
+def init_db():
+    """Create missing tables and columns"""
     db.create_all()
+    added = upgrade_schema()
+    click.echo('Database initialized' + (f' (added {", ".join(added)})' if added else ''))
 
-# Try to load Gemini API key from environment variable
-gemini_api_key = os.environ.get('GEMINI_API_KEY')
-if gemini_api_key:
-    try:
-        if set_api_key(gemini_api_key):
-            print("Gemini API key loaded from environment variable")
-    except Exception as e:
-        print(f"Error loading Gemini API key from environment: {str(e)}")
+@main.cli.command('reshard')
+@click.option('--count', type=int, required=True, help='The new number of shards')
+@click.option('--from-count', type=int, help='The current number of shards (default: SHARD_COUNT)')
+def reshard(count, from_count):
+    """Move users between shard databases for a new shard count; stop the app first"""
+    start = datetime.now()
+    moved = db.reshard(count, from_count, echo=click.echo)
+    elapsed = (datetime.now() - start).total_seconds()
+    click.echo(f'Moved {moved} users in {elapsed:.2f}s; restart the app with SHARD_COUNT={count}')
+
+@main.cli.command('shard-stats')
+def shard_stats():
+    """Users, intake rows and today's logged intake in each shard, and in total"""
+    today = datetime.now().date()
+    queries = {
+        'users': db.select(db.func.count(User.id)),
+        'intake rows': db.select(db.func.count(WaterIntake.id)),
+        'ml today': db.select(db.func.coalesce(db.func.sum(WaterIntake.amount), 0)).where(WaterIntake.date == today),
+    }
+    totals = dict.fromkeys(queries, 0)
+    for shard_id in db.shard_ids():
+        counts = {label: db.execute_on(shard_id, query).scalar() for label, query in queries.items()}
+        click.echo(f'shard {shard_id}: ' + ', '.join(f'{count} {label}' for label, count in counts.items()))
+        for label, count in counts.items():
+            totals[label] += count
+    click.echo('total:   ' + ', '.join(f'{count} {label}' for label, count in totals.items()))
+
+@main.cli.command('refresh-cohorts')
+def refresh_cohorts():
+    """Rebuild cohort rankings once and report how long it took"""
+    start = datetime.now()
+    ranked = cohort_stats.refresh()
+    elapsed = (datetime.now() - start).total_seconds()
+    click.echo(f'Ranked {ranked} users in {elapsed:.2f}s')
+    for cohort, size in sorted(cohort_stats.sizes().items()):
+        click.echo(f'  {cohort}: {size}')
+
+@main.cli.command('plan-reminders')
+def plan_reminders():
+    """Schedule every user's next water reminder once and report how long it took"""
+    start = datetime.now()
+    planned, updated = reminder_planner.plan_all()
+    elapsed = (datetime.now() - start).total_seconds()
+    click.echo(f'Planned {planned} users ({updated} rescheduled) in {elapsed:.2f}s')
+
+@main.cli.command('archive-intake')
+@click.option('--horizon-days', type=click.IntRange(min=MIN_HORIZON_DAYS),
+              help=f'Archive intake older than this, at least {MIN_HORIZON_DAYS} (default: ARCHIVE_HORIZON_DAYS)')
+@click.option('--compact', is_flag=True, help='Merge all segments into one afterwards')
+@click.option('--vacuum', is_flag=True, help='Return the freed space in the database file to the OS')
+def archive_intake(horizon_days, compact, vacuum):
+    """Move old daily totals from water_intakes into the columnar archive"""
+    cutoff = datetime.now().date() - timedelta(days=horizon_days or intake_archive.horizon_days)
+    start = datetime.now()
+    moved = intake_archive.archive(cutoff)
+    click.echo(f'Archived {moved} rows dated before {cutoff} in {(datetime.now() - start).total_seconds():.2f}s')
+    if compact:
+        merged = intake_archive.compact()
+        if merged:
+            click.echo(f'Compacted {merged} segments')
+    if vacuum:
+        for shard_id in db.shard_ids():
+            db.execute_on(shard_id, db.text('VACUUM'))
+    summary = intake_archive.summary()
+    click.echo(f"Archive: {summary['rows']} rows for {summary['users']} users "
+               f"({summary['first_date']} to {summary['last_date']})")
+
+@main.cli.command('precompile-templates')
+def precompile_templates():
+    """Compile every template into the bytecode cache, so workers skip compilation after a deploy"""
+    env = current_app.jinja_env
+    names = env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        env.get_template(name)
+    click.echo(f'Compiled {len(names)} templates into {current_app.config["TEMPLATE_CACHE_DIR"]}')
+
+# Background tasks, registered at import so durable tasks can be replayed when the queue starts
+@task_queue.task()
+def recalculate_water_goal(user_id):
+    """Recalculate a user's daily goal after their profile changed"""
+    user = User.query.get(user_id)
+    if user:
+        daily_goal = calculate_water_goal(user)
+        return {'goal': daily_goal.amount}
+
+# Free the Gemini slot taken by /chatbot_message once the reply is ready or has failed for good
+@task_queue.task(on_finish=lambda record: admission.release('gemini'))
+def chatbot_reply(user_message, user_data, water_data, note='', user_id=None, history=None):
+    """Generate a chatbot reply, which may block on the Gemini API"""
+    reply = generate_response(user_message, user_data, water_data, history,
+                              current_app.config['CHAT_PROMPT_TOKEN_BUDGET'])
+    if user_id is not None:
+        conversation_memory.add_exchange(user_id, user_message, reply)
+    return {'message': reply + note}
 
-@app.route('/')
+@main.route('/')
 def index():
     if 'user_id' in session:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     return render_template('index.html')
 
-@app.route('/profile', methods=['GET', 'POST'])
+@main.route('/profile', methods=['GET', 'POST'])
 def profile():
     if request.method == 'POST':
         data = request.form
@@ -70,12 +333,21 @@ def profile():
             user.height = float(data['height'])
             user.profession = data['profession']
             user.email = data.get('email', user.email)
+            bump_data_version(user.id)
             db.session.commit()
+            server_sessions.invalidate_user(user.id)
         
-        # Calculate recommended water intake
-        calculate_water_goal(user)
+        # Calculate recommended water intake. New users need a goal before the
+        # dashboard renders, existing users keep their old goal until the task runs.
+        if user.daily_goal is None:
+            calculate_water_goal(user)
+        else:
+            try:
+                task_queue.enqueue('recalculate_water_goal', user.id, owner=user.id)
+            except QueueFullError:
+                calculate_water_goal(user)
         
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     user = None
     if 'user_id' in session:
@@ -83,154 +355,168 @@ def profile():
     
     return render_template('profile.html', user=user)
 
-@app.route('/dashboard')
-def dashboard():
-    if 'user_id' not in session:
-        return redirect(url_for('index'))
-    
-    user = User.query.get(session['user_id'])
-    if not user:
-        return redirect(url_for('index'))
-    
-    # Get today's water intake
-    today = datetime.now().date()
-    today_intake = WaterIntake.query.filter_by(
-        user_id=user.id, 
-        date=today
-    ).first()
-    
-    if not today_intake:
-        today_intake = WaterIntake(user_id=user.id, date=today, amount=0)
-        db.session.add(today_intake)
-        db.session.commit()
+# Tips rotated client-side on the dashboard, so the page itself stays the same for every user
+DASHBOARD_TIPS = [
+    "Drinking water before meals can help with weight management.",
+    "Herbal teas count towards your daily water intake.",
+    "Eat water-rich fruits and vegetables to boost hydration.",
+    "Keep a water bottle with you at all times as a visual reminder.",
+    "Try infusing your water with fruits for added flavor.",
+    "Drinking cold water can help burn more calories.",
+    "Proper hydration can help reduce headaches.",
+    "Replace sugary drinks with water to reduce calorie intake.",
+    "Drinking water can help improve your mood and cognitive function."
+]
+
+# Rendered page shells, keyed by template name (only cached outside debug mode)
+_shell_cache = {}
+
+def render_shell(template_name, **context):
+    """
+    Render a page that holds no per-user data and serve it with an ETag.
+
+    The HTML is rendered once per process; browsers revalidate it on each
+    visit (Cache-Control: no-cache) and get a 304 while it is unchanged.
+    """
+    html = _shell_cache.get(template_name)
+    if html is None:
+        html = render_template(template_name, **context)
+        if not current_app.debug:
+            _shell_cache[template_name] = html
+    
+    response = current_app.make_response(html)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+def calculate_streak(user_id, goal_amount, today, today_amount):
+    """Count consecutive days (ending today or yesterday) on which the goal was met"""
+    streak = 0
+    check_date = today - timedelta(days=1)
     
-    # Get daily goal
-    daily_goal = DailyGoal.query.filter_by(user_id=user.id).first()
-    if not daily_goal:
-        daily_goal = calculate_water_goal(user)
+    # Walk back through history newest-first in a single query, stopping at the first gap
+    history = WaterIntake.query.with_entities(WaterIntake.date, WaterIntake.amount).filter(
+        WaterIntake.user_id == user_id,
+        WaterIntake.date < today
+    ).order_by(WaterIntake.date.desc()).yield_per(64)
     
-    # Get intake history for the last 30 days
-    thirty_days_ago = today - timedelta(days=30)
-    intake_history = WaterIntake.query.filter(
-        WaterIntake.user_id == user.id,
-        WaterIntake.date >= thirty_days_ago
-    ).all()
-    
-    # Format history for calendar
-    calendar_data = {}
-    for intake in intake_history:
-        date_str = intake.date.strftime('%Y-%m-%d')
-        goal_achieved = intake.amount >= daily_goal.amount
-        calendar_data[date_str] = {
-            'amount': intake.amount,
-            'goal': daily_goal.amount,
-            'achieved': goal_achieved
-        }
-    
-    # Prepare calendar days for template
-    now = datetime.now()
-    current_month_days = []
-    
-    # Get the first day of the month and the number of days in the month
-    first_day = datetime(now.year, now.month, 1)
-    if now.month == 12:
-        next_month = datetime(now.year + 1, 1, 1)
+    for date, amount in history:
+        if date != check_date or amount < goal_amount:
+            break
+        streak += 1
+        check_date -= timedelta(days=1)
     else:
-        next_month = datetime(now.year, now.month + 1, 1)
-    
-    num_days = (next_month - first_day).days
+        # No gap before the oldest row in water_intakes, so the streak may continue into the archive
+        streak += intake_archive.goal_streak(user_id, check_date, goal_amount)
     
-    # Add empty days for the beginning of the month
-    weekday = first_day.weekday()
-    for _ in range((weekday + 1) % 7):  # Convert to Sunday-based week
-        current_month_days.append({'empty': True})
+    # Add today if goal achieved
+    if today_amount >= goal_amount:
+        streak += 1
+    return streak
+
+@main.route('/dashboard')
+def dashboard():
+    if 'user_id' not in session:
+        return redirect(url_for('main.index'))
     
-    # Add the days of the month
-    for day in range(1, num_days + 1):
-        date_obj = datetime(now.year, now.month, day).date()
-        date_str = date_obj.strftime('%Y-%m-%d')
-        
-        water_intake = WaterIntake.query.filter_by(
-            user_id=user.id, 
-            date=date_obj
-        ).first()
-        
-        achieved = False
-        if water_intake and daily_goal:
-            achieved = water_intake.amount >= daily_goal.amount
-        
-        current_month_days.append({
-            'day': day,
-            'empty': False,
-            'achieved': achieved,
-            'today': date_obj == today
-        })
+    # Static shell; the data comes from /api/dashboard
+    return render_shell('dashboard.html', tips=DASHBOARD_TIPS)
+
+def dashboard_payload(user, goal, today, pending):
+    """Today's progress, streak and this month's calendar, as shown on the dashboard"""
+    # Get this month's intake (the calendar) in one query
+    first_day = today.replace(day=1)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    month_intake = dict(
+        WaterIntake.query.with_entities(WaterIntake.date, WaterIntake.amount).filter(
+            WaterIntake.user_id == user.id,
+            WaterIntake.date >= first_day,
+            WaterIntake.date < next_month
+        )
+    )
     
-    # Get percentage of water consumed
-    percentage = min(100, int((today_intake.amount / daily_goal.amount) * 100)) if daily_goal.amount > 0 else 0
+    # Include intake still waiting in the write buffer
+    today_amount = month_intake.get(today, 0) + pending
+    month_intake[today] = today_amount
     
-    # Calculate streak
-    streak = 0
-    check_date = today - timedelta(days=1)
+    # Bit (day - 1) is set when the goal was achieved that day
+    achieved_bitmap = 0
+    for date, amount in month_intake.items():
+        if amount >= goal:
+            achieved_bitmap |= 1 << (date.day - 1)
     
-    while True:
-        intake = WaterIntake.query.filter_by(
-            user_id=user.id, 
-            date=check_date
-        ).first()
-        
-        if intake and intake.amount >= daily_goal.amount:
-            streak += 1
-            check_date -= timedelta(days=1)
-        else:
-            break
+    # Get percentage of water consumed
+    percentage = min(100, int((today_amount / goal) * 100)) if goal > 0 else 0
     
-    # Add today if goal achieved
-    if today_intake.amount >= daily_goal.amount:
-        streak += 1
+    streak = calculate_streak(user.id, goal, today, today_amount)
+    cohort_stats.observe_streak(user, streak)
     
-    # Get a random hydration tip
-    tips = [
-        "Drinking water before meals can help with weight management.",
-        "Herbal teas count towards your daily water intake.",
-        "Eat water-rich fruits and vegetables to boost hydration.",
-        "Keep a water bottle with you at all times as a visual reminder.",
-        "Try infusing your water with fruits for added flavor.",
-        "Drinking cold water can help burn more calories.",
-        "Proper hydration can help reduce headaches.",
-        "Replace sugary drinks with water to reduce calorie intake.",
-        "Drinking water can help improve your mood and cognitive function."
-    ]
-    tip = random.choice(tips)
+    return {
+        'user_id': user.id,
+        'version': user.data_version,
+        'name': user.name,
+        'timezone': user.timezone,
+        'current_date': today.strftime('%B %d, %Y'),
+        'intake': today_amount,
+        'target': goal,
+        'percentage': percentage,
+        'streak': streak,
+        'streak_percentage': min(100, streak * 10),  # 10 days is 100%
+        'calendar': {
+            'year': today.year,
+            'month': today.month,
+            'days': (next_month - first_day).days,
+            'offset': (first_day.weekday() + 1) % 7,  # Sunday-based week
+            'today': today.day,
+            'achieved': achieved_bitmap
+        },
+        'gemini_api_key_set': session.get('gemini_api_key_set', False)
+    }
+
+@main.route('/api/dashboard')
+def dashboard_data():
+    """Per-user dashboard payload, revalidated with an ETag derived from the user's data version"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
     
-    # Check if Gemini API key is set
+    # Everything but the intake comes from the cached user context
+    user = server_sessions.current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    goal = user.goal
+    if goal is None:
+        goal = calculate_water_goal(User.query.get(user.id)).amount
+    
+    # Everything the payload depends on goes into the ETag, so a match means nothing changed
+    today = local_today(user.timezone)
+    pending = intake_buffer.pending(user.id, today)
     gemini_api_key_set = session.get('gemini_api_key_set', False)
-    
-    return render_template(
-        'dashboard.html', 
-        user=user,
-        intake=today_intake.amount,
-        target=daily_goal.amount,
-        percentage=percentage,
-        streak=streak,
-        streak_percentage=min(100, streak * 10),  # 10 days is 100%
-        calendar_days=current_month_days,
-        current_date=today.strftime('%B %d, %Y'),
-        tip=tip,
-        gemini_api_key_set=gemini_api_key_set
-    )
+    etag = f'{user.id}-{user.data_version}-{today.isoformat()}-{pending}-{int(gemini_api_key_set)}'
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    
+    response = jsonify({'success': True, **dashboard_payload(user, goal, today, pending)})
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
-@app.route('/insights')
+@main.route('/insights')
 def insights():
     if 'user_id' not in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    user = User.query.get(session['user_id'])
+    user = server_sessions.current_user()
     if not user:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     # Get water intake history for the last 30 days
-    today = datetime.now().date()
+    today = local_today(user.timezone)
     thirty_days_ago = today - timedelta(days=30)
     intake_history = WaterIntake.query.filter(
         WaterIntake.user_id == user.id,
@@ -238,35 +524,24 @@ def insights():
     ).order_by(WaterIntake.date).all()
     
     # Get daily goal
-    daily_goal = DailyGoal.query.filter_by(user_id=user.id).first()
-    
-    # Calculate current streak
-    streak = 0
-    check_date = today - timedelta(days=1)
-    
-    while True:
-        intake = WaterIntake.query.filter_by(
-            user_id=user.id, 
-            date=check_date
-        ).first()
-        
-        if intake and intake.amount >= daily_goal.amount:
-            streak += 1
-            check_date -= timedelta(days=1)
-        else:
-            break
+    goal = user.goal
+    if goal is None:
+        goal = calculate_water_goal(User.query.get(user.id)).amount
     
-    # Add today if goal achieved
+    # Calculate current streak, including intake still in the write buffer
     today_intake = WaterIntake.query.filter_by(
         user_id=user.id, 
         date=today
     ).first()
+    today_amount = (today_intake.amount if today_intake else 0) + intake_buffer.pending(user.id, today)
+    streak = calculate_streak(user.id, goal, today, today_amount)
     
-    if today_intake and today_intake.amount >= daily_goal.amount:
-        streak += 1
+    # Rank against peers of similar age and profession
+    cohort_stats.observe_streak(user, streak)
+    ranking = cohort_stats.lookup(user.id)
     
-    # Get all historical data for badge calculation
-    all_history = WaterIntake.query.filter_by(user_id=user.id).order_by(WaterIntake.date).all()
+    # Get all historical data for badge calculation, including archived days
+    all_history = intake_archive.daily_totals(user.id)
     
     # Calculate badges
     badges = {
@@ -289,8 +564,8 @@ def insights():
     for i in range(min(7, len(all_history))):
         if i >= len(all_history):
             break
-        intake_record = all_history[-(i+1)]  # Get most recent days
-        if intake_record.amount >= daily_goal.amount * 1.5:
+        date, amount = all_history[-(i+1)]  # Get most recent days
+        if amount >= goal * 1.5:
             overachiever_days += 1
     
     badges['overachiever'] = overachiever_days >= 7
@@ -304,63 +579,52 @@ def insights():
         badges['consistency'] = True
         badges['goal_setter'] = True
     
-    # Prepare calendar days for template
-    now = datetime.now()
-    current_month_days = []
-    current_month = now.strftime('%B %Y')
-    
-    # Get the first day of the month and the number of days in the month
-    first_day = datetime(now.year, now.month, 1)
-    if now.month == 12:
-        next_month = datetime(now.year + 1, 1, 1)
-    else:
-        next_month = datetime(now.year, now.month + 1, 1)
-    
-    num_days = (next_month - first_day).days
-    
-    # Add empty days for the beginning of the month
-    weekday = first_day.weekday()
-    for _ in range((weekday + 1) % 7):  # Convert to Sunday-based week
-        current_month_days.append({'empty': True})
-    
-    # Add the days of the month
-    for day in range(1, num_days + 1):
-        date_obj = datetime(now.year, now.month, day).date()
-        date_str = date_obj.strftime('%Y-%m-%d')
-        
-        water_intake = WaterIntake.query.filter_by(
-            user_id=user.id, 
-            date=date_obj
-        ).first()
-        
-        streak_day = False
-        if water_intake and daily_goal:
-            streak_day = water_intake.amount >= daily_goal.amount
-        
-        current_month_days.append({
-            'day': day,
-            'empty': False,
-            'streak': streak_day,
-            'today': date_obj == today
-        })
+    # This month's calendar: the grid is a cached fragment keyed by month,
+    # and the days the goal was met are marked from a bitmap in one query
+    first_day = today.replace(day=1)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    month_intake = dict(
+        WaterIntake.query.with_entities(WaterIntake.date, WaterIntake.amount).filter(
+            WaterIntake.user_id == user.id,
+            WaterIntake.date >= first_day,
+            WaterIntake.date < next_month
+        ).all()
+    )
+    month_intake[today] = today_amount
+    
+    # Bit (day - 1) is set when the goal was achieved that day
+    achieved_bitmap = 0
+    for date, amount in month_intake.items():
+        if amount >= goal:
+            achieved_bitmap |= 1 << (date.day - 1)
+    
+    calendar = {
+        'year': today.year,
+        'month': today.month,
+        'days': (next_month - first_day).days,
+        'offset': (first_day.weekday() + 1) % 7,  # Sunday-based week
+        'today': today.day,
+        'achieved': achieved_bitmap
+    }
     
     return render_template(
         'insights.html',
         user=user,
         streak=streak,
-        calendar_days=current_month_days,
-        current_month=current_month,
-        badges=badges
+        calendar=calendar,
+        current_month=first_day.strftime('%B %Y'),
+        badges=badges,
+        ranking=ranking
     )
 
-@app.route('/settings')
+@main.route('/settings')
 def settings():
     if 'user_id' not in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     user = User.query.get(session['user_id'])
     if not user:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     # Get the user's reminder settings
     reminder = WaterReminder.query.filter_by(user_id=user.id).first()
@@ -379,59 +643,289 @@ def settings():
                           reminder=reminder,
                           gemini_api_key_set=gemini_api_key_set)
 
-@app.route('/add_water', methods=['POST'])
+@main.route('/add_water', methods=['POST'])
+@admission.limit('write')
 def add_water():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'})
     
-    data = request.json
-    amount = data.get('amount', 0)
+    user = server_sessions.current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'Not logged in'})
     
-    today = datetime.now().date()
+    data = request.get_json(silent=True) or {}
+    amount = data.get('amount') if isinstance(data, dict) else None
+    # Checked before it reaches the write buffer, its journal or the daily total
+    if not isinstance(amount, int) or isinstance(amount, bool) or not 0 < amount <= MAX_INTAKE_AMOUNT:
+        return jsonify({'success': False,
+                        'message': f'amount must be an integer between 1 and {MAX_INTAKE_AMOUNT}'}), 400
+    
+    today = local_today(user.timezone)
     intake = WaterIntake.query.filter_by(
         user_id=session['user_id'], 
         date=today
     ).first()
     
-    if not intake:
-        intake = WaterIntake(
-            user_id=session['user_id'],
-            date=today,
-            amount=amount
-        )
-        db.session.add(intake)
+    if intake_buffer.enabled:
+        # Coalesce with other recent sips; the buffer writes them in one batch
+        pending = intake_buffer.add(session['user_id'], today, amount)
+        current_amount = (intake.amount if intake else 0) + pending
     else:
-        intake.amount += amount
-    
-    db.session.commit()
+        if not intake:
+            intake = WaterIntake(
+                user_id=session['user_id'],
+                date=today,
+                amount=amount
+            )
+            db.session.add(intake)
+        else:
+            intake.amount += amount
+        
+        intake.version = bump_data_version(session['user_id'])[session['user_id']]
+        db.session.commit()
+        current_amount = intake.amount
     
-    # Get daily goal
-    daily_goal = DailyGoal.query.filter_by(user_id=session['user_id']).first()
-    goal_achieved = intake.amount >= daily_goal.amount if daily_goal else False
+    # Daily goal, from the cached user context
+    goal = user.goal or 0
+    goal_achieved = current_amount >= goal if goal else False
     
     # Calculate percentage for the water fill display
-    percentage = min(100, int((intake.amount / daily_goal.amount) * 100)) if daily_goal and daily_goal.amount > 0 else 0
+    percentage = min(100, int((current_amount / goal) * 100)) if goal > 0 else 0
     
     return jsonify({
         'success': True, 
-        'current_amount': intake.amount,
-        'goal': daily_goal.amount if daily_goal else 0,
+        'current_amount': current_amount,
+        'goal': goal,
         'goal_achieved': goal_achieved,
         'percentage': percentage
     })
 
-@app.route('/chatbot_message', methods=['POST'])
+def parse_event_time(value):
+    """Parse a device timestamp (ISO 8601 string or Unix seconds) into local naive time"""
+    if isinstance(value, bool):
+        raise ValueError('invalid timestamp')
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value)
+        if isinstance(value, str):
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone().replace(tzinfo=None)
+            return parsed
+    except (ValueError, OverflowError, OSError):
+        # Out-of-range numbers overflow rather than raising ValueError
+        raise ValueError('invalid timestamp') from None
+    raise ValueError('invalid timestamp')
+
+def ingest_intake_events(events, is_device=False):
+    """
+    Validate, deduplicate and apply timestamped sip events in one transaction.
+    
+    Args:
+        events: List of event objects with event_id, amount, timestamp and (devices only) user_id
+        is_device: Whether the caller may log intake for any user
+    
+    Returns:
+        (accepted event IDs, duplicate event IDs, rejected events with the reason)
+    
+    Raises:
+        Exception: if the transaction fails; it is rolled back and nothing was applied
+    """
+    # Validate events; browser sessions may only log for their own user
+    valid = {}
+    rejected = []
+    duplicates = []
+    now = datetime.now()
+    earliest = now - timedelta(days=current_app.config['INTAKE_EVENT_MAX_AGE_DAYS'])
+    latest = now + timedelta(seconds=current_app.config['INTAKE_EVENT_MAX_SKEW_SECONDS'])
+    for index, event in enumerate(events):
+        try:
+            if not isinstance(event, dict):
+                raise ValueError('event must be an object')
+            event_id = event.get('event_id')
+            if not isinstance(event_id, str) or not 0 < len(event_id) <= 64:
+                raise ValueError('event_id must be a string of 1-64 characters')
+            user_id = event.get('user_id', session.get('user_id'))
+            if not isinstance(user_id, int) or isinstance(user_id, bool):
+                raise ValueError('user_id must be an integer')
+            if not is_device and user_id != session['user_id']:
+                raise ValueError('cannot log intake for another user')
+            amount = event.get('amount')
+            if not isinstance(amount, int) or isinstance(amount, bool) or not 0 < amount <= MAX_INTAKE_AMOUNT:
+                raise ValueError(f'amount must be an integer between 1 and {MAX_INTAKE_AMOUNT}')
+            recorded_at = parse_event_time(event.get('timestamp'))
+            if recorded_at > latest:
+                raise ValueError('timestamp is in the future')
+            if recorded_at < earliest:
+                raise ValueError(f"timestamp is more than {current_app.config['INTAKE_EVENT_MAX_AGE_DAYS']} days old")
+        except ValueError as e:
+            rejected.append({'index': index, 'message': str(e)})
+            continue
+        
+        if (user_id, event_id) in valid:
+            duplicates.append(event_id)
+            continue
+        valid[(user_id, event_id)] = (amount, recorded_at)
+    
+    # Drop events for unknown users and events that were already applied
+    user_ids = {user_id for user_id, _ in valid}
+    known_users = {
+        row.id: row.timezone
+        for row in User.query.with_entities(User.id, User.timezone).filter(User.id.in_(user_ids))
+    } if user_ids else {}
+    seen = set()
+    keys = list(valid)
+    for start in range(0, len(keys), 500):
+        chunk_ids = {event_id for _, event_id in keys[start:start + 500]}
+        seen.update(
+            (row.user_id, row.event_id)
+            for row in IntakeEvent.query.with_entities(IntakeEvent.user_id, IntakeEvent.event_id)
+            .filter(IntakeEvent.user_id.in_(user_ids), IntakeEvent.event_id.in_(chunk_ids))
+        )
+    
+    new_events = []
+    deltas = {}
+    for (user_id, event_id), (amount, recorded_at) in valid.items():
+        if user_id not in known_users:
+            rejected.append({'event_id': event_id, 'message': 'unknown user'})
+            continue
+        if (user_id, event_id) in seen:
+            duplicates.append(event_id)
+            continue
+        new_events.append({
+            'user_id': user_id,
+            'event_id': event_id,
+            'amount': amount,
+            'recorded_at': recorded_at
+        })
+        key = (user_id, to_local_date(known_users[user_id], recorded_at))
+        deltas[key] = deltas.get(key, 0) + amount
+    
+    if new_events:
+        try:
+            db.bulk_insert(IntakeEvent, new_events)
+            apply_intake_deltas(deltas, commit=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    return [event['event_id'] for event in new_events], duplicates, rejected
+
+@main.route('/api/intake/batch', methods=['POST'])
+@admission.limit('write')
+def intake_batch():
+    """Apply a batch of timestamped sip events from a device in one transaction"""
+    token = current_app.config.get('DEVICE_API_TOKEN')
+    is_device = bool(token) and request.headers.get('X-Device-Token') == token
+    if not is_device and 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    events = data.get('events')
+    if not isinstance(events, list):
+        return jsonify({'success': False, 'message': 'events must be a list'}), 400
+    if len(events) > current_app.config['INTAKE_BATCH_MAX_EVENTS']:
+        return jsonify({'success': False, 'message': 'Too many events in one batch'}), 413
+    
+    try:
+        accepted, duplicates, rejected = ingest_intake_events(events, is_device)
+    except Exception as e:
+        print(f"Error applying intake batch: {str(e)}")
+        return jsonify({'success': False, 'message': 'Could not apply batch, please retry'}), 500
+    
+    return jsonify({
+        'success': True,
+        'accepted': len(accepted),
+        'duplicates': len(duplicates),
+        'rejected': rejected
+    })
+
+@main.route('/api/sync', methods=['POST'])
+@admission.limit('write')
+def sync():
+    """
+    Offline-first sync for the browser.
+    
+    The client queues sip events locally and posts them with the last data
+    version it saw. Events are applied idempotently (deduplicated by event ID),
+    so a batch can be retried until it is acknowledged. The reply carries the
+    current version and, only if that differs from the client's, the days whose
+    totals changed since then plus a fresh dashboard payload.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    since = data.get('version', 0)
+    events = data.get('events', [])
+    if not isinstance(since, int) or isinstance(since, bool) or since < 0:
+        return jsonify({'success': False, 'message': 'version must be a non-negative integer'}), 400
+    if not isinstance(events, list):
+        return jsonify({'success': False, 'message': 'events must be a list'}), 400
+    if len(events) > current_app.config['INTAKE_BATCH_MAX_EVENTS']:
+        return jsonify({'success': False, 'message': 'Too many events in one batch'}), 413
+    
+    try:
+        accepted, duplicates, rejected = ingest_intake_events(events)
+    except Exception as e:
+        print(f"Error applying sync batch: {str(e)}")
+        return jsonify({'success': False, 'message': 'Could not apply batch, please retry'}), 500
+    
+    user = server_sessions.current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    result = {
+        'success': True,
+        'version': user.data_version,
+        'acked': accepted + duplicates,
+        'rejected': rejected
+    }
+    if since == user.data_version:
+        return jsonify(result)
+    
+    goal = user.goal
+    if goal is None:
+        goal = calculate_water_goal(User.query.get(user.id)).amount
+    today = local_today(user.timezone)
+    
+    changed = WaterIntake.query.with_entities(WaterIntake.date, WaterIntake.amount).filter(
+        WaterIntake.user_id == user.id
+    )
+    if 0 < since < user.data_version:
+        changed = changed.filter(WaterIntake.version > since)
+    else:
+        # First sync, or a version this server never issued: send the last 30 days
+        changed = changed.filter(WaterIntake.date >= today - timedelta(days=30))
+    result['days'] = [{'date': date.isoformat(), 'amount': amount}
+                      for date, amount in changed.order_by(WaterIntake.date)]
+    result['dashboard'] = dashboard_payload(user, goal, today, intake_buffer.pending(user.id, today))
+    return jsonify(result)
+
+@main.route('/chatbot_message', methods=['POST'])
+@admission.limit('chat')
 def chatbot_message():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'})
     
     data = request.json
-    user_message = data.get('message', '').lower()
+    user_message = data.get('message', '')
+    if not isinstance(user_message, str):
+        return jsonify({'success': False, 'message': 'message must be a string'}), 400
+    if len(user_message) > current_app.config['CHAT_MAX_MESSAGE_CHARS']:
+        return jsonify({
+            'success': False,
+            'message': f"That message is too long, please keep it under {current_app.config['CHAT_MAX_MESSAGE_CHARS']} characters."
+        }), 413
+    user_message = user_message.lower()
     
-    user = User.query.get(session['user_id'])
-    today = datetime.now().date()
+    user = server_sessions.current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    today = local_today(user.timezone)
     intake = WaterIntake.query.filter_by(user_id=user.id, date=today).first()
-    daily_goal = DailyGoal.query.filter_by(user_id=user.id).first()
+    goal = user.goal
     
     if not intake:
         intake = WaterIntake(user_id=user.id, date=today, amount=0)
@@ -477,11 +971,15 @@ def chatbot_message():
     
     if amount > 0:
         intake.amount += amount
+        intake.version = bump_data_version(user.id)[user.id]
         db.session.commit()
         water_added = True
 
+    # Include intake still waiting in the write buffer
+    current_amount = intake.amount + intake_buffer.pending(user.id, today)
+
     # Prepare user and water data for AI model
-    goal_percentage = (intake.amount / daily_goal.amount) * 100 if daily_goal else 0
+    goal_percentage = (current_amount / goal) * 100 if goal else 0
     
     user_data = {
         'name': user.name,
@@ -492,36 +990,77 @@ def chatbot_message():
     }
     
     water_data = {
-        'current_amount': intake.amount,
-        'goal': daily_goal.amount if daily_goal else 0,
+        'current_amount': current_amount,
+        'goal': goal or 0,
         'percentage': goal_percentage,
-        'remaining': (daily_goal.amount - intake.amount) if daily_goal else 0
+        'remaining': (goal - current_amount) if goal else 0,
+        'water_added': water_added
     }
     
     # Check if Gemini API key is configured
     api_key_set = session.get('gemini_api_key_set', False)
     
-    # Use Gemini to generate a response
-    response = generate_response(user_message, user_data, water_data)
-    
     # If API key isn't set, add a note to the response
+    note = ''
     if not api_key_set and 'api' not in user_message.lower() and 'gemini' not in user_message.lower():
-        response += "\n\n(Note: For more advanced AI responses, ask your admin to set up the Gemini API key in Settings.)"
+        note = "\n\n(Note: For more advanced AI responses, ask your admin to set up the Gemini API key in Settings.)"
 
     # Calculate percentage for the water fill display
-    percentage = min(100, int((intake.amount / daily_goal.amount) * 100)) if daily_goal and daily_goal.amount > 0 else 0
+    percentage = min(100, int((current_amount / goal) * 100)) if goal else 0
     
-    return jsonify({
+    result = {
         'success': True,
-        'message': response,
-        'current_amount': intake.amount,
-        'goal': daily_goal.amount if daily_goal else 0,
+        'current_amount': current_amount,
+        'goal': goal or 0,
         'percentage': percentage,
         'water_added': water_added,
         'api_key_set': api_key_set
+    }
+    
+    # Progress, tips, facts and logging are answered locally right away
+    reply = local_response(user_message, user_data, water_data)
+    if reply is not None:
+        conversation_memory.add_exchange(user.id, user_message, reply)
+        result['message'] = reply + note
+        return jsonify(result)
+    
+    # Open-ended messages go to Gemini in the background with the recent conversation;
+    # the client polls /task_status for the reply
+    history = conversation_memory.history(user.id)
+    try:
+        admission.acquire('gemini', user.id, queue_depth=task_queue.depth)
+        result['task_id'] = task_queue.enqueue('chatbot_reply', user_message, user_data, water_data,
+                                               note=note, user_id=user.id, history=history, owner=user.id)
+        result['pending'] = True
+    except (Overloaded, QueueFullError) as e:
+        if isinstance(e, QueueFullError):
+            admission.release('gemini')
+        # Shed load with a canned answer instead of waiting behind other Gemini calls
+        reply = fallback_reply(user_message, user_data, water_data)
+        conversation_memory.add_exchange(user.id, user_message, reply)
+        result['message'] = reply + note
+        result['shed'] = True
+    
+    return jsonify(result)
+
+@main.route('/task_status/<task_id>', methods=['GET'])
+def task_status(task_id):
+    """Poll the state of a background task started by this user"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    
+    record = task_queue.status(task_id)
+    if not record or record.get('owner') != session['user_id']:
+        return jsonify({'success': False, 'message': 'Unknown task'}), 404
+    
+    return jsonify({
+        'success': True,
+        'state': record['state'],
+        'result': record.get('result'),
+        'error': record.get('error')
     })
 
-@app.route('/check_water_reminder', methods=['GET'])
+@main.route('/check_water_reminder', methods=['GET'])
 def check_water_reminder():
     """Check if it's time to send a water reminder to the user"""
     if 'user_id' not in session:
@@ -542,60 +1081,40 @@ def check_water_reminder():
     if not reminder.is_enabled:
         return jsonify({'success': True, 'should_remind': False})
     
-    # Get the current time
     now = datetime.now()
     
-    # Calculate the time difference since the last reminder
-    time_diff = now - reminder.last_reminder_time
-    minutes_passed = time_diff.total_seconds() / 60
-    
-    # Check if it's time for a reminder (1.5 hours = 90 minutes)
-    should_remind = minutes_passed >= reminder.reminder_interval
-    
-    # If it's time for a reminder, update the last reminder time
-    if should_remind:
-        reminder.last_reminder_time = now
-        db.session.commit()
-        
-        # Get personalized reminder message
-        user = User.query.get(user_id)
-        today = datetime.now().date()
-        intake = WaterIntake.query.filter_by(user_id=user_id, date=today).first()
-        daily_goal = DailyGoal.query.filter_by(user_id=user_id).first()
-        
-        if not intake:
-            intake = WaterIntake(user_id=user_id, date=today, amount=0)
-            db.session.add(intake)
-            db.session.commit()
-        
-        # Calculate remaining water needed
-        remaining = (daily_goal.amount - intake.amount) if daily_goal else 2500
-        
-        # Generate a personalized reminder message
-        reminder_messages = [
-            f"Hi {user.name}! It's been 1.5 hours since your last water break. Time to hydrate!",
-            f"Water break time! You still need {remaining}ml to reach your daily goal.",
-            f"Remember to stay hydrated, {user.name}! How about drinking some water now?",
-            "Hydration reminder! A glass of water will help you stay focused and energized.",
-            "Your body needs water to function properly. Take a moment to hydrate now!"
-        ]
-        
-        message = random.choice(reminder_messages)
-        
+    # Until the scheduled time there is nothing to read or write
+    if reminder.next_reminder_at is not None and now < reminder.next_reminder_at:
         return jsonify({
             'success': True,
-            'should_remind': True,
-            'message': message,
-            'current_amount': intake.amount,
-            'goal': daily_goal.amount if daily_goal else 2500
+            'should_remind': False,
+            'next_check_seconds': round((reminder.next_reminder_at - now).total_seconds())
         })
     
-    return jsonify({
+    # Compare today's intake, including intake still in the write buffer, with the expected pace
+    user = server_sessions.current_user()
+    if not user:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    today = local_today(user.timezone)
+    intake = WaterIntake.query.filter_by(user_id=user_id, date=today).first()
+    goal = user.goal or 2500
+    current_amount = (intake.amount if intake else 0) + intake_buffer.pending(user_id, today)
+    
+    result = reminder_planner.evaluate(reminder, user.timezone, goal, current_amount, now)
+    db.session.commit()
+    
+    response = {
         'success': True,
-        'should_remind': False
-    })
+        'should_remind': result.remind,
+        'next_check_seconds': round((result.next_check - now).total_seconds()),
+        'current_amount': current_amount,
+        'goal': goal
+    }
+    if result.remind:
+        response['message'] = reminder_message(user.name, result, current_amount, goal)
+    return jsonify(response)
 
-@app.route('/toggle_water_reminders', methods=['POST'])
+@main.route('/toggle_water_reminders', methods=['POST'])
 def toggle_water_reminders():
     """Enable or disable water reminders for the user"""
     if 'user_id' not in session:
@@ -614,6 +1133,7 @@ def toggle_water_reminders():
         db.session.add(reminder)
     else:
         reminder.is_enabled = enabled
+        reminder.next_reminder_at = None
     
     db.session.commit()
     
@@ -622,7 +1142,7 @@ def toggle_water_reminders():
         'is_enabled': reminder.is_enabled
     })
 
-@app.route('/set_reminder_interval', methods=['POST'])
+@main.route('/set_reminder_interval', methods=['POST'])
 def set_reminder_interval():
     """Set the interval for water reminders in minutes"""
     if 'user_id' not in session:
@@ -644,6 +1164,7 @@ def set_reminder_interval():
         db.session.add(reminder)
     else:
         reminder.reminder_interval = interval
+        reminder.next_reminder_at = None
     
     db.session.commit()
     
@@ -652,12 +1173,98 @@ def set_reminder_interval():
         'interval': reminder.reminder_interval
     })
 
-@app.route('/logout')
+@main.route('/set_timezone', methods=['POST'])
+def set_timezone():
+    """Set the user's IANA timezone (detected by the browser) and re-bucket their history"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    
+    data = request.json
+    timezone = data.get('timezone', '')
+    
+    if not is_valid_timezone(timezone):
+        return jsonify({'success': False, 'message': 'Unknown timezone'})
+    
+    user = User.query.get(session['user_id'])
+    moved = change_user_timezone(user, timezone)
+    server_sessions.invalidate_user(user.id)
+    
+    return jsonify({
+        'success': True,
+        'timezone': user.timezone,
+        'rebucketed_events': moved
+    })
+
+@main.cli.command('rebucket-timezones')
+@click.option('--timezone', 'default_timezone', required=True, help='IANA timezone for users without one')
+def rebucket_timezones(default_timezone):
+    """Assign a timezone to users who have none and move their history into local days"""
+    if not is_valid_timezone(default_timezone):
+        raise click.BadParameter(f'Unknown timezone: {default_timezone}')
+    
+    for user in User.query.filter(User.timezone.is_(None)).all():
+        moved = change_user_timezone(user, default_timezone)
+        server_sessions.invalidate_user(user.id)
+        click.echo(f'{user.name} (#{user.id}): {moved} events re-bucketed')
+
+@main.route('/logout')
 def logout():
+    if 'user_id' in session:
+        conversation_memory.clear(session['user_id'])
     session.pop('user_id', None)
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
+
+def profiler_authorized():
+    """Whether the request carries the PROFILER_TOKEN shared secret"""
+    token = current_app.config.get('PROFILER_TOKEN')
+    # Compared as bytes: compare_digest() raises TypeError for non-ASCII strings
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Profiler-Token', '').encode(), token.encode())
+
+@main.route('/admin/profiler', methods=['GET'])
+def profiler_status():
+    """State of the current or last profiling session, with time per endpoint and category"""
+    if not profiler_authorized():
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    return jsonify({'success': True, **profiler.summary()})
 
-@app.route('/set_gemini_api_key', methods=['POST'])
+@main.route('/admin/profiler/start', methods=['POST'])
+def profiler_start():
+    """Sample all requests and tasks, or a fraction of one endpoint's requests, for a number of seconds"""
+    if not profiler_authorized():
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 30))
+        interval_ms = float(data['interval_ms']) if 'interval_ms' in data else None
+        fraction = float(data.get('fraction', 1.0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'seconds, interval_ms and fraction must be numbers'}), 400
+    endpoint = data.get('endpoint')
+    if endpoint is not None and endpoint not in current_app.view_functions:
+        return jsonify({'success': False, 'message': f'Unknown endpoint {endpoint}'}), 400
+    if seconds <= 0 or not 0 < fraction <= 1:
+        return jsonify({'success': False, 'message': 'seconds must be positive and fraction between 0 and 1'}), 400
+    
+    if not profiler.start(seconds, interval_ms, endpoint, fraction):
+        return jsonify({'success': False, 'message': 'A profiling session is already running'}), 409
+    return jsonify({'success': True, **profiler.summary()})
+
+@main.route('/admin/profiler/stop', methods=['POST'])
+def profiler_stop():
+    if not profiler_authorized():
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    profiler.stop()
+    return jsonify({'success': True, **profiler.summary()})
+
+@main.route('/admin/profiler/stacks', methods=['GET'])
+def profiler_stacks():
+    """Collapsed stacks for flamegraph.pl or speedscope"""
+    if not profiler_authorized():
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    return current_app.response_class(profiler.collapsed(), mimetype='text/plain')
+
+@main.route('/set_gemini_api_key', methods=['POST'])
 def set_gemini_api_key():
     """Set the Gemini API key for the chatbot"""
     if 'user_id' not in session:
@@ -680,7 +1287,7 @@ def set_gemini_api_key():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error setting API key: {str(e)}'})
 
-@app.route('/test_gemini', methods=['GET', 'POST'])
+@main.route('/test_gemini', methods=['GET', 'POST'])
 def test_gemini():
     """Test route for Gemini API integration"""
     from gemini_api import generate
@@ -737,16 +1344,13 @@ def calculate_water_goal(user):
     elif user.age < 18:
         base_amount *= 1.1  # Slightly more for younger people
     
-    # Adjustments based on profession (simplified)
-    active_professions = ['athlete', 'construction', 'fitness', 'trainer', 'labor', 'worker']
-    sedentary_professions = ['office', 'desk', 'computer', 'programmer', 'developer']
-    
-    for term in active_professions:
+    # Adjustments based on profession (simplified; the same terms define cohorts)
+    for term in ACTIVE_PROFESSIONS:
         if term in user.profession.lower():
             base_amount *= 1.3  # More water for active professions
             break
     
-    for term in sedentary_professions:
+    for term in SEDENTARY_PROFESSIONS:
         if term in user.profession.lower():
             base_amount *= 0.9  # Less water for sedentary professions
             break
@@ -766,8 +1370,10 @@ def calculate_water_goal(user):
     else:
         daily_goal.amount = recommended_amount
     
+    bump_data_version(user.id)
     db.session.commit()
+    server_sessions.invalidate_user(user.id)
     return daily_goal
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""
+Intake archive for WaterBuddy
+This module moves daily totals older than a horizon out of water_intakes into compact columnar segment files
+
+Pages only read the last month or so from water_intakes, but the table grows by
+one row per user per day forever. `flask archive-intake` deletes rows older than
+ARCHIVE_HORIZON_DAYS and writes them to segment files, which are memory-mapped
+for reading. history() and daily_totals() read across the hot table and the
+archive, so streaks and badges still see the whole history.
+
+Segment layout (little-endian, every value 4 bytes wide):
+    header     magic, user count, row count, cutoff ordinal (32 bytes)
+    user_ids   int32[users], ascending
+    offsets    int32[users + 1], each user's first row; the last is the row count
+    dates      int32[rows], date.toordinal(), ascending within a user
+    amounts    int32[rows], milliliters
+
+The archive_segments table is the catalog of published segments. Readers follow
+a MANIFEST file in the archive directory instead, so no request queries the
+catalog; the manifest is rewritten after every catalog change, and
+IntakeArchive.recover() brings it back in line after an interrupted run.
+A (user, date) may appear in several segments, and in the hot table too (e.g.
+after a timezone change moves intake onto an archived day); its amounts are summed.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from database import db, ArchiveSegment, WaterIntake
+
+# numpy is optional (scans fall back to memoryviews over the same mappings) and slow
+# to import, so it is loaded by the first scan instead of when the app starts
+_numpy = None
+
+MAGIC = b'WBARCH01'
+HEADER = struct.Struct('<8sIIi12x')
+MANIFEST = 'MANIFEST'
+SEGMENT_SUFFIX = '.seg'
+
+# /insights, /api/dashboard and the cohort hit rates read the current month and
+# the last 30 days straight from water_intakes, so those must never be archived
+MIN_HORIZON_DAYS = 62
+
+ARCHIVE_SQL = text("""
+    DELETE FROM water_intakes
+    WHERE date < :cutoff AND user_id BETWEEN :first_user AND :last_user
+    RETURNING user_id, date, amount
+""")
+
+
+def load_numpy():
+    """The numpy module, or None if it is not installed"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def _int32_view(buffer, offset):
+    """Zero-copy int32 view of buffer from offset (a copy on big-endian machines)"""
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.frombuffer(buffer, dtype='<i4', offset=offset)
+    if sys.byteorder == 'little':
+        return memoryview(buffer)[offset:].cast('i')
+    values = array('i', bytes(buffer[offset:]))
+    values.byteswap()
+    return values
+
+
+class Segment:
+    """A memory-mapped segment file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, users, rows, cutoff = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an intake archive segment")
+        self.cutoff = date.fromordinal(cutoff)
+
+        words = _int32_view(self._map, HEADER.size)
+        self.user_ids = words[:users]
+        self.offsets = words[users:2 * users + 1]
+        self.dates = words[2 * users + 1:2 * users + 1 + rows]
+        self.amounts = words[2 * users + 1 + rows:2 * users + 1 + 2 * rows]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def columns(self, user_id):
+        """(dates, amounts) views for one user, or None if the segment has no rows for them"""
+        index = bisect_left(self.user_ids, user_id)
+        if index == len(self.user_ids) or self.user_ids[index] != user_id:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.dates[start:end], self.amounts[start:end]
+
+
+def write_segment(path, cutoff, rows):
+    """
+    Write a segment file.
+
+    Args:
+        path: Destination file
+        cutoff: Date every row is before
+        rows: (user_id, date ordinal, amount), sorted by user and date
+
+    Returns:
+        (number of users, number of rows)
+    """
+    user_ids, offsets, dates, amounts = array('i'), array('i'), array('i'), array('i')
+    for user_id, day, amount in rows:
+        if not user_ids or user_ids[-1] != user_id:
+            user_ids.append(user_id)
+            offsets.append(len(dates))
+        dates.append(day)
+        amounts.append(amount)
+    offsets.append(len(dates))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(user_ids), len(dates), cutoff.toordinal()))
+        for column in (user_ids, offsets, dates, amounts):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(user_ids), len(dates)
+
+
+class IntakeArchive:
+    """
+    Flask extension reading and writing the intake archive in ARCHIVE_DIR.
+
+    Segments are opened on first use and re-opened whenever the manifest
+    changes, e.g. after `flask archive-intake` ran in another process.
+    """
+
+    def __init__(self, app=None, directory=None, horizon_days=365, batch_users=1000):
+        self.directory = directory
+        self.horizon_days = horizon_days
+        self.batch_users = batch_users
+        self._segments = []
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get('ARCHIVE_DIR') or os.path.join(app.instance_path, 'archive')
+        self.horizon_days = app.config.get('ARCHIVE_HORIZON_DAYS', self.horizon_days)
+        self.batch_users = app.config.get('ARCHIVE_BATCH_USERS', self.batch_users)
+        if self.horizon_days < MIN_HORIZON_DAYS:
+            raise ValueError(f"ARCHIVE_HORIZON_DAYS must be at least {MIN_HORIZON_DAYS}")
+        self._segments = []
+        self._manifest_mtime = None
+        app.extensions['intake_archive'] = self
+
+    # Reading
+
+    def segments(self):
+        """The published segments, re-read if the manifest changed since the last call"""
+        manifest = os.path.join(self.directory, MANIFEST)
+        try:
+            mtime = os.stat(manifest).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._manifest_mtime:
+            return self._segments
+
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                names = []
+                if mtime is not None:
+                    with open(manifest) as f:
+                        names = json.load(f)
+                opened = {os.path.basename(segment.path): segment for segment in self._segments}
+                self._segments = [opened.get(name) or Segment(os.path.join(self.directory, name))
+                                  for name in names]
+                self._manifest_mtime = mtime
+            return self._segments
+
+    def history(self, user_id, start=None, end=None):
+        """
+        A user's archived daily totals.
+
+        Args:
+            user_id: The user
+            start: First date to include (default: the oldest)
+            end: Date to stop before (default: no limit)
+
+        Returns:
+            List of (date, amount), oldest first
+        """
+        first = start.toordinal() if start else 0
+        last = end.toordinal() if end else sys.maxsize
+        totals = {}
+        for segment in self.segments():
+            columns = segment.columns(user_id)
+            if columns is None:
+                continue
+            dates, amounts = columns
+            for i in range(bisect_left(dates, first), bisect_left(dates, last)):
+                day = int(dates[i])
+                totals[day] = totals.get(day, 0) + int(amounts[i])
+        return [(date.fromordinal(day), amount) for day, amount in sorted(totals.items())]
+
+    def daily_totals(self, user_id, start=None, end=None):
+        """Like history(), but across the hot table and the archive"""
+        query = WaterIntake.query.with_entities(WaterIntake.date, WaterIntake.amount).filter(
+            WaterIntake.user_id == user_id
+        )
+        if start:
+            query = query.filter(WaterIntake.date >= start)
+        if end:
+            query = query.filter(WaterIntake.date < end)
+
+        totals = dict(self.history(user_id, start, end))
+        for day, amount in query:
+            totals[day] = totals.get(day, 0) + amount
+        return sorted(totals.items())
+
+    def goal_streak(self, user_id, last_day, goal_amount):
+        """Consecutive archived days ending on last_day on which goal_amount was met"""
+        streak = 0
+        check_date = last_day
+        for day, amount in reversed(self.history(user_id, end=last_day + timedelta(days=1))):
+            if day != check_date or amount < goal_amount:
+                break
+            streak += 1
+            check_date -= timedelta(days=1)
+        return streak
+
+    def newest_cutoff(self):
+        """Every archived date is before this (None when the archive is empty)"""
+        return max((segment.cutoff for segment in self.segments()), default=None)
+
+    def scan(self):
+        """
+        Columns of every segment, for analytics over the full archive.
+
+        Yields:
+            (user_ids, offsets, dates, amounts) per segment: NumPy arrays over the
+            mapped files when NumPy is installed, memoryviews otherwise
+        """
+        for segment in self.segments():
+            yield segment.user_ids, segment.offsets, segment.dates, segment.amounts
+
+    def summary(self):
+        """Row count, distinct users, total milliliters and date range of the archive"""
+        rows = total = 0
+        users = set()
+        first = last = None
+        for user_ids, _, dates, amounts in self.scan():
+            if not len(dates):
+                continue
+            rows += len(dates)
+            users.update(user_ids.tolist())
+            numpy = load_numpy()
+            if numpy is not None:
+                total += int(amounts.sum(dtype=numpy.int64))
+                low, high = int(dates.min()), int(dates.max())
+            else:
+                total += sum(amounts)
+                low, high = min(dates), max(dates)
+            first = low if first is None else min(first, low)
+            last = high if last is None else max(last, high)
+        return {
+            'rows': rows,
+            'users': len(users),
+            'total_ml': total,
+            'first_date': date.fromordinal(first) if first else None,
+            'last_date': date.fromordinal(last) if last else None,
+        }
+
+    # Writing
+
+    def archive(self, cutoff=None):
+        """
+        Move hot rows dated before cutoff into new segments, one per batch of users.
+
+        Each batch is deleted and catalogued in one short transaction, so
+        writers are only blocked for the batch being moved.
+
+        Args:
+            cutoff: Default: ARCHIVE_HORIZON_DAYS before today
+
+        Returns:
+            The number of rows archived
+
+        Raises:
+            ValueError: if cutoff is less than MIN_HORIZON_DAYS before today
+        """
+        if cutoff is None:
+            cutoff = date.today() - timedelta(days=self.horizon_days)
+        if cutoff > date.today() - timedelta(days=MIN_HORIZON_DAYS):
+            raise ValueError(f"Cannot archive intake from the last {MIN_HORIZON_DAYS} days")
+        os.makedirs(self.directory, exist_ok=True)
+        self.recover()
+
+        user_ids = sorted(user_id for (user_id,) in db.session.query(WaterIntake.user_id).filter(
+            WaterIntake.date < cutoff
+        ).distinct())
+        db.session.commit()
+
+        moved = 0
+        for i in range(0, len(user_ids), self.batch_users):
+            batch = user_ids[i:i + self.batch_users]
+            params = {'cutoff': cutoff.isoformat(), 'first_user': batch[0], 'last_user': batch[-1]}
+            deleted = [row for shard_id in db.partition(batch) for row in db.execute_on(shard_id, ARCHIVE_SQL, params)]
+            if not deleted:
+                db.session.commit()
+                continue
+            rows = sorted(
+                (user_id, (day if isinstance(day, date) else date.fromisoformat(day)).toordinal(), amount)
+                for user_id, day, amount in deleted
+            )
+            name = f"intake-{cutoff:%Y%m%d}-{batch[0]}-{batch[-1]}-{datetime.now():%Y%m%d%H%M%S%f}{SEGMENT_SUFFIX}"
+            self._publish(name, cutoff, rows)
+            moved += len(rows)
+        return moved
+
+    def compact(self):
+        """
+        Merge all segments into one, summing any (user, date) found in several.
+
+        Returns:
+            The number of segments merged
+        """
+        self.recover()
+        segments = self.segments()
+        if len(segments) < 2:
+            return 0
+
+        user_ids = sorted(set().union(*(segment.user_ids.tolist() for segment in segments)))
+        rows = (
+            (user_id, day.toordinal(), amount)
+            for user_id in user_ids
+            for day, amount in self.history(user_id)
+        )
+        cutoff = max(segment.cutoff for segment in segments)
+        name = f"compact-{cutoff:%Y%m%d}-{datetime.now():%Y%m%d%H%M%S%f}{SEGMENT_SUFFIX}"
+        old = [os.path.basename(segment.path) for segment in segments]
+        ArchiveSegment.query.filter(ArchiveSegment.name.in_(old)).delete(synchronize_session=False)
+        self._publish(name, cutoff, rows)
+
+        for old_name in old:
+            os.remove(os.path.join(self.directory, old_name))
+        return len(old)
+
+    def _publish(self, name, cutoff, rows):
+        # The segment is written before the transaction commits and only becomes
+        # visible to readers through the manifest, after the commit
+        path = os.path.join(self.directory, name)
+        try:
+            users, count = write_segment(path, cutoff, rows)
+            db.session.add(ArchiveSegment(name=name, users=users, rows=count, cutoff=cutoff))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        self._write_manifest()
+
+    def _write_manifest(self):
+        names = [name for (name,) in db.session.query(ArchiveSegment.name).order_by(ArchiveSegment.id)]
+        manifest = os.path.join(self.directory, MANIFEST)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump(names, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + '.tmp', manifest)
+
+    def recover(self):
+        """
+        Finish or undo a run that was interrupted: rewrite the manifest from the
+        catalog and delete segment files that never made it into the catalog.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        self._write_manifest()
+        catalogued = {name for (name,) in db.session.query(ArchiveSegment.name)}
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX) and name not in catalogued:
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,62 @@
+"""
+Static asset serving for WaterBuddy
+This module resolves fingerprinted files built by build_assets.py and serves them with long-lived caching
+"""
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for
+
+# Fingerprinted files never change, so browsers and proxies may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class Assets:
+    """
+    Flask extension for the build_assets.py output in static/dist.
+
+    Templates call asset_url('js/chatbot.js'), which returns the fingerprinted
+    URL from manifest.json via url_for('static'). Without a build, the plain
+    static URL is returned. Files under /static/dist are served with immutable
+    cache headers, using the precompressed .br or .gz file when the client accepts it.
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.dist_folder = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist_folder = os.path.join(app.static_folder, 'dist')
+        manifest_path = os.path.join(self.dist_folder, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            print("No asset manifest found, run `python build_assets.py` to build static/dist")
+
+        app.jinja_env.globals['asset_url'] = self.url
+        app.add_url_rule(app.static_url_path + '/dist/<path:filename>',
+                         endpoint='dist_asset', view_func=self.send_dist)
+
+    def url(self, name):
+        """URL of the built (fingerprinted) version of an asset"""
+        return url_for('static', filename=self.manifest.get(name, name))
+
+    def send_dist(self, filename):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in accepted and os.path.isfile(os.path.join(self.dist_folder, filename + suffix)):
+                response = send_from_directory(self.dist_folder, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.dist_folder, filename, mimetype=mimetype)
+
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
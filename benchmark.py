@@ -0,0 +1,820 @@
+"""
+Benchmark harness for WaterBuddy
+Runs the app against a throwaway SQLite database and reports timings for hot paths
+
+Usage:
+    python benchmark.py batch [--sizes 1,10,100,1000,5000] [--repeat 5]
+    python benchmark.py startup [--runs 5]
+    python benchmark.py render [--repeat 50]
+    python benchmark.py chat [--live]
+    python benchmark.py conversation [--turns 200] [--budget 800]
+    python benchmark.py load [--duration 20] [--chat-rate 100] [--write-rate 50]
+    python benchmark.py cohorts [--users 20000] [--days 60]
+    python benchmark.py archive [--users 2000] [--days 730] [--horizon 365]
+    python benchmark.py profile [--requests 300] [--interval-ms 10]
+    python benchmark.py reminders [--users 1000] [--days 7]
+    python benchmark.py shards [--counts 1,2,4] [--workers 8] [--duration 10]
+    python benchmark.py sessions [--requests 200]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Cold start budgets, checked by `benchmark.py startup`. Flask and SQLAlchemy account
+# for most of the import time; the Gemini SDK alone used to add roughly 900 ms.
+IMPORT_BUDGET_MS = 600
+FIRST_REQUEST_BUDGET_MS = 800
+
+
+def load_app(db_path=None, config=None):
+    """
+    Build an app pointed at a temporary database so water_tracker.db is never touched.
+
+    Returns:
+        (app module, app instance), with all tables created
+    """
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='waterbuddy-bench-'), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('TEMPLATE_CACHE_DIR', os.path.join(os.path.dirname(db_path), 'jinja_cache'))
+    os.environ['SESSION_DB'] = os.path.join(os.path.dirname(db_path), 'sessions.db')
+    os.environ['COHORT_SNAPSHOT'] = os.path.join(os.path.dirname(db_path), 'cohorts.json')
+    import app as app_module
+    app = app_module.create_app(config)
+    with app.app_context():
+        app_module.db.create_all()
+    return app_module, app
+
+
+def create_user(app_module, app, name='Bench User'):
+    """Create a user with a daily goal and return its id"""
+    with app.app_context():
+        user = app_module.User(name=name, age=30, weight=70.0, height=175.0, profession='developer')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        app_module.calculate_water_goal(user)
+        return user.id
+
+
+def logged_in_client(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    return client
+
+
+def bench_batch(args):
+    """Events per second for /api/intake/batch at increasing batch sizes"""
+    # One client sends far more than a person could, so per-user rate limits are off
+    app_module, app = load_app(config={'ADMISSION_ENABLED': False})
+    user_id = create_user(app_module, app)
+    client = logged_in_client(app, user_id)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print(f"{'batch size':>10} {'median ms':>10} {'us/event':>10} {'events/s':>12}")
+    for size in sizes:
+        timings = []
+        for _ in range(args.repeat):
+            now = datetime.now().isoformat()
+            events = [
+                {'event_id': uuid.uuid4().hex, 'amount': 20, 'timestamp': now}
+                for _ in range(size)
+            ]
+            start = time.perf_counter()
+            response = client.post('/api/intake/batch', json={'events': events})
+            timings.append(time.perf_counter() - start)
+            assert response.get_json()['accepted'] == size, response.get_json()
+
+        median = statistics.median(timings)
+        print(f"{size:>10} {median * 1000:>10.2f} {median / size * 1e6:>10.1f} {size / median:>12.0f}")
+
+    # For comparison: the same number of sips sent one by one to /add_water
+    size = min(sizes[-1], 500)
+    start = time.perf_counter()
+    for _ in range(size):
+        client.post('/add_water', json={'amount': 20})
+    elapsed = time.perf_counter() - start
+    print(f"\n/add_water x{size}: {elapsed * 1000:.2f} ms total, {size / elapsed:.0f} events/s")
+
+
+# Run in a fresh interpreter: import the app, build it, and serve one logged-in request
+FIRST_REQUEST_SCRIPT = """
+import time
+start = time.perf_counter()
+import app as app_module
+imported = time.perf_counter()
+app = app_module.create_app()
+client = app.test_client()
+with client.session_transaction() as sess:
+    sess['user_id'] = 1
+response = client.post('/add_water', json={'amount': 250})
+assert response.get_json()['success'], response.get_json()
+done = time.perf_counter()
+print((imported - start) * 1000, (done - start) * 1000)
+"""
+
+
+def bench_startup(args):
+    """Import time and time-to-first-request in fresh interpreters, against the budgets"""
+    app_module, app = load_app()
+    create_user(app_module, app)
+    env = dict(os.environ)
+
+    # Per-module import cost of `import app`
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            capture_output=True, text=True, env=env, check=True, cwd=HERE)
+    modules = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match:
+            modules.append((int(match.group(2)), int(match.group(1)), len(match.group(3)), match.group(4)))
+    # Modules imported directly by app.py are indented one level below it
+    direct = [module for module in modules if module[2] == 3]
+    print("Slowest imports made by app.py (cumulative ms):")
+    for cumulative, _, _, name in sorted(direct, reverse=True)[:10]:
+        print(f"  {cumulative / 1000:>8.1f}  {name}")
+    heavy = [name for _, _, _, name in modules if name.startswith(('google.generativeai', 'grpc'))]
+    print(f"Gemini SDK modules imported: {len(heavy)}")
+
+    imports, firsts = [], []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', FIRST_REQUEST_SCRIPT],
+                                capture_output=True, text=True, env=env, check=True, cwd=HERE).stdout
+        import_ms, first_ms = map(float, output.split()[-2:])
+        imports.append(import_ms)
+        firsts.append(first_ms)
+
+    import_ms = statistics.median(imports)
+    first_ms = statistics.median(firsts)
+    print(f"\nimport app:          {import_ms:>7.1f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    print(f"time to 1st request: {first_ms:>7.1f} ms (budget {FIRST_REQUEST_BUDGET_MS} ms)")
+
+    if import_ms > IMPORT_BUDGET_MS or first_ms > FIRST_REQUEST_BUDGET_MS:
+        print("Over budget")
+        return 1
+    return 0
+
+
+def bench_render(args):
+    """Template compile cost and per-route render time for the HTML pages"""
+    app_module, app = load_app()
+    user_id = create_user(app_module, app)
+    client = logged_in_client(app, user_id)
+    client.post('/add_water', json={'amount': 500})
+
+    # Compiling from source vs loading from the bytecode cache (filled as by `flask precompile-templates`)
+    env = app.jinja_env
+    for name in env.list_templates(filter_func=lambda name: name.endswith('.html')):
+        env.get_template(name)
+    print(f"{'template':<16} {'compile ms':>10} {'cached ms':>10}")
+    for name in ('dashboard.html', 'insights.html', 'settings.html'):
+        timings = {}
+        for label, bytecode_cache in (('compile', None), ('cached', env.bytecode_cache)):
+            env.bytecode_cache, saved = bytecode_cache, env.bytecode_cache
+            env.cache.clear()
+            start = time.perf_counter()
+            env.get_template(name)
+            timings[label] = time.perf_counter() - start
+            env.bytecode_cache = saved
+        print(f"{name:<16} {timings['compile'] * 1000:>10.2f} {timings['cached'] * 1000:>10.2f}")
+
+    # Time spent inside render_template, separately from the whole request
+    render_timings = []
+    original_render = app_module.render_template
+
+    def timed_render(*render_args, **render_kwargs):
+        start = time.perf_counter()
+        try:
+            return original_render(*render_args, **render_kwargs)
+        finally:
+            render_timings.append(time.perf_counter() - start)
+
+    app_module.render_template = timed_render
+    env.cache.clear()
+    env.fragment_cache.clear()
+    app_module._shell_cache.clear()
+    try:
+        print(f"\n{'route':<12} {'first ms':>9} {'request ms':>11} {'render ms':>10}")
+        for route in ('/dashboard', '/insights', '/settings'):
+            start = time.perf_counter()
+            client.get(route)
+            first = time.perf_counter() - start
+
+            requests, renders = [], []
+            for _ in range(args.repeat):
+                del render_timings[:]
+                start = time.perf_counter()
+                response = client.get(route)
+                requests.append(time.perf_counter() - start)
+                renders.append(sum(render_timings))
+                assert response.status_code == 200, (route, response.status_code)
+            print(f"{route:<12} {first * 1000:>9.2f} {statistics.median(requests) * 1000:>11.2f} "
+                  f"{statistics.median(renders) * 1000:>10.2f}")
+    finally:
+        app_module.render_template = original_render
+    print(f"\nfragments cached: {len(env.fragment_cache)}")
+
+
+# Chat messages that are not in the intent training set, with the path each should take
+CHAT_SAMPLE = [
+    ('progress', "how much water have i had so far today?"),
+    ('progress', "am i close to my goal"),
+    ('progress', "what's my progress looking like"),
+    ('progress', "how many more ml do i need"),
+    ('progress', "did i hit my target yet?"),
+    ('progress', "how much is left"),
+    ('tip', "got any tips for drinking more?"),
+    ('tip', "how can i remember to drink water at work"),
+    ('tip', "give me some advice"),
+    ('tip', "i always forget to drink, help"),
+    ('fact', "tell me a fun fact about water"),
+    ('fact', "why is hydration so important?"),
+    ('fact', "what are the benefits of drinking water"),
+    ('fact', "what does dehydration do to you"),
+    ('log', "add 300ml"),
+    ('log', "i just drank a glass of water"),
+    ('log', "add 2 cups"),
+    ('log', "500"),
+    ('log', "had a bottle"),
+    ('gemini', "hi!"),
+    ('gemini', "does green tea count towards my goal?"),
+    ('gemini', "is it ok to drink water right after running"),
+    ('gemini', "i'm breastfeeding, do i need more water"),
+    ('gemini', "what's the healthiest kind of water to drink"),
+    ('gemini', "can you tell me how the goal is worked out"),
+    ('gemini', "i get headaches in the afternoon, any idea why"),
+    ('gemini', "thanks buddy"),
+    ('gemini', "should i drink electrolytes on a long hike"),
+]
+
+
+def bench_chat(args):
+    """Share of chat messages answered by the local intent classifier, and latency per path"""
+    import gemini_helper
+    from intents import LOCAL_INTENTS, classify, get_classifier
+
+    start = time.perf_counter()
+    get_classifier()
+    print(f"intent model load: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    user_data = {'name': 'Bench User'}
+    water_data = {'current_amount': 1250, 'goal': 2500, 'percentage': 50.0, 'remaining': 1250, 'water_added': True}
+    misrouted = []
+    for expected, message in CHAT_SAMPLE:
+        intent, _ = classify(message)
+        actual = intent if intent in LOCAL_INTENTS else 'gemini'
+        if actual != expected:
+            misrouted.append((expected, actual, message))
+
+        if args.live:
+            gemini_helper.generate_response(message, user_data, water_data)
+        elif gemini_helper.local_response(message, user_data, water_data) is None:
+            # Only count the remote path; without --live nothing is sent to Gemini
+            gemini_helper.record_route('gemini', 0.0)
+
+    stats = gemini_helper.get_route_stats()
+    print(f"\n{'path':<10} {'replies':>8} {'mean ms':>9}")
+    for path, path_stats in sorted(stats['paths'].items()):
+        mean = f"{path_stats['mean_ms']:>9.3f}" if path != 'gemini' or args.live else f"{'-':>9}"
+        print(f"{path:<10} {path_stats['count']:>8} {mean}")
+    print(f"\nserved locally: {stats['local_fraction']:.0%} of {stats['total']} messages")
+
+    print(f"routed as expected: {len(CHAT_SAMPLE) - len(misrouted)}/{len(CHAT_SAMPLE)}")
+    for expected, actual, message in misrouted:
+        print(f"  expected {expected:<8} got {actual:<8} {message}")
+    if not args.live:
+        print("(gemini latency not measured; pass --live with GEMINI_API_KEY set)")
+
+
+def bench_conversation(args):
+    """Prompt size and assembly time as one user's conversation grows"""
+    from conversation import ConversationMemory, estimate_tokens
+    from gemini_helper import gemini_prompt
+
+    memory = ConversationMemory()
+    user_data = {'name': 'Bench User'}
+    water_data = {'current_amount': 1250, 'goal': 2500, 'percentage': 50.0, 'remaining': 1250}
+    messages = [message for expected, message in CHAT_SAMPLE if expected == 'gemini']
+    reply = "Great question! Staying hydrated helps your energy and focus, so keep sipping through the day."
+    checkpoints = {1, 5, 10, 25, 50, 100, 200, 500, args.turns}
+    unbounded_tokens = 0
+
+    print(f"{'turn':>6} {'prompt tokens':>14} {'build us':>9} {'unbounded tokens':>17}")
+    for turn in range(1, args.turns + 1):
+        message = messages[turn % len(messages)]
+        start = time.perf_counter()
+        history = memory.history(1)
+        _, tokens = gemini_prompt(message, user_data, water_data, history, args.budget)
+        elapsed = time.perf_counter() - start
+        # What the prompt would cost if every earlier turn were sent verbatim
+        unbounded_tokens += estimate_tokens(message) + estimate_tokens(reply) + 2
+        memory.add_exchange(1, message, reply)
+        if turn in checkpoints:
+            _, base_tokens = gemini_prompt(message, user_data, water_data, None, 10 ** 9)
+            print(f"{turn:>6} {tokens:>14} {elapsed * 1e6:>9.1f} {base_tokens + unbounded_tokens:>17}")
+    print(f"\nbudget {args.budget} tokens, {memory.max_turns} turns kept verbatim per user")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_load(args):
+    """/add_water latency while /chatbot_message is saturated, with and without admission control"""
+    import gemini_helper
+    from concurrent.futures import ThreadPoolExecutor
+
+    app_module, app = load_app()
+    writers = [logged_in_client(app, create_user(app_module, app, f'Writer {i}')) for i in range(args.users)]
+    chatters = [logged_in_client(app, create_user(app_module, app, f'Chatter {i}')) for i in range(args.users)]
+    messages = [message for expected, message in CHAT_SAMPLE if expected == 'gemini']
+
+    # Stand-in for the Gemini API: a slow network call
+    def slow_generate(prompt, enhance=True):
+        time.sleep(args.gemini_latency)
+        return "Stay hydrated!"
+    gemini_helper.generate = slow_generate
+
+    def timed(client, path, payload):
+        start = time.perf_counter()
+        response = client.post(path, json=payload)
+        body = response.get_json(silent=True) or {}
+        if response.status_code == 429:
+            outcome = 'rejected'
+        elif body.get('shed'):
+            outcome = 'shed'
+        elif body.get('pending'):
+            outcome = 'queued'
+        else:
+            outcome = 'ok' if body.get('success') else 'error'
+        return time.perf_counter() - start, outcome
+
+    def run_phase(name, chat_rate):
+        # A fixed pool stands in for the WSGI server's worker threads; latency
+        # includes any wait for a free thread
+        write_futures, chat_futures = [], []
+        with ThreadPoolExecutor(max_workers=args.server_threads) as server:
+            start = time.perf_counter()
+            next_write = next_chat = start
+            sent = 0
+            while time.perf_counter() - start < args.duration:
+                now = time.perf_counter()
+                if now >= next_write:
+                    submitted = time.perf_counter()
+                    client = writers[sent % len(writers)]
+                    future = server.submit(timed, client, '/add_water', {'amount': 50})
+                    write_futures.append((submitted, future))
+                    next_write += 1 / args.write_rate
+                if chat_rate and now >= next_chat:
+                    client = chatters[sent % len(chatters)]
+                    chat_futures.append(server.submit(timed, client, '/chatbot_message',
+                                                      {'message': messages[sent % len(messages)]}))
+                    next_chat += 1 / chat_rate
+                sent += 1
+                time.sleep(0.0005)
+
+        latencies = [future.result()[0] for _, future in write_futures]
+        write_outcomes = [future.result()[1] for _, future in write_futures]
+        chat_outcomes = [future.result()[1] for future in chat_futures]
+        print(f"{name:<22} {statistics.median(latencies) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f} "
+              f"{write_outcomes.count('ok'):>6}/{len(write_outcomes):<6} "
+              + ' '.join(f"{outcome}={chat_outcomes.count(outcome)}"
+                         for outcome in ('queued', 'shed', 'rejected', 'error') if chat_outcomes.count(outcome)))
+
+        # Let queued Gemini calls finish so they do not spill into the next phase
+        deadline = time.perf_counter() + 120
+        while app_module.task_queue.depth and time.perf_counter() < deadline:
+            time.sleep(0.1)
+
+    print(f"{args.server_threads} server threads, Gemini latency {args.gemini_latency * 1000:.0f} ms, "
+          f"/add_water at {args.write_rate}/s, chat at {args.chat_rate}/s for {args.duration}s\n")
+    print(f"{'phase':<22} {'p50 ms':>8} {'p99 ms':>8} {'writes ok':>13} chat outcomes")
+    run_phase('writes only', 0)
+    run_phase('chat saturated', args.chat_rate)
+    app_module.admission.enabled = False
+    run_phase('no admission control', args.chat_rate)
+    app_module.admission.enabled = True
+    print(f"\nadmission stats: {app_module.admission.stats()}")
+
+
+def seed_history(app_module, app, users, days, seed=1):
+    """Bulk-insert users with goals and random daily intake for the last `days` days"""
+    import random
+    from datetime import date, timedelta
+    rng = random.Random(seed)
+    professions = ['developer', 'teacher', 'construction worker', 'nurse', 'office manager', 'athlete']
+    today = date.today()
+    with app.app_context():
+        db = app_module.db
+        db.session.execute(app_module.User.__table__.insert(), [
+            {'name': f'User {i}', 'age': rng.randint(14, 80), 'weight': 70.0, 'height': 175.0,
+             'profession': rng.choice(professions), 'data_version': 0}
+            for i in range(users)
+        ])
+        user_ids = [user_id for (user_id,) in db.session.query(app_module.User.id)]
+        db.session.execute(app_module.DailyGoal.__table__.insert(),
+                           [{'user_id': user_id, 'amount': 2000} for user_id in user_ids])
+        for user_id in user_ids:
+            # Each user has their own habit: how likely they are to meet the goal on a given day
+            habit = rng.random()
+            db.session.execute(app_module.WaterIntake.__table__.insert(), [
+                {'user_id': user_id, 'date': today - timedelta(days=day),
+                 'amount': 2200 if rng.random() < habit else 1200}
+                for day in range(days)
+            ])
+        db.session.commit()
+        return user_ids
+
+
+def bench_cohorts(args):
+    """Cohort refresh cost and per-request lookup cost, compared with ranking peers on demand"""
+    import random
+    app_module, app = load_app(config={'COHORT_REFRESH_SECONDS': 0})
+    start = time.perf_counter()
+    user_ids = seed_history(app_module, app, args.users, args.days)
+    print(f"seeded {len(user_ids)} users x {args.days} days in {time.perf_counter() - start:.1f}s")
+    stats = app_module.cohort_stats
+    rng = random.Random(2)
+
+    with app.app_context():
+        start = time.perf_counter()
+        stats.refresh()
+        print(f"refresh (window-function query + rebuild): {(time.perf_counter() - start) * 1000:.0f} ms")
+        print(f"cohorts: {len(stats.sizes())}, largest {max(stats.sizes().values())} users")
+
+        sample = rng.sample(user_ids, min(1000, len(user_ids)))
+        start = time.perf_counter()
+        for user_id in sample:
+            stats.lookup(user_id)
+        print(f"lookup: {(time.perf_counter() - start) / len(sample) * 1e6:.1f} us per user")
+
+        users = {user.id: user for user in app_module.User.query.filter(app_module.User.id.in_(sample))}
+        start = time.perf_counter()
+        for user_id in sample:
+            stats.observe_streak(users[user_id], rng.randint(0, args.days))
+        print(f"incremental streak update: {(time.perf_counter() - start) / len(sample) * 1e6:.1f} us per user")
+
+        # Ranking one user on demand: recompute every cohort peer's streak from their history
+        from cohorts import cohort_of
+        from datetime import date
+        user = users[sample[0]]
+        cohort = cohort_of(user.age, user.profession)
+        peers = [peer.id for peer in app_module.User.query if cohort_of(peer.age, peer.profession) == cohort]
+        start = time.perf_counter()
+        for peer_id in peers:
+            app_module.calculate_streak(peer_id, 2000, date.today(), 0)
+        print(f"naive ranking of one user ({len(peers)} peers): {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def bench_archive(args):
+    """Hot table size and history read cost before and after archiving, and full-archive scan speed"""
+    import random
+    from datetime import date, timedelta
+    import archive
+    app_module, app = load_app(config={'COHORT_REFRESH_SECONDS': 0, 'ARCHIVE_HORIZON_DAYS': args.horizon})
+    db_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    app.config['ARCHIVE_DIR'] = os.path.join(os.path.dirname(db_path), 'archive')
+    app_module.intake_archive.init_app(app)
+    intake_archive = app_module.intake_archive
+
+    start = time.perf_counter()
+    user_ids = seed_history(app_module, app, args.users, args.days)
+    print(f"seeded {len(user_ids)} users x {args.days} days in {time.perf_counter() - start:.1f}s")
+    rng = random.Random(3)
+    sample = rng.sample(user_ids, min(200, len(user_ids)))
+    today = date.today()
+
+    def measure(label):
+        with app.app_context():
+            hot_rows = app_module.WaterIntake.query.count()
+            start = time.perf_counter()
+            streaks = [app_module.calculate_streak(user_id, 2000, today, 0) for user_id in sample]
+            streak_us = (time.perf_counter() - start) / len(sample) * 1e6
+            start = time.perf_counter()
+            totals = [sum(amount for _, amount in intake_archive.daily_totals(user_id)) for user_id in sample]
+            history_ms = (time.perf_counter() - start) / len(sample) * 1000
+        print(f"{label}: {hot_rows} hot rows, {os.path.getsize(db_path) / 1e6:.1f} MB database, "
+              f"streak {streak_us:.0f} us, full history {history_ms:.2f} ms per user")
+        return streaks, totals
+
+    before = measure('before archiving')
+    with app.app_context():
+        start = time.perf_counter()
+        moved = intake_archive.archive(today - timedelta(days=args.horizon))
+        print(f"archived {moved} rows in {time.perf_counter() - start:.2f}s")
+        app_module.db.session.execute(app_module.db.text('VACUUM'))
+    after = measure('after archiving')
+    print(f"streaks and totals unchanged: {before == after}")
+
+    size = sum(os.path.getsize(segment.path) for segment in intake_archive.segments())
+    start = time.perf_counter()
+    summary = intake_archive.summary()
+    elapsed = time.perf_counter() - start
+    engine = 'NumPy' if archive.load_numpy() is not None else 'memoryview (NumPy not installed)'
+    print(f"archive: {len(intake_archive.segments())} segments, {size / 1e6:.1f} MB for {summary['rows']} rows")
+    print(f"full scan with {engine}: {elapsed * 1000:.1f} ms ({size / elapsed / 1e6:.0f} MB/s)")
+
+
+def bench_profile(args):
+    """Request latency with the sampling profiler off and on, and where the sampled time went"""
+    app_module, app = load_app(config={'COHORT_REFRESH_SECONDS': 0, 'ADMISSION_ENABLED': False,
+                                       'PROFILER_TOKEN': 'bench'})
+    seed_history(app_module, app, 50, 120)
+    with app.app_context():
+        user_id = app_module.db.session.query(app_module.User.id).first()[0]
+    client = logged_in_client(app, user_id)
+    headers = {'X-Profiler-Token': 'bench'}
+    routes = ['/insights', '/api/dashboard']
+
+    def run_requests():
+        timings = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            client.get(routes[i % len(routes)], headers={'If-None-Match': ''})
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    run_requests()  # warm up templates and caches
+    baseline = run_requests()
+    print(f"profiler off: {baseline:.2f} ms per request")
+
+    client.post('/admin/profiler/start', headers=headers,
+                json={'seconds': 300, 'interval_ms': args.interval_ms})
+    profiled = run_requests()
+    summary = client.post('/admin/profiler/stop', headers=headers).get_json()
+    print(f"profiler on ({args.interval_ms} ms interval): {profiled:.2f} ms per request "
+          f"({(profiled / baseline - 1) * 100:+.1f}%), sampler CPU {summary['overhead'] * 100:.2f}% of wall time, "
+          f"{summary['samples']} samples")
+    for root, entry in sorted(summary['endpoints'].items()):
+        categories = ', '.join(f"{category} {count}" for category, count in sorted(entry['categories'].items()))
+        print(f"  {root}: {entry['samples']} samples (~{entry['estimated_ms']} ms): {categories}")
+
+    stacks = client.get('/admin/profiler/stacks', headers=headers).get_data(as_text=True).splitlines()
+    print(f"{len(stacks)} distinct stacks; hottest:")
+    for line in stacks[:3]:
+        frames, count = line.rsplit(' ', 1)
+        frames = frames.split(';')
+        print(f"  {count:>5}  {';'.join(frames[:3])};...;{frames[-1]}")
+
+
+def bench_reminders(args):
+    """Reminders sent and goals met with a fixed interval vs pacing, and the cost of planning every user"""
+    import random
+    from datetime import date, timedelta
+    from reminders import pace, DAY_START, DAY_END
+
+    rng = random.Random(3)
+    goal, glass = 2000, 250
+    # Simulated users drink a glass now and then on their own (glasses per waking hour)
+    # and drink one in response to a reminder with some probability
+    users = [(rng.uniform(0.15, 0.6), rng.uniform(0.3, 0.8)) for _ in range(args.users)]
+
+    def simulate(policy):
+        reminders = goals_met = 0
+        for own_rate, response in users:
+            for day in range(args.days):
+                morning = datetime.combine(date(2024, 1, 1) + timedelta(days=day), datetime.min.time())
+                amount, last, next_check = 0, morning, morning
+                for minute in range(DAY_START * 60, DAY_END * 60):
+                    now = morning + timedelta(minutes=minute)
+                    if rng.random() < own_rate / 60:
+                        amount += glass
+                    if now < next_check:
+                        continue
+                    if policy == 'fixed':
+                        remind = now - last >= timedelta(minutes=90)
+                        next_check = now + timedelta(minutes=1)
+                    else:
+                        result = pace(goal, amount, now, last, 90)
+                        remind, next_check = result.remind, result.next_check
+                    if remind:
+                        reminders += 1
+                        last = now
+                        if rng.random() < response:
+                            amount += glass
+                goals_met += amount >= goal
+        days = len(users) * args.days
+        print(f"{policy:>6}: {reminders / days:.1f} reminders per user-day, goal met on {100 * goals_met / days:.1f}% of days")
+
+    print(f"{len(users)} simulated users x {args.days} days, goal {goal}ml")
+    simulate('fixed')
+    simulate('paced')
+
+    app_module, app = load_app(config={'COHORT_REFRESH_SECONDS': 0, 'REMINDER_PLAN_SECONDS': 0})
+    user_ids = seed_history(app_module, app, args.users, 1)
+    with app.app_context():
+        db = app_module.db
+        db.session.execute(app_module.WaterReminder.__table__.insert(), [
+            {'user_id': user_id, 'reminder_interval': 90, 'is_enabled': True,
+             'last_reminder_time': datetime.now() - timedelta(minutes=rng.randint(0, 240))}
+            for user_id in user_ids
+        ])
+        db.session.commit()
+        for label in ('first plan', 'replan'):
+            start = time.perf_counter()
+            planned, updated = app_module.reminder_planner.plan_all()
+            print(f"plan_all ({label}): {planned} users, {updated} rows written in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+# The two writes /add_water makes once today's row exists, issued straight to the user's shard
+SHARD_WRITE_SQL = [
+    "UPDATE users SET data_version = data_version + 1 WHERE id = :user_id",
+    "UPDATE water_intakes SET amount = amount + 20 WHERE user_id = :user_id AND date = :date",
+]
+
+
+def _shard_writer(app_module, config, user_ids, duration, direct, ready, results):
+    """One writer process: /add_water (or its SQL alone) for random users for `duration` seconds"""
+    import random
+    from datetime import date
+    from sqlalchemy import text
+    app = app_module.create_app(config)
+    clients = {user_id: logged_in_client(app, user_id) for user_id in user_ids}
+    statements = [text(sql) for sql in SHARD_WRITE_SQL]
+    writes = errors = 0
+    with app.app_context():
+        engines = app_module.db.shard_engines()
+        ready.wait()  # start together once every process has built its app
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            user_id = random.choice(user_ids)
+            try:
+                if direct:
+                    with engines[app_module.db.shard_of(user_id)].begin() as connection:
+                        for statement in statements:
+                            connection.execute(statement, {'user_id': user_id, 'date': date.today()})
+                    writes += 1
+                elif clients[user_id].post('/add_water', json={'amount': 20}).get_json()['success']:
+                    writes += 1
+                else:
+                    errors += 1
+            except Exception:
+                errors += 1  # "database is locked" after the busy timeout
+    results.put((writes, errors))
+
+
+def bench_shards(args):
+    """Concurrent write throughput from several processes as the shard count grows"""
+    import multiprocessing
+
+    context = multiprocessing.get_context('fork')
+    print(f"{args.workers} writer processes, {args.users} users, {os.cpu_count()} CPUs")
+    print(f"{'shards':>6} {'sql writes/s':>13} {'speedup':>8} {'/add_water/s':>13} {'speedup':>8} {'errors':>7}")
+    baseline = {}
+    for count in [int(count) for count in args.counts.split(',')]:
+        directory = tempfile.mkdtemp(prefix=f'waterbuddy-shards{count}-')
+        config = {'COHORT_REFRESH_SECONDS': 0, 'REMINDER_PLAN_SECONDS': 0, 'ADMISSION_ENABLED': False,
+                  'SHARD_COUNT': count, 'SHARD_DIR': directory}
+        app_module, app = load_app(os.path.join(directory, 'main.db'), config)
+        user_ids = [create_user(app_module, app, f'Writer {i}') for i in range(args.users)]
+        for user_id in user_ids:
+            logged_in_client(app, user_id).post('/add_water', json={'amount': 20})
+        with app.app_context():
+            app_module.db.session.remove()
+            for engine in app_module.db.shard_engines().values():
+                engine.dispose()  # children open their own connections
+
+        row = {}
+        for direct in (True, False):
+            results = context.Queue()
+            ready = context.Barrier(args.workers)
+            workers = [
+                context.Process(target=_shard_writer,
+                                args=(app_module, config, user_ids, args.duration, direct, ready, results))
+                for _ in range(args.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            totals = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            row[direct] = (sum(w for w, _ in totals) / args.duration, sum(e for _, e in totals))
+            baseline.setdefault(direct, row[direct][0])
+
+        (sql_rate, sql_errors), (route_rate, route_errors) = row[True], row[False]
+        print(f"{count:>6} {sql_rate:>13.0f} {sql_rate / baseline[True]:>7.2f}x "
+              f"{route_rate:>13.0f} {route_rate / baseline[False]:>7.2f}x {sql_errors + route_errors:>7}")
+
+
+def bench_sessions(args):
+    """SQL queries and latency per authenticated route, and cookie size, for each session backend"""
+    from sqlalchemy import event
+
+    routes = [
+        ('POST', '/add_water', {'amount': 250}),
+        ('GET', '/check_water_reminder', None),
+        ('GET', '/api/dashboard', None),
+        ('GET', '/insights', None),
+        ('POST', '/chatbot_message', {'message': 'how am i doing'}),
+    ]
+    print(f"{'backend':>8} {'cookie':>7}  " + ''.join(f"{path:>24}" for _, path, _ in routes))
+    for backend in ('cookie', 'memory', 'sqlite'):
+        app_module, app = load_app(config={'COHORT_REFRESH_SECONDS': 0, 'REMINDER_PLAN_SECONDS': 0,
+                                           'ADMISSION_ENABLED': False, 'SESSION_BACKEND': backend})
+        client = app.test_client()
+        response = client.post('/profile', data={'name': 'Bench User', 'age': '30', 'weight': '70',
+                                                 'height': '175', 'profession': 'developer'})
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        # Let the invalidation after the new user's goal was set expire, as it would between page loads
+        time.sleep(3)
+
+        queries = [0]
+        with app.app_context():
+            event.listen(app_module.db.get_engine(app), 'before_cursor_execute',
+                         lambda *_: queries.__setitem__(0, queries[0] + 1))
+        cells = []
+        for method, path, body in routes:
+            client.open(path, method=method, json=body)  # warm up
+            queries[0] = 0
+            timings = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                client.open(path, method=method, json=body, headers={'If-None-Match': ''})
+                timings.append(time.perf_counter() - start)
+            cells.append(f"{queries[0] / args.requests:.1f}q {statistics.median(timings) * 1000:.2f}ms")
+        print(f"{backend:>8} {len(cookie):>6}B  " + ''.join(f"{cell:>24}" for cell in cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WaterBuddy benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch = subparsers.add_parser('batch', help='batch sip ingestion throughput')
+    batch.add_argument('--sizes', default='1,10,100,1000,5000')
+    batch.add_argument('--repeat', type=int, default=5)
+    batch.set_defaults(func=bench_batch)
+
+    startup = subparsers.add_parser('startup', help='import time and time to first request')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    render = subparsers.add_parser('render', help='template compile and per-route render time')
+    render.add_argument('--repeat', type=int, default=50)
+    render.set_defaults(func=bench_render)
+
+    chat = subparsers.add_parser('chat', help='chat replies served locally vs by Gemini')
+    chat.add_argument('--live', action='store_true', help='send open-ended messages to Gemini')
+    chat.set_defaults(func=bench_chat)
+
+    conversation = subparsers.add_parser('conversation', help='prompt size as a conversation grows')
+    conversation.add_argument('--turns', type=int, default=200)
+    conversation.add_argument('--budget', type=int, default=800)
+    conversation.set_defaults(func=bench_conversation)
+
+    load = subparsers.add_parser('load', help='/add_water latency while the chatbot is saturated')
+    load.add_argument('--duration', type=float, default=20)
+    load.add_argument('--chat-rate', type=float, default=100)
+    load.add_argument('--write-rate', type=float, default=50)
+    load.add_argument('--users', type=int, default=20)
+    load.add_argument('--server-threads', type=int, default=16)
+    load.add_argument('--gemini-latency', type=float, default=1.0)
+    load.set_defaults(func=bench_load)
+
+    cohorts = subparsers.add_parser('cohorts', help='cohort ranking refresh and lookup cost')
+    cohorts.add_argument('--users', type=int, default=20000)
+    cohorts.add_argument('--days', type=int, default=60)
+    cohorts.set_defaults(func=bench_cohorts)
+
+    archive = subparsers.add_parser('archive', help='history reads and scans before and after archiving')
+    archive.add_argument('--users', type=int, default=2000)
+    archive.add_argument('--days', type=int, default=730)
+    archive.add_argument('--horizon', type=int, default=365)
+    archive.set_defaults(func=bench_archive)
+
+    profile = subparsers.add_parser('profile', help='sampling profiler overhead and attribution')
+    profile.add_argument('--requests', type=int, default=300)
+    profile.add_argument('--interval-ms', type=float, default=10)
+    profile.set_defaults(func=bench_profile)
+
+    reminders = subparsers.add_parser('reminders', help='reminder volume and goal attainment, fixed vs paced')
+    reminders.add_argument('--users', type=int, default=1000)
+    reminders.add_argument('--days', type=int, default=7)
+    reminders.set_defaults(func=bench_reminders)
+
+    shards = subparsers.add_parser('shards', help='concurrent /add_water throughput by shard count')
+    shards.add_argument('--counts', default='1,2,4')
+    shards.add_argument('--workers', type=int, default=8)
+    shards.add_argument('--users', type=int, default=200)
+    shards.add_argument('--duration', type=float, default=10)
+    shards.set_defaults(func=bench_shards)
+
+    sessions = subparsers.add_parser('sessions', help='queries and latency per route for each session backend')
+    sessions.add_argument('--requests', type=int, default=200)
+    sessions.set_defaults(func=bench_sessions)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
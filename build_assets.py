@@ -0,0 +1,324 @@
+"""
+Asset build step for WaterBuddy
+Compiles Tailwind CSS, minifies and fingerprints CSS/JS/SVG and fonts, and precompresses them into static/dist
+
+Usage:
+    python build_assets.py --fetch-vendor   # once, online: download third-party files into vendor/
+    python build_assets.py                  # offline: build static/dist and its manifest.json
+
+Tailwind is compiled with the standalone Tailwind CLI (a single binary, no Node.js needed).
+Set TAILWIND_BIN or put `tailwindcss` on PATH; --fetch-vendor downloads it into vendor/bin.
+brotli (.br files) and rjsmin (JS minification) are optional, see requirements-build.txt.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VENDOR_DIR = os.path.join(ROOT, 'vendor')
+DIST_DIR = os.path.join(ROOT, 'static', 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+TEMPLATES = ['index.html', 'profile.html', 'dashboard.html', 'insights.html', 'settings.html', 'test_gemini.html']
+
+# Logical asset name (as used with asset_url() in templates) -> source file
+ASSET_SOURCES = {
+    'js/chatbot.js': 'chatbot.js',
+    'js/dashboard.js': 'dashboard.js',
+    'js/profile.js': 'profile.js',
+    'js/background-effects.js': 'background-effects.js',
+    'images/water-drop.svg': 'water-drop.svg',
+    'images/water-glass.svg': 'water-glass.svg',
+    'vendor/fontawesome/css/all.min.css': 'vendor/fontawesome/css/all.min.css',
+    'vendor/fontawesome/webfonts/fa-solid-900.woff2': 'vendor/fontawesome/webfonts/fa-solid-900.woff2',
+    'vendor/fontawesome/webfonts/fa-regular-400.woff2': 'vendor/fontawesome/webfonts/fa-regular-400.woff2',
+    'vendor/fontawesome/webfonts/fa-brands-400.woff2': 'vendor/fontawesome/webfonts/fa-brands-400.woff2',
+    'vendor/flatpickr/flatpickr.min.css': 'vendor/flatpickr/flatpickr.min.css',
+    'vendor/flatpickr/flatpickr.min.js': 'vendor/flatpickr/flatpickr.min.js',
+}
+
+# Third-party files downloaded by --fetch-vendor, pinned to exact versions
+VENDOR_FILES = {
+    'vendor/fontawesome/css/all.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'vendor/fontawesome/webfonts/fa-solid-900.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.woff2',
+    'vendor/fontawesome/webfonts/fa-regular-400.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-regular-400.woff2',
+    'vendor/fontawesome/webfonts/fa-brands-400.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-brands-400.woff2',
+    'vendor/flatpickr/flatpickr.min.css': 'https://cdn.jsdelivr.net/npm/flatpickr@4.6.13/dist/flatpickr.min.css',
+    'vendor/flatpickr/flatpickr.min.js': 'https://cdn.jsdelivr.net/npm/flatpickr@4.6.13/dist/flatpickr.min.js',
+}
+
+TAILWIND_VERSION = 'v3.4.3'
+TAILWIND_PLATFORMS = {
+    ('linux', 'x86_64'): 'tailwindcss-linux-x64',
+    ('linux', 'aarch64'): 'tailwindcss-linux-arm64',
+    ('darwin', 'x86_64'): 'tailwindcss-macos-x64',
+    ('darwin', 'arm64'): 'tailwindcss-macos-arm64',
+    ('windows', 'amd64'): 'tailwindcss-windows-x64.exe',
+}
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json')
+
+
+def fetch_vendor():
+    """Download third-party assets and the Tailwind CLI into vendor/"""
+    downloads = dict(VENDOR_FILES)
+    binary = TAILWIND_PLATFORMS.get((sys.platform.replace('win32', 'windows'), platform.machine().lower()))
+    if binary:
+        downloads['vendor/bin/' + binary] = (
+            f'https://github.com/tailwindlabs/tailwindcss/releases/download/{TAILWIND_VERSION}/{binary}'
+        )
+
+    for target, url in downloads.items():
+        path = os.path.join(ROOT, target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print(f"Fetching {url}")
+        with urllib.request.urlopen(url) as response, open(path, 'wb') as out:
+            shutil.copyfileobj(response, out)
+        if target.startswith('vendor/bin/'):
+            os.chmod(path, 0o755)
+
+
+def find_tailwind():
+    candidates = [os.environ.get('TAILWIND_BIN'), shutil.which('tailwindcss')]
+    bin_dir = os.path.join(VENDOR_DIR, 'bin')
+    if os.path.isdir(bin_dir):
+        candidates += [os.path.join(bin_dir, name) for name in sorted(os.listdir(bin_dir))]
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def compile_tailwind():
+    """Compile only the Tailwind utilities used by the templates and scripts"""
+    tailwind = find_tailwind()
+    if not tailwind:
+        return None
+
+    content = ','.join(os.path.join(ROOT, name) for name in TEMPLATES + ['*.js'])
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'input.css')
+        output = os.path.join(tmp, 'tailwind.css')
+        with open(source, 'w') as f:
+            f.write('@tailwind base;\n@tailwind components;\n@tailwind utilities;\n')
+        subprocess.run([tailwind, '-i', source, '-o', output, '--content', content, '--minify'],
+                       check=True, capture_output=True)
+        with open(output, 'rb') as f:
+            return f.read()
+
+
+def used_class_names():
+    """Every class-like token in the templates and scripts, used to purge vendor CSS"""
+    tokens = set()
+    for name in TEMPLATES + [source for source in ASSET_SOURCES.values() if source.endswith('.js')]:
+        path = os.path.join(ROOT, name)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                tokens.update(re.findall(r'[A-Za-z][\w-]*', f.read()))
+    return tokens
+
+
+def purge_css(css, used):
+    """
+    Drop rules whose selectors only target classes that never appear in the templates.
+
+    Rules without class selectors (elements, :root, @font-face) are always kept,
+    and @media/@supports blocks are purged recursively.
+    """
+    out = []
+    pos = 0
+    while pos < len(css):
+        open_brace = css.find('{', pos)
+        if open_brace == -1:
+            out.append(css[pos:])
+            break
+        prelude = css[pos:open_brace].strip()
+
+        depth, end = 1, open_brace + 1
+        while depth and end < len(css):
+            if css[end] == '{':
+                depth += 1
+            elif css[end] == '}':
+                depth -= 1
+            end += 1
+        body = css[open_brace + 1:end - 1]
+        pos = end
+
+        if prelude.startswith(('@media', '@supports')):
+            inner = purge_css(body, used)
+            if inner.strip():
+                out.append(f'{prelude}{{{inner}}}')
+        elif prelude.startswith('@'):
+            out.append(f'{prelude}{{{body}}}')
+        else:
+            selectors = [sel for sel in prelude.split(',') if _selector_used(sel, used)]
+            if selectors:
+                out.append(f'{",".join(selectors)}{{{body}}}')
+    return ''.join(out)
+
+
+def _selector_used(selector, used):
+    classes = re.findall(r'\.([A-Za-z][\w-]*)', selector)
+    return all(cls in used for cls in classes)
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};:,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(name, js):
+    """Minify JS with rjsmin; without it the file is copied as written (gzip/brotli still apply)"""
+    if rjsmin is None:
+        print(f"  rjsmin not installed, copying {name} unminified")
+        return js
+    return rjsmin.jsmin(js)
+
+
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    return f'dist/{stem}.{digest}{ext}'
+
+
+def rewrite_css_urls(css, css_name, manifest):
+    """Point url(...) references in CSS at the fingerprinted files"""
+    base = os.path.dirname(css_name)
+
+    def replace(match):
+        url = match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '/')):
+            return match.group(0)
+        path, _, suffix = url.partition('?')
+        path, hash_sep, fragment = path.partition('#')
+        target = os.path.normpath(os.path.join(base, path)).replace(os.sep, '/')
+        if target not in manifest:
+            return match.group(0)
+        rel = os.path.relpath(manifest[target], os.path.dirname('dist/' + css_name)).replace(os.sep, '/')
+        return f'url({match.group(1)}{rel}{hash_sep}{fragment}{match.group(1)})'
+
+    return re.sub(r'url\((["\']?)([^"\')]+)\1\)', replace, css)
+
+
+def write_output(path, data):
+    full = os.path.join(ROOT, 'static', path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, 'wb') as f:
+        f.write(data)
+
+    sizes = {'raw': len(data)}
+    if full.endswith(COMPRESSIBLE):
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        with open(full + '.gz', 'wb') as f:
+            f.write(gz)
+        sizes['gzip'] = len(gz)
+        if brotli is not None:
+            br = brotli.compress(data, quality=11)
+            with open(full + '.br', 'wb') as f:
+                f.write(br)
+            sizes['br'] = len(br)
+    return sizes
+
+
+def build(allow_missing=False):
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+
+    used = used_class_names()
+    manifest = {}
+    report = []
+
+    def emit(name, data, original_size):
+        path = fingerprint(name, data)
+        manifest[name] = path
+        report.append((name, original_size, write_output(path, data)))
+
+    tailwind = compile_tailwind()
+    if tailwind is None:
+        message = "Tailwind CLI not found: set TAILWIND_BIN, install tailwindcss, or run --fetch-vendor"
+        if not allow_missing:
+            raise SystemExit(message)
+        print(f"  {message}")
+    else:
+        emit('css/tailwind.css', tailwind, len(tailwind))
+
+    # Binary files first so CSS can reference their fingerprinted names
+    ordered = sorted(ASSET_SOURCES.items(), key=lambda item: item[0].endswith('.css'))
+    for name, source in ordered:
+        path = os.path.join(ROOT, source)
+        if not os.path.exists(path):
+            message = f"Missing asset source {source} (run --fetch-vendor?)"
+            if not allow_missing:
+                raise SystemExit(message)
+            print(f"  {message}")
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if name.endswith('.css'):
+            # Minify first so comments cannot be mistaken for selectors
+            css = purge_css(minify_css(data.decode('utf-8')), used)
+            css = rewrite_css_urls(css, name, manifest)
+            emit(name, css.encode('utf-8'), len(data))
+        elif name.endswith('.js'):
+            js = data.decode('utf-8')
+            emit(name, (js if name.endswith('.min.js') else minify_js(name, js)).encode('utf-8'), len(data))
+        elif name.endswith('.svg'):
+            svg = re.sub(r'>\s+<', '><', data.decode('utf-8')).strip()
+            emit(name, svg.encode('utf-8'), len(data))
+        else:
+            emit(name, data, len(data))
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    print_report(report)
+
+
+def print_report(report):
+    print(f"{'asset':<52} {'source':>10} {'built':>10} {'gzip':>9} {'br':>9}")
+    transferred = 0
+    for name, original, sizes in report:
+        wire = min(sizes.values())
+        transferred += wire
+        print(f"{name:<52} {original:>10} {sizes['raw']:>10} "
+              f"{sizes.get('gzip', '-'):>9} {sizes.get('br', '-'):>9}")
+    print(f"\nTotal bytes on the wire (best encoding per file): {transferred}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build WaterBuddy static assets')
+    parser.add_argument('--fetch-vendor', action='store_true', help='download third-party files (needs network)')
+    parser.add_argument('--allow-missing', action='store_true', help='warn instead of failing on missing sources')
+    args = parser.parse_args(argv)
+
+    if args.fetch_vendor:
+        fetch_vendor()
+    build(allow_missing=args.allow_missing)
+
+
+if __name__ == '__main__':
+    main()
@@ -68,17 +68,26 @@ class WaterChatbot {
                 body: JSON.stringify({ message: message }),
             });
             
-            // Add a small delay to simulate typing
-            await new Promise(resolve => setTimeout(resolve, Math.random() * 1000 + 1000));
+            const data = await response.json();
+            
+            // The reply is generated in the background, poll until it is ready
+            if (data.success && data.pending) {
+                const result = await this.pollTask(data.task_id);
+                data.message = result ? result.message : "I'm sorry, I couldn't process your message. Please try again later.";
+            }
             
             // Hide typing indicator
             this.hideTypingIndicator();
             
-            const data = await response.json();
             if (data.success) {
                 // Add bot response to chat
                 this.addBotMessage(data.message);
                 
+                // Water logged through the chat bumps the data version; pull the change
+                if (data.water_added && window.intakeSync) {
+                    window.intakeSync.sync();
+                }
+                
                 // Update water amount if changed
                 if (data.current_amount !== window.currentAmount) {
                     window.currentAmount = data.current_amount;
@@ -105,14 +114,51 @@ class WaterChatbot {
                         apiStatusNote.classList.remove('hidden');
                     }
                 }
+            } else if (data.message) {
+                // e.g. rate limited (429) while the server is busy
+                this.addBotMessage(data.message);
             }
         } catch (error) {
             console.error('Error sending message:', error);
             this.hideTypingIndicator();
+            
+            // Offline: simple water logs go into the sync queue instead of being lost
+            const amount = this.parseWaterLog(message);
+            if (amount && window.intakeSync) {
+                window.intakeSync.log(amount);
+                this.addBotMessage(`You're offline, so I've saved ${amount}ml on this device. It will sync when you're back online.`);
+                return;
+            }
             this.addBotMessage("I'm sorry, I couldn't process your message. Please try again later.");
         }
     }
     
+    parseWaterLog(message) {
+        // The simplest forms the server understands: "add", "300", "add 300ml"
+        const text = message.trim().toLowerCase();
+        if (text === 'add') {
+            return 250;
+        }
+        const match = text.match(/^(?:add\s+)?(\d{1,4})\s*(?:ml)?$/);
+        const amount = match ? parseInt(match[1], 10) : 0;
+        return amount > 0 && amount <= 5000 ? amount : 0;
+    }
+    
+    async pollTask(taskId) {
+        let delay = 300;
+        for (let attempt = 0; attempt < 60; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            const response = await fetch(`/task_status/${taskId}`);
+            const data = await response.json();
+            
+            if (!data.success || data.state === 'failed') return null;
+            if (data.state === 'done') return data.result;
+            
+            delay = Math.min(delay * 1.5, 2000);
+        }
+        return null;
+    }
+    
     addUserMessage(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'flex mb-4 justify-end';
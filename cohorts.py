@@ -0,0 +1,309 @@
+"""
+Cohort rankings for WaterBuddy
+This module ranks each user's streak and goal-hit rate against peers of a similar age and profession
+
+Statistics for every user are rebuilt with one windowed SQL query by a single
+job (`flask refresh-cohorts` from cron), which writes them to a snapshot file;
+every worker loads the snapshot again when it changes. In between, streaks
+observed by the dashboard and insights pages update the rankings incrementally.
+Each cohort keeps its values in sorted lists, so a user's percentile and rank
+are binary searches. Leaderboards show ranks and streaks, never other users' names.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, timedelta
+
+from sqlalchemy import text
+
+from database import db, User, DailyGoal
+from timezones import local_today
+
+# Profession terms used by calculate_water_goal() to adjust the goal
+ACTIVE_PROFESSIONS = ['athlete', 'construction', 'fitness', 'trainer', 'labor', 'worker']
+SEDENTARY_PROFESSIONS = ['office', 'desk', 'computer', 'programmer', 'developer']
+
+# (lowest age, highest age, label); calculate_water_goal() changes the goal below 18 and above 65
+AGE_BANDS = [
+    (0, 17, 'under 18'),
+    (18, 29, '18-29'),
+    (30, 49, '30-49'),
+    (50, 65, '50-65'),
+    (66, 200, 'over 65'),
+]
+
+CATEGORY_LABELS = {'active': 'active jobs', 'sedentary': 'desk jobs', 'other': 'other jobs'}
+
+# Days of goal-met runs found with a window function: consecutive dates share
+# the same (julian day - row number), so each group is one streak
+STREAKS_SQL = text("""
+    WITH met AS (
+        SELECT w.user_id, w.date,
+               julianday(w.date) - ROW_NUMBER() OVER (PARTITION BY w.user_id ORDER BY w.date) AS run
+        FROM water_intakes w
+        JOIN daily_goals g ON g.user_id = w.user_id
+        WHERE w.date >= :since AND w.amount >= g.amount
+    )
+    SELECT user_id, MAX(date) AS last_day, COUNT(*) AS days
+    FROM met
+    GROUP BY user_id, run
+""")
+
+
+def profession_category(profession):
+    """'active', 'sedentary' or 'other', by the same terms as calculate_water_goal()"""
+    profession = (profession or '').lower()
+    if any(term in profession for term in ACTIVE_PROFESSIONS):
+        return 'active'
+    if any(term in profession for term in SEDENTARY_PROFESSIONS):
+        return 'sedentary'
+    return 'other'
+
+
+def cohort_label(cohort):
+    age_band, category = cohort
+    return f"aged {age_band} with {CATEGORY_LABELS[category]}"
+
+
+def cohort_of(age, profession):
+    """The (age band, profession category) cohort for a user"""
+    for low, high, label in AGE_BANDS:
+        if low <= age <= high:
+            return (label, profession_category(profession))
+    return (AGE_BANDS[-1][2], profession_category(profession))
+
+
+class _Cohort:
+    """
+    Sorted values for one cohort; streak_order is (-streak, user_id), so its head is the leaderboard.
+
+    Finding a position is a binary search, but insort() and del shift the tail
+    of the list, so add/remove/update are O(n) in the cohort size. That is
+    intended: a cohort holds at most a few hundred thousand values, and shifting
+    them is one memmove of a few hundred KB, cheaper than maintaining a balanced
+    tree in Python.
+    """
+
+    def __init__(self, rows=()):
+        # rows: (user_id, streak, hit_rate), sorted once when a refresh builds the cohort
+        rows = list(rows)
+        self.streaks = sorted(streak for _, streak, _ in rows)
+        self.hit_rates = sorted(hit_rate for _, _, hit_rate in rows)
+        self.streak_order = sorted((-streak, user_id) for user_id, streak, _ in rows)
+
+    def add(self, user_id, streak, hit_rate):
+        insort(self.streaks, streak)
+        insort(self.hit_rates, hit_rate)
+        insort(self.streak_order, (-streak, user_id))
+
+    def remove(self, user_id, streak, hit_rate):
+        del self.streaks[bisect_left(self.streaks, streak)]
+        del self.hit_rates[bisect_left(self.hit_rates, hit_rate)]
+        del self.streak_order[bisect_left(self.streak_order, (-streak, user_id))]
+
+    def update_streak(self, user_id, old, new):
+        del self.streaks[bisect_left(self.streaks, old)]
+        insort(self.streaks, new)
+        del self.streak_order[bisect_left(self.streak_order, (-old, user_id))]
+        insort(self.streak_order, (-new, user_id))
+
+
+class CohortStats:
+    """
+    Flask extension holding cohort rankings in memory.
+
+    refresh() ranks every user and writes the result to COHORT_SNAPSHOT; run it
+    from one place, `flask refresh-cohorts` in a cron job. Each process reloads
+    the snapshot when its mtime changes, like the archive manifest. For a single
+    process deployment, COHORT_REFRESH_SECONDS starts a daemon thread calling
+    refresh() instead (0, the default, disables it). lookup() and
+    observe_streak() never touch the database.
+    """
+
+    def __init__(self, app=None, refresh_seconds=0, leaderboard_size=10, min_cohort=5, lookback_days=365,
+                 snapshot_path=None):
+        self.refresh_seconds = refresh_seconds
+        self.leaderboard_size = leaderboard_size
+        self.min_cohort = min_cohort
+        self.lookback_days = lookback_days
+        self.snapshot_path = snapshot_path
+
+        self.app = None
+        self.refreshed_at = None
+        self._cohorts = {}
+        self._members = {}
+        self._snapshot_mtime = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.refresh_seconds = app.config.get('COHORT_REFRESH_SECONDS', self.refresh_seconds)
+        self.leaderboard_size = app.config.get('COHORT_LEADERBOARD_SIZE', self.leaderboard_size)
+        self.min_cohort = app.config.get('COHORT_MIN_SIZE', self.min_cohort)
+        self.lookback_days = app.config.get('COHORT_LOOKBACK_DAYS', self.lookback_days)
+        self.snapshot_path = app.config.get('COHORT_SNAPSHOT') or os.path.join(app.instance_path, 'cohorts.json')
+        self.refreshed_at = None
+        self._cohorts = {}
+        self._members = {}
+        self._snapshot_mtime = None
+        app.extensions['cohort_stats'] = self
+
+        if self.refresh_seconds:
+            refresher = threading.Thread(target=self._run, name='waterbuddy-cohort-refresh', daemon=True)
+            refresher.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh()
+                delay = self.refresh_seconds
+            except Exception as e:
+                print(f"Cohort refresh failed: {str(e)}")
+                delay = min(self.refresh_seconds, 30)
+            time.sleep(delay)
+
+    def refresh(self):
+        """
+        Recompute every user's streak and 30-day goal-hit rate, write the snapshot and rebuild the rankings.
+
+        Returns:
+            The number of users ranked
+        """
+        since = date.today() - timedelta(days=self.lookback_days)
+        runs = {}
+        for user_id, last_day, days in db.fan_out(STREAKS_SQL, {'since': since.isoformat()}):
+            if isinstance(last_day, str):
+                last_day = date.fromisoformat(last_day)
+            runs.setdefault(user_id, []).append((last_day, days))
+
+        # Streaks reaching back past the archive cutoff continue in the archive
+        archive = self.app.extensions.get('intake_archive')
+        archive_cutoff = archive.newest_cutoff() if archive else None
+
+        members = []
+        users = db.session.query(User.id, User.age, User.profession, User.timezone)
+        for user_id, age, profession, tz_name in users:
+            today = local_today(tz_name)
+            window_start = today - timedelta(days=29)
+            streak = 0
+            met_days = 0
+            for last_day, days in runs.get(user_id, ()):
+                first_day = last_day - timedelta(days=days - 1)
+                if last_day in (today, today - timedelta(days=1)):
+                    streak = days
+                    if archive_cutoff and first_day <= archive_cutoff:
+                        goal = db.session.query(DailyGoal.amount).filter_by(user_id=user_id).scalar()
+                        streak += archive.goal_streak(user_id, first_day - timedelta(days=1), goal)
+                # Days of this run inside the last 30 days
+                overlap = (min(last_day, today) - max(first_day, window_start)).days + 1
+                met_days += max(0, overlap)
+
+            members.append([user_id, *cohort_of(age, profession), streak, met_days / 30])
+
+        refreshed_at = time.time()
+        directory = os.path.dirname(self.snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'refreshed_at': refreshed_at, 'members': members}, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+        with self._lock:
+            self._install(members, refreshed_at)
+            self._snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+        return len(members)
+
+    def _load(self):
+        """Load the snapshot if another process (or thread) rewrote it since the last call"""
+        try:
+            mtime = os.stat(self.snapshot_path).st_mtime_ns
+        except (FileNotFoundError, TypeError):
+            return
+        if mtime == self._snapshot_mtime:
+            return
+
+        with self._lock:
+            if mtime != self._snapshot_mtime:
+                with open(self.snapshot_path) as f:
+                    snapshot = json.load(f)
+                self._install(snapshot['members'], snapshot['refreshed_at'])
+                self._snapshot_mtime = mtime
+
+    def _install(self, members, refreshed_at):
+        # members: [user_id, age band, profession category, streak, hit rate]
+        rows = {}
+        self._members = {}
+        for user_id, age_band, category, streak, hit_rate in members:
+            cohort = (age_band, category)
+            rows.setdefault(cohort, []).append((user_id, streak, hit_rate))
+            self._members[user_id] = {'cohort': cohort, 'streak': streak, 'hit_rate': hit_rate}
+        self._cohorts = {cohort: _Cohort(cohort_rows) for cohort, cohort_rows in rows.items()}
+        self.refreshed_at = refreshed_at
+
+    def observe_streak(self, user, streak):
+        """Update a user's streak between refreshes (e.g. after /insights recomputes it)"""
+        self._load()
+        cohort = cohort_of(user.age, user.profession)
+        with self._lock:
+            member = self._members.get(user.id)
+            if member is not None and member['cohort'] != cohort:
+                # The profile changed cohort since the last refresh
+                self._cohorts[member['cohort']].remove(user.id, member['streak'], member['hit_rate'])
+                self._cohorts.setdefault(cohort, _Cohort()).add(user.id, streak, member['hit_rate'])
+                member.update(cohort=cohort, streak=streak)
+            elif member is None:
+                self._members[user.id] = {'cohort': cohort, 'streak': streak, 'hit_rate': 0.0}
+                self._cohorts.setdefault(cohort, _Cohort()).add(user.id, streak, 0.0)
+            elif member['streak'] != streak:
+                self._cohorts[cohort].update_streak(user.id, member['streak'], streak)
+                member['streak'] = streak
+
+    def sizes(self):
+        """Number of users in each cohort, keyed by its label"""
+        self._load()
+        with self._lock:
+            return {cohort_label(key): len(cohort.streaks) for key, cohort in self._cohorts.items()}
+
+    def lookup(self, user_id):
+        """
+        Where a user stands in their cohort.
+
+        Returns:
+            Dictionary with the cohort label, its size, the user's streak and hit
+            rate percentiles (percent of peers below them), streak rank and the
+            leaderboard (rank and streak only, flagging the user's own entry);
+            None if the user is not ranked or the cohort is too small
+        """
+        self._load()
+        with self._lock:
+            member = self._members.get(user_id)
+            if member is None:
+                return None
+            cohort = self._cohorts[member['cohort']]
+            size = len(cohort.streaks)
+            if size < self.min_cohort:
+                return None
+
+            streak, hit_rate = member['streak'], member['hit_rate']
+            # Ranks are competition ranks (ties share one), the same as streak_rank
+            leaderboard = [
+                {'rank': size - bisect_right(cohort.streaks, -negative_streak) + 1,
+                 'streak': -negative_streak, 'you': peer_id == user_id}
+                for negative_streak, peer_id in cohort.streak_order[:self.leaderboard_size]
+            ]
+            return {
+                'cohort': cohort_label(member['cohort']),
+                'size': size,
+                'streak': streak,
+                'hit_rate': round(hit_rate * 100),
+                'streak_percentile': round(100 * bisect_left(cohort.streaks, streak) / size),
+                'hit_rate_percentile': round(100 * bisect_left(cohort.hit_rates, hit_rate) / size),
+                'streak_rank': size - bisect_right(cohort.streaks, streak) + 1,
+                'leaderboard': leaderboard,
+            }
@@ -0,0 +1,177 @@
+"""
+Conversation memory for the WaterBuddy chatbot
+This module keeps each user's recent chat turns server-side and assembles Gemini prompts within a token budget
+"""
+import json
+import time
+from collections import deque
+
+from sessions import MemoryStore
+
+CHAT_PREFIX = 'chat:'
+# A conversation is locked while a message is appended; a lock left by a crashed worker expires
+LOCK_SECONDS = 5
+LOCK_WAIT_SECONDS = 2
+
+# How many of the most recent topics the rolling summary keeps, and how much of each
+SUMMARY_TOPICS = 6
+SUMMARY_TOPIC_CHARS = 80
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English text)"""
+    return (len(text) + 3) // 4
+
+
+class _Thread:
+    """One user's conversation: a ring buffer of recent turns and a summary of evicted ones"""
+
+    def __init__(self, max_turns, turns=(), evicted=0, topics=(), summary=''):
+        self.turns = deque((tuple(turn) for turn in turns), maxlen=max_turns)
+        self.evicted = evicted
+        self.topics = deque(topics, maxlen=SUMMARY_TOPICS)
+        self.summary = summary
+
+    @classmethod
+    def loads(cls, max_turns, raw):
+        return cls(max_turns, **json.loads(raw)) if raw else cls(max_turns)
+
+    def dumps(self):
+        return json.dumps({'turns': list(self.turns), 'evicted': self.evicted,
+                           'topics': list(self.topics), 'summary': self.summary})
+
+    def add(self, role, text):
+        if len(self.turns) == self.turns.maxlen:
+            self._compact(*self.turns[0])
+        self.turns.append((role, text))
+
+    def _compact(self, role, text):
+        # The summary is rebuilt only when a turn falls out of the ring buffer,
+        # so building a prompt never re-reads the whole conversation
+        self.evicted += 1
+        if role == 'user':
+            topic = ' '.join(text.split())
+            if len(topic) > SUMMARY_TOPIC_CHARS:
+                topic = topic[:SUMMARY_TOPIC_CHARS - 3] + '...'
+            self.topics.append(topic)
+        if self.topics:
+            self.summary = (f"{self.evicted} earlier messages. Earlier the user asked about: "
+                            + '; '.join(self.topics))
+
+
+class ConversationMemory:
+    """
+    Flask extension holding per-user chat history in the server-side session store.
+
+    Each user gets a ring buffer of the last CHAT_MEMORY_TURNS messages (user
+    and assistant). Messages pushed out of the buffer are folded into a short
+    cached summary. Conversations live in the ServerSessions store, so every
+    worker sees the same history, and expire CHAT_MEMORY_TTL_HOURS after the
+    last message. With the 'cookie' session backend there is no shared store
+    and history is kept in this process.
+    """
+
+    def __init__(self, app=None, max_turns=12, ttl_hours=24):
+        self.max_turns = max_turns
+        self.ttl_hours = ttl_hours
+        self.store = MemoryStore()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_turns = app.config.get('CHAT_MEMORY_TURNS', self.max_turns)
+        self.ttl_hours = app.config.get('CHAT_MEMORY_TTL_HOURS', self.ttl_hours)
+        sessions = app.extensions.get('server_sessions')
+        self.store = sessions.store if sessions is not None and sessions.store is not None else MemoryStore()
+        app.extensions['conversation_memory'] = self
+
+    def add_exchange(self, user_id, user_message, reply):
+        """Record a user message and the assistant's reply"""
+        key = CHAT_PREFIX + str(user_id)
+        # Two replies for one user can finish at once in different workers, so the
+        # read-modify-write holds a short lock in the store (SET NX, like Redis)
+        deadline = time.monotonic() + LOCK_WAIT_SECONDS
+        locked = self.store.add(key + ':lock', '1', LOCK_SECONDS)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(0.01)
+            locked = self.store.add(key + ':lock', '1', LOCK_SECONDS)
+        try:
+            thread = _Thread.loads(self.max_turns, self.store.get(key))
+            thread.add('user', user_message)
+            thread.add('assistant', reply)
+            self.store.set(key, thread.dumps(), self.ttl_hours * 3600)
+        finally:
+            if locked:
+                self.store.delete(key + ':lock')
+
+    def history(self, user_id):
+        """
+        Snapshot of a user's conversation, safe to pass to a background task.
+
+        Returns:
+            Dictionary with 'summary' (text, may be empty) and 'turns' ([role, text], oldest first)
+        """
+        thread = _Thread.loads(self.max_turns, self.store.get(CHAT_PREFIX + str(user_id)))
+        return {'summary': thread.summary, 'turns': [list(turn) for turn in thread.turns]}
+
+    def clear(self, user_id):
+        self.store.delete(CHAT_PREFIX + str(user_id))
+
+
+def build_prompt(preamble, message, footer, history=None, supplements=(), token_budget=800):
+    """
+    Assemble a prompt that fits the token budget.
+
+    The preamble (instructions and user context), the message and the footer
+    are always included; a message too long for the budget is truncated. The remaining budget goes, in order, to the most
+    recent turns, then the summary of older turns, then supplemental facts and tips.
+
+    Args:
+        preamble: Instructions and context placed before the history
+        message: The user's message, placed after the history
+        footer: Closing instructions
+        history: Output of ConversationMemory.history(), or None
+        supplements: Optional lines of extra information, most useful first
+        token_budget: Maximum estimated tokens for the whole prompt
+
+    Returns:
+        (prompt, estimated tokens)
+    """
+    history = history or {'summary': '', 'turns': []}
+    # The message gets whatever the preamble, footer and separators leave, cut off if it is longer
+    room = token_budget - estimate_tokens(preamble) - estimate_tokens(footer) - 2
+    if estimate_tokens(message) > room:
+        message = message[:max(0, room * 4 - 3)] + '...'
+    remaining = room - estimate_tokens(message)
+
+    # Newest turns first, stopping at the first one that does not fit
+    recent = []
+    for role, text in reversed(history['turns']):
+        line = f"{'User' if role == 'user' else 'WaterBuddy'}: {text}"
+        cost = estimate_tokens(line) + 1
+        if cost > remaining:
+            break
+        recent.append(line)
+        remaining -= cost
+    recent.reverse()
+
+    summary = history['summary']
+    if summary and estimate_tokens(summary) + 1 <= remaining:
+        remaining -= estimate_tokens(summary) + 1
+    else:
+        summary = ''
+
+    extra = []
+    for line in supplements:
+        cost = estimate_tokens(line) + 1
+        if cost <= remaining:
+            extra.append(line)
+            remaining -= cost
+
+    sections = [preamble.strip()]
+    if summary or recent:
+        sections.append("Conversation so far:\n" + '\n'.join(([f"({summary})"] if summary else []) + recent))
+    if extra:
+        sections.append("Additional hydration information to consider:\n" + '\n'.join(extra))
+    prompt = '\n\n'.join(sections + [message.strip(), footer.strip()]) + '\n'
+    return prompt, estimate_tokens(prompt)
@@ -3,6 +3,173 @@
  * Handles water intake tracking, visualization, and calendar functionality
  */
 
+/**
+ * Offline-first intake logging
+ * Sips are queued in localStorage and pushed to /api/sync in batches, so logging is
+ * instant and survives a dropped connection. Each event has its own ID and the server
+ * ignores IDs it has already applied, so a batch is simply resent until acknowledged.
+ */
+class IntakeSync {
+    constructor(options = {}) {
+        this.url = options.url || '/api/sync';
+        this.storageKey = options.storageKey || 'waterbuddy-sync';
+        this.flushDelay = options.flushDelay || 1000;    // coalesce quick taps into one request
+        this.pollInterval = options.pollInterval || 60000;
+        this.maxBatch = options.maxBatch || 500;
+        this.onChange = options.onChange || (() => {});
+        
+        this.timer = null;
+        this.inFlight = null;
+        this.retryDelay = this.flushDelay;
+        this.state = this.load();
+        
+        window.addEventListener('online', () => this.sync());
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'visible') {
+                this.sync();
+            }
+        });
+        setInterval(() => this.sync(), this.pollInterval);
+    }
+    
+    load() {
+        try {
+            const saved = JSON.parse(localStorage.getItem(this.storageKey));
+            if (saved && Array.isArray(saved.queue)) {
+                return saved;
+            }
+        } catch (error) {
+            console.error('Error reading the sync queue:', error);
+        }
+        return { version: 0, queue: [], dashboard: null };
+    }
+    
+    save() {
+        try {
+            localStorage.setItem(this.storageKey, JSON.stringify(this.state));
+        } catch (error) {
+            console.error('Error saving the sync queue:', error);
+        }
+    }
+    
+    newEventId() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+    
+    // Queue a sip and push it shortly; returns the queued event
+    log(amount) {
+        // Other tabs share the queue, so start from what is stored
+        this.state = this.load();
+        const event = {
+            event_id: this.newEventId(),
+            amount: amount,
+            timestamp: new Date().toISOString()
+        };
+        // Tag events with the user they were logged for, so a different user's
+        // session rejects them instead of applying them to the wrong account
+        if (this.state.dashboard) {
+            event.user_id = this.state.dashboard.user_id;
+        }
+        this.state.queue.push(event);
+        this.save();
+        this.schedule(this.flushDelay);
+        return event;
+    }
+    
+    // Milliliters logged on this device that the server has not acknowledged yet
+    pendingAmount() {
+        return this.state.queue.reduce((total, event) => total + event.amount, 0);
+    }
+    
+    // Adopt a payload fetched elsewhere (e.g. /api/dashboard) as the latest known state
+    remember(dashboard) {
+        this.state = this.load();
+        if (dashboard.version >= this.state.version) {
+            this.state.version = dashboard.version;
+            this.state.dashboard = dashboard;
+            this.save();
+        }
+    }
+    
+    schedule(delay) {
+        clearTimeout(this.timer);
+        this.timer = setTimeout(() => this.sync(), delay);
+    }
+    
+    sync() {
+        if (this.inFlight) {
+            return this.inFlight;
+        }
+        clearTimeout(this.timer);
+        
+        const batch = this.state.queue.slice(0, this.maxBatch);
+        this.inFlight = fetch(this.url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ version: this.state.version, events: batch }),
+        })
+        .then(response => {
+            if (response.status === 401) {
+                return null;
+            }
+            if (!response.ok) {
+                throw new Error('Sync failed with status ' + response.status);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (!data || !data.success) {
+                return data;
+            }
+            
+            // Acknowledged and rejected events both leave the queue; rejected
+            // ones are reported by index into the batch or by event ID
+            const done = new Set(data.acked);
+            data.rejected.forEach(rejection => {
+                const event = rejection.event_id !== undefined ? { event_id: rejection.event_id } : batch[rejection.index];
+                if (event) {
+                    console.error('Intake event rejected:', rejection.message);
+                    done.add(event.event_id);
+                }
+            });
+            this.state = this.load();
+            this.state.queue = this.state.queue.filter(event => !done.has(event.event_id));
+            this.state.version = data.version;
+            if (data.dashboard) {
+                this.state.dashboard = data.dashboard;
+            }
+            this.save();
+            this.retryDelay = this.flushDelay;
+            
+            if (data.dashboard) {
+                this.onChange(data.dashboard, data.days);
+            }
+            if (this.state.queue.length > 0) {
+                this.schedule(0);
+            }
+            return data;
+        })
+        .catch(error => {
+            // Offline or the server is busy: keep the queue and retry with backoff
+            console.error('Sync failed, will retry:', error);
+            this.retryDelay = Math.min(this.retryDelay * 2, 60000);
+            if (this.state.queue.length > 0) {
+                this.schedule(this.retryDelay);
+            }
+            return null;
+        })
+        .finally(() => {
+            this.inFlight = null;
+        });
+        return this.inFlight;
+    }
+}
+
 class WaterDashboard {
     constructor() {
         // Initialize properties
@@ -96,42 +263,28 @@ class WaterDashboard {
         }
     }
     
-    async addWater(amount) {
-        try {
-            const response = await fetch('/add_water', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ amount: amount }),
-            });
-            
-            const data = await response.json();
-            if (data.success) {
-                this.currentAmount = data.current_amount;
-                this.goalAmount = data.goal;
-                this.updateWaterFill();
-                
-                // Add a system message to chat if chatbot is initialized
-                if (window.waterChatbot) {
-                    window.waterChatbot.addSystemMessage(`Added ${amount}ml of water. Total: ${this.currentAmount}ml`);
-                }
-                
-                // Update calendar for today
-                const today = new Date().toISOString().split('T')[0];
-                this.calendarData[today] = {
-                    amount: this.currentAmount,
-                    goal: this.goalAmount,
-                    achieved: data.goal_achieved
-                };
-                
-                // Refresh calendar
-                this.renderCalendar(this.currentDate);
-                this.updateStreaks();
-            }
-        } catch (error) {
-            console.error('Error adding water:', error);
+    addWater(amount) {
+        // Logged locally right away; IntakeSync pushes it to the server in the background
+        window.intakeSync.log(amount);
+        this.currentAmount += amount;
+        this.updateWaterFill();
+        
+        // Add a system message to chat if chatbot is initialized
+        if (window.waterChatbot) {
+            window.waterChatbot.addSystemMessage(`Added ${amount}ml of water. Total: ${this.currentAmount}ml`);
         }
+        
+        // Update calendar for today
+        const today = new Date().toISOString().split('T')[0];
+        this.calendarData[today] = {
+            amount: this.currentAmount,
+            goal: this.goalAmount,
+            achieved: this.currentAmount >= this.goalAmount
+        };
+        
+        // Refresh calendar
+        this.renderCalendar(this.currentDate);
+        this.updateStreaks();
     }
     
     renderCalendar(date) {
@@ -249,6 +402,10 @@ class WaterDashboard {
 document.addEventListener('DOMContentLoaded', function() {
     // Check if we're on the dashboard page
     if (document.getElementById('waterFill')) {
+        if (!window.intakeSync) {
+            window.intakeSync = new IntakeSync();
+        }
+        
         // Make dashboard instance available globally
         window.waterDashboard = new WaterDashboard();
         
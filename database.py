@@ -1,8 +1,9 @@
-from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
-# Initialize SQLAlchemy
-db = SQLAlchemy()
+from shards import ShardedSQLAlchemy
+
+# Initialize SQLAlchemy; per-user tables are split across SHARD_COUNT databases (see shards.py)
+db = ShardedSQLAlchemy()
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -14,6 +15,8 @@ class User(db.Model):
     weight = db.Column(db.Float, nullable=False)  # in kg
     height = db.Column(db.Float, nullable=False)  # in cm
     profession = db.Column(db.String(100), nullable=False)
+    timezone = db.Column(db.String(64), nullable=True)  # IANA name, None means server time
+    data_version = db.Column(db.Integer, nullable=False, default=0)  # bumped on every write to the user's data
     created_at = db.Column(db.DateTime, default=datetime.now)
     
     # Relationships
@@ -24,18 +27,52 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.name}>'
 
+def bump_data_version(*user_ids):
+    """
+    Mark users' data as changed so cached dashboard payloads are revalidated (caller commits).
+
+    The users are noted in the session's info, so their cached contexts
+    (sessions.py) are invalidated once the caller commits.
+
+    Returns:
+        Mapping of user id to the new data version, for stamping WaterIntake.version
+    """
+    if not user_ids:
+        return {}
+    User.query.filter(User.id.in_(user_ids)).update(
+        {User.data_version: User.data_version + 1}, synchronize_session=False
+    )
+    db.session.info.setdefault('bumped_users', set()).update(user_ids)
+    return dict(db.session.query(User.id, User.data_version).filter(User.id.in_(user_ids)))
+
 class WaterIntake(db.Model):
     __tablename__ = 'water_intakes'
+    __table_args__ = (db.Index('ix_water_intakes_user_date', 'user_id', 'date'),)
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     amount = db.Column(db.Integer, nullable=False)  # in milliliters
+    version = db.Column(db.Integer, nullable=False, default=0)  # the user's data_version when the total last changed
     created_at = db.Column(db.DateTime, default=datetime.now)
     
     def __repr__(self):
         return f'<WaterIntake {self.date}: {self.amount}ml>'
 
+class IntakeEvent(db.Model):
+    __tablename__ = 'intake_events'
+    __table_args__ = (db.UniqueConstraint('user_id', 'event_id', name='uq_intake_event'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    event_id = db.Column(db.String(64), nullable=False)  # client-generated, used for deduplication
+    amount = db.Column(db.Integer, nullable=False)  # in milliliters
+    recorded_at = db.Column(db.DateTime, nullable=False)  # when the sip happened on the device
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<IntakeEvent {self.event_id}: {self.amount}ml>'
+
 class DailyGoal(db.Model):
     __tablename__ = 'daily_goals'
     
@@ -55,6 +92,48 @@ class WaterReminder(db.Model):
     last_reminder_time = db.Column(db.DateTime, default=datetime.now)
     reminder_interval = db.Column(db.Integer, default=90)  # in minutes (1.5 hours = 90 minutes)
     is_enabled = db.Column(db.Boolean, default=True)
+    next_reminder_at = db.Column(db.DateTime)  # scheduled by reminders.ReminderPlanner; None means check now
+    
+    def __repr__(self):
+        return f'<WaterReminder for user {self.user_id}, last sent: {self.last_reminder_time}>'
+
+class ArchiveSegment(db.Model):
+    __tablename__ = 'archive_segments'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128), nullable=False, unique=True)  # file name in ARCHIVE_DIR
+    users = db.Column(db.Integer, nullable=False)
+    rows = db.Column(db.Integer, nullable=False)
+    cutoff = db.Column(db.Date, nullable=False)  # every archived date is before this
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<ArchiveSegment {self.name}: {self.rows} rows>'
+
+class IdSequence(db.Model):
+    __tablename__ = 'id_sequences'
+    
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)  # last id handed out; user ids come from here when sharded
+    
+    def __repr__(self):
+        return f'<IdSequence {self.name}: {self.value}>'
+
+class JournalBatch(db.Model):
+    __tablename__ = 'journal_batches'
+    
+    batch_id = db.Column(db.String(32), primary_key=True)  # a flushed write-buffer batch, committed in the same transaction
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<JournalBatch {self.batch_id}>'
+
+class ShardMove(db.Model):
+    __tablename__ = 'shard_moves'
+    
+    user_id = db.Column(db.Integer, primary_key=True)  # copied here by `flask reshard`, not yet deleted from its old shard
+    source = db.Column(db.Integer, nullable=False)
+    moved_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     
     def __repr__(self):
-        return f'<WaterReminder for user {self.user_id}, last sent: {self.last_reminder_time}>'
\ No newline at end of file
+        return f'<ShardMove of user {self.user_id} from shard {self.source}>'
@@ -0,0 +1,85 @@
+"""
+Template fragment caching for WaterBuddy
+This module adds a {% cache %} tag so the static parts of large templates are rendered once per process
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache:
+    """Bounded in-process store for rendered fragments, evicting the least recently used"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Jinja extension for caching a block of template output.
+
+    Usage:
+        {% cache 'badge-legend' %}...{% endcache %}
+        {% cache 'calendar', year, month %}...{% endcache %}
+
+    The key parts are joined into the cache key, so anything the block
+    renders from the context must appear in the key. Caching is skipped
+    while the Flask app is in debug mode, so template edits show up on
+    reload; like the page shells, this is checked when the block renders,
+    since app.run(debug=True) turns debug on only after create_app().
+    Setting environment.fragment_cache_enabled to False also disables it.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache(), fragment_cache_enabled=True)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render_cached', [nodes.List(key_parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key_parts, caller):
+        if not self.environment.fragment_cache_enabled or (has_app_context() and current_app.debug):
+            return caller()
+
+        key = ':'.join(str(part) for part in key_parts)
+        cache = self.environment.fragment_cache
+        html = cache.get(key)
+        if html is None:
+            html = caller()
+            cache.set(key, html)
+        return html
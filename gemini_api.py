@@ -3,20 +3,37 @@ Google Gemini AI integration for WaterBuddy
 This module provides API access to Google's Gemini for hydration-related queries
 """
 import os
-import google.generativeai as genai
 from datetime import datetime
 import random
 
+# The Gemini SDK is slow to import, so it is only loaded the first time a model is needed
+genai = None
+_api_key = None
+
+def _load_genai():
+    """Import and configure the Gemini SDK on first use"""
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+        key = _api_key or os.getenv("GEMINI_API_KEY")
+        if key:
+            genai.configure(api_key=key)
+    return genai
+
 # Configure the Gemini API with the API key
 def configure_genai(api_key=None):
     """Configure the Gemini API with the provided API key"""
+    global _api_key
     if api_key is None:
         api_key = os.getenv("GEMINI_API_KEY")
         
     if not api_key:
         raise ValueError("Gemini API key is required. Set it as GEMINI_API_KEY environment variable or pass it directly.")
     
-    genai.configure(api_key=api_key)
+    _api_key = api_key
+    if genai is not None:
+        genai.configure(api_key=api_key)
 
 # Hydration facts to supplement responses
 hydration_facts = [
@@ -58,6 +75,7 @@ hydration_tips = [
 
 def get_gemini_model():
     """Get the Gemini model to use for generation"""
+    _load_genai()
     try:
         # Try to use Gemini 1.5 Pro if available
         return genai.GenerativeModel('gemini-1.5-pro')
@@ -74,12 +92,14 @@ def get_gemini_model():
             
             raise ValueError("No Gemini models available with your API key")
 
-def generate(prompt):
+def generate(prompt, enhance=True):
     """
     Generate a response using Google's Gemini API based on the user's query and context
     
     Args:
         prompt: The text prompt containing the user's query and context
+        enhance: Append a random fact and tip to the prompt; pass False when the
+            prompt was already assembled within a token budget
     
     Returns:
         A response from the Gemini model
@@ -123,6 +143,9 @@ def generate(prompt):
         model = get_gemini_model()
         
         # Enhance the prompt with additional hydration information
+        if not enhance:
+            return model.generate_content(prompt).text
+        
         enhanced_prompt = f"""{prompt}
 
 Additional hydration information to consider:
@@ -139,35 +162,39 @@ Keep your response concise (1-3 sentences) and focused on helping them stay hydr
     except Exception as e:
         # Fallback in case of API errors
         print(f"Gemini API Error: {str(e)}")
-        
-        # Calculate some useful values for the fallback response
-        glasses_remaining = round(remaining / 250)
-        glasses_total = round(goal_amount / 250)
-        current_hour = datetime.now().hour
-        time_of_day = "morning" if 5 <= current_hour < 12 else "afternoon" if 12 <= current_hour < 18 else "evening"
-        
-        # Create simple fallback responses based on query type
-        if any(x in user_query.lower() for x in ['how much', 'progress', 'water intake', 'hydration level']):
-            if percentage >= 80:
-                return f"You're doing great, {user_name}! You've had {current_amount}ml, which is {round(percentage)}% of your {goal_amount}ml goal."
-            else:
-                return f"You're currently at {round(percentage)}% of your daily goal with {current_amount}ml. You still need {remaining}ml to reach your {goal_amount}ml target. That's about {glasses_remaining} more glasses."
-        
-        elif any(x in user_query.lower() for x in ['tip', 'advice', 'suggest']):
-            return f"Here's a hydration tip: {random.choice(hydration_tips)}"
-        
-        elif any(x in user_query.lower() for x in ['fact', 'benefit', 'health', 'importance']):
-            return f"Hydration fact: {random.choice(hydration_facts)}"
-        
-        else:
-            return f"Good {time_of_day}, {user_name}! I'm here to help you track your water intake. Currently you're at {round(percentage)}% of your daily goal."
+        return canned_response(user_query, user_name, current_amount, goal_amount, percentage, remaining)
 
-# Initialize the API if environment variable is available
-try:
-    configure_genai()
-except:
-    # Will configure later when API key is provided
-    pass
+def canned_response(user_query, user_name="there", current_amount=0, goal_amount=2500, percentage=0, remaining=0):
+    """
+    Answer without calling the Gemini API, used when it fails or the app is shedding load
+    
+    Args:
+        user_query: The user's message
+        user_name, current_amount, goal_amount, percentage, remaining: The user's progress today
+    
+    Returns:
+        A response picked by the kind of question
+    """
+    # Calculate some useful values for the fallback response
+    glasses_remaining = round(remaining / 250)
+    current_hour = datetime.now().hour
+    time_of_day = "morning" if 5 <= current_hour < 12 else "afternoon" if 12 <= current_hour < 18 else "evening"
+    
+    # Create simple fallback responses based on query type
+    if any(x in user_query.lower() for x in ['how much', 'progress', 'water intake', 'hydration level']):
+        if percentage >= 80:
+            return f"You're doing great, {user_name}! You've had {current_amount}ml, which is {round(percentage)}% of your {goal_amount}ml goal."
+        else:
+            return f"You're currently at {round(percentage)}% of your daily goal with {current_amount}ml. You still need {remaining}ml to reach your {goal_amount}ml target. That's about {glasses_remaining} more glasses."
+    
+    elif any(x in user_query.lower() for x in ['tip', 'advice', 'suggest']):
+        return f"Here's a hydration tip: {random.choice(hydration_tips)}"
+    
+    elif any(x in user_query.lower() for x in ['fact', 'benefit', 'health', 'importance']):
+        return f"Hydration fact: {random.choice(hydration_facts)}"
+    
+    else:
+        return f"Good {time_of_day}, {user_name}! I'm here to help you track your water intake. Currently you're at {round(percentage)}% of your daily goal."
 
 # Test function if this file is run directly
 if __name__ == "__main__":
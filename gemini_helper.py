@@ -2,8 +2,21 @@
 AI helper for WaterBuddy
 This module provides AI responses for the WaterBuddy chatbot using Google's Gemini API
 """
-from datetime import datetime
-from gemini_api import generate, configure_genai
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, date
+from gemini_api import generate, canned_response, configure_genai, hydration_facts, hydration_tips
+from intents import classify, LOCAL_INTENTS, PROGRESS, TIP, FACT, LOG
+from conversation import build_prompt
+
+# Default size of a Gemini prompt, including conversation history and supplemental facts
+DEFAULT_TOKEN_BUDGET = 800
+
+# Replies served per path ('progress', 'tip', 'fact', 'log' or 'gemini'): [count, total seconds]
+_route_stats = {}
+_route_stats_lock = threading.Lock()
 
 def set_api_key(api_key):
     """
@@ -19,42 +32,118 @@ def set_api_key(api_key):
         print(f"Error configuring Gemini API: {str(e)}")
         return False
 
-def generate_response(user_input, user_data=None, water_data=None):
+def generate_response(user_input, user_data=None, water_data=None, history=None, token_budget=DEFAULT_TOKEN_BUDGET):
     """
-    Generate an AI response based on user input and context using Gemini API.
+    Generate an AI response based on user input and context.
+    
+    Progress questions, tips, facts and logging are answered locally from
+    templates; only open-ended messages are sent to the Gemini API.
     
     Args:
         user_input: The user's message
         user_data: Dictionary containing user profile information
         water_data: Dictionary containing water intake information
+        history: The user's recent conversation (ConversationMemory.history())
+        token_budget: Maximum estimated size of the Gemini prompt
     
     Returns:
         Generated text response
     """
+    response = local_response(user_input, user_data, water_data)
+    if response is None:
+        start = time.perf_counter()
+        response = gemini_reply(user_input, user_data, water_data, history, token_budget)
+        record_route('gemini', time.perf_counter() - start)
+    return response
+
+def local_response(user_input, user_data=None, water_data=None):
+    """
+    Answer a message from templates when the intent classifier recognises it.
+    
+    Returns:
+        The response text, or None for open-ended messages that need Gemini
+    """
+    start = time.perf_counter()
+    intent, _ = classify(user_input)
+    if intent not in LOCAL_INTENTS:
+        return None
+    
     # Extract user and water data
     user_name = user_data.get('name', 'there') if user_data else 'there'
     current_amount = water_data.get('current_amount', 0) if water_data else 0
     goal_amount = water_data.get('goal', 2500) if water_data else 2500
     percentage = water_data.get('percentage', 0) if water_data else 0
     remaining = water_data.get('remaining', 0) if water_data else 0
+    water_added = water_data.get('water_added', True) if water_data else True
+    
+    if intent == LOG:
+        response = log_reply(percentage, water_added)
+    elif intent == PROGRESS:
+        response = progress_reply(user_name, current_amount, goal_amount, percentage, remaining)
+    elif intent == TIP:
+        response = f"Here's a hydration tip: {pick(hydration_tips, user_input)}"
+    else:
+        response = f"Hydration fact: {pick(hydration_facts, user_input)}"
+    
+    record_route(intent, time.perf_counter() - start)
+    return response
+
+def fallback_reply(user_input, user_data=None, water_data=None):
+    """Answer an open-ended message from the canned responses, without calling Gemini"""
+    start = time.perf_counter()
+    response = canned_response(
+        user_input,
+        user_data.get('name', 'there') if user_data else 'there',
+        water_data.get('current_amount', 0) if water_data else 0,
+        water_data.get('goal', 2500) if water_data else 2500,
+        water_data.get('percentage', 0) if water_data else 0,
+        water_data.get('remaining', 0) if water_data else 0
+    )
+    record_route('canned', time.perf_counter() - start)
+    return response
+
+def pick(items, user_input):
+    """Choose a tip or fact, varying by message and day but stable for repeats of the same message"""
+    return items[(zlib.crc32(user_input.encode()) + date.today().toordinal()) % len(items)]
+
+def log_reply(percentage, water_added=True):
+    """Confirm a logged drink with the updated progress"""
+    if not water_added:
+        return "How much did you drink? Send something like \"add 250ml\" or \"2 glasses\" and I'll log it."
+    if percentage >= 100:
+        return f"Great job! I've updated your water intake. You've reached {percentage:.0f}% of your daily goal!"
+    elif percentage >= 75:
+        return f"Almost there! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
+    elif percentage >= 50:
+        return f"Halfway there! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
+    elif percentage >= 25:
+        return f"Good start! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
+    else:
+        return f"I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
 
-    # Check if the user just wanted to add water (simple command processing)
-    water_keywords = ['add', 'water', 'glass', 'cup', 'ml', 'bottle', 'drink']
-    if any(keyword in user_input.lower() for keyword in water_keywords) and len(user_input.split()) <= 4:
-        # If it's just an add water command, give a simple response about the update
-        if percentage >= 100:
-            return f"Great job! I've updated your water intake. You've reached {percentage:.0f}% of your daily goal!"
-        elif percentage >= 75:
-            return f"Almost there! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
-        elif percentage >= 50:
-            return f"Halfway there! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
-        elif percentage >= 25:
-            return f"Good start! I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
-        else:
-            return f"I've updated your water intake. You're at {percentage:.0f}% of your daily goal."
+def progress_reply(user_name, current_amount, goal_amount, percentage, remaining):
+    """Exact progress numbers for today"""
+    if remaining <= 0:
+        return f"You've reached your goal, {user_name}! You've had {current_amount}ml today, {percentage:.0f}% of your {goal_amount}ml target."
+    glasses_remaining = max(1, round(remaining / 250))
+    return (f"You've had {current_amount}ml today, {percentage:.0f}% of your {goal_amount}ml goal. "
+            f"You need {remaining}ml more, about {glasses_remaining} glass{'es' if glasses_remaining != 1 else ''}.")
+
+def gemini_prompt(user_input, user_data=None, water_data=None, history=None, token_budget=DEFAULT_TOKEN_BUDGET):
+    """
+    Build the Gemini prompt for a message, fitting history and supplemental facts into the token budget
+    
+    Returns:
+        (prompt, estimated tokens)
+    """
+    user_name = user_data.get('name', 'there') if user_data else 'there'
+    current_amount = water_data.get('current_amount', 0) if water_data else 0
+    goal_amount = water_data.get('goal', 2500) if water_data else 2500
+    percentage = water_data.get('percentage', 0) if water_data else 0
+    remaining = water_data.get('remaining', 0) if water_data else 0
     
     # Create a prompt for the Gemini API based on user's query and water data
-    prompt = f"""
+    preamble = f"""
 You are a helpful water intake assistant named WaterBuddy, helping a user track their hydration. 
 Be friendly, supportive, and provide useful information about hydration. Keep your responses concise and natural.
 
@@ -64,17 +153,30 @@ Respond to the user's message below. Here's some context:
 - Daily goal: {goal_amount}ml
 - Current progress: {percentage:.0f}%
 - Remaining water needed: {remaining}ml
-
-User's message: {user_input}
-
+"""
+    message = f"User's message: {user_input}"
+    footer = """
 Note: If the user is asking about water intake progress, be specific with the numbers. 
 If they're asking about hydration tips or benefits, provide valuable information.
+If the conversation so far is relevant, stay consistent with it.
 DO NOT mention that you're an AI or language model.
+Keep your response concise (1-3 sentences) and focused on helping them stay hydrated.
 """
+    supplements = [
+        f"Did you know? {random.choice(hydration_facts)}",
+        f"Helpful tip: {random.choice(hydration_tips)}"
+    ]
+    return build_prompt(preamble, message, footer, history, supplements, token_budget)
+
+def gemini_reply(user_input, user_data=None, water_data=None, history=None, token_budget=DEFAULT_TOKEN_BUDGET):
+    """Answer an open-ended message with the Gemini API"""
+    user_name = user_data.get('name', 'there') if user_data else 'there'
+    percentage = water_data.get('percentage', 0) if water_data else 0
+    prompt, _ = gemini_prompt(user_input, user_data, water_data, history, token_budget)
     
     # Get response from the API
     try:
-        return generate(prompt)
+        return generate(prompt, enhance=False)
     except Exception as e:
         # Fallback responses in case of API failure
         current_hour = datetime.now().hour
@@ -82,4 +184,29 @@ DO NOT mention that you're an AI or language model.
         
         fallback = f"Good {time_greeting}, {user_name}! I'm here to help you track your water intake. Currently you're at {percentage:.0f}% of your daily goal."
         print(f"API Error: {str(e)}")
-        return fallback 
\ No newline at end of file
+        return fallback 
+
+def record_route(path, seconds):
+    with _route_stats_lock:
+        stats = _route_stats.setdefault(path, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+def get_route_stats():
+    """
+    How chatbot replies were served in this process.
+    
+    Returns:
+        Dictionary with the fraction of replies served without Gemini and, per path,
+        the number of replies and their mean latency in milliseconds
+    """
+    with _route_stats_lock:
+        paths = {path: {'count': count, 'mean_ms': total * 1000 / count}
+                 for path, (count, total) in _route_stats.items()}
+    total = sum(stats['count'] for stats in paths.values())
+    local = total - paths.get('gemini', {}).get('count', 0)
+    return {
+        'total': total,
+        'local_fraction': local / total if total else 0.0,
+        'paths': paths
+    }
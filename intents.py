@@ -0,0 +1,463 @@
+"""
+Chat intent classifier for WaterBuddy
+This module routes chatbot messages the app can answer itself (progress, tips, facts, logging) away from Gemini
+
+The model is a multinomial naive Bayes over character n-grams and words. It is
+trained offline from TRAINING_EXAMPLES and stored as intent_model.json, which is
+loaded once per process:
+
+    python intents.py train      # rebuild intent_model.json and print accuracy
+    python intents.py classify "how much water have I had today?"
+"""
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'intent_model.json')
+MODEL_VERSION = 1
+
+# Intents answered locally; anything else (or anything below the threshold) is OPEN and goes to Gemini
+PROGRESS, TIP, FACT, LOG, OPEN = 'progress', 'tip', 'fact', 'log', 'open'
+LOCAL_INTENTS = (PROGRESS, TIP, FACT, LOG)
+
+NGRAM_RANGE = (3, 5)
+SMOOTHING = 0.5
+# Overlapping n-grams are far from independent, so raw naive Bayes posteriors are
+# close to 0 or 1. Scoring uses the mean log-likelihood per feature times TEMPERATURE,
+# which keeps the posterior usable as a confidence.
+TEMPERATURE = 5.0
+# Minimum posterior probability for a local intent to be trusted
+DEFAULT_THRESHOLD = 0.8
+
+TRAINING_EXAMPLES = {
+    PROGRESS: [
+        "how much water have i had today",
+        "how much have i drunk",
+        "what is my progress",
+        "how am i doing",
+        "how am i doing today",
+        "show my progress",
+        "am i on track",
+        "how close am i to my goal",
+        "how much more do i need",
+        "how much left",
+        "how much is left to drink",
+        "what's my water intake",
+        "what's my intake so far",
+        "did i reach my goal",
+        "have i hit my goal yet",
+        "how far from my goal am i",
+        "what percentage am i at",
+        "status",
+        "my stats",
+        "how many glasses left",
+        "how many more glasses should i drink today",
+        "remaining water",
+        "what is my daily goal",
+        "what's my goal",
+        "how much should i drink today",
+        "hydration level",
+        "check my hydration",
+        "where am i at with water",
+        "total for today",
+        "progress update please",
+        "how much water is left for today",
+        "how much do i still need to drink",
+        "how much did i drink today",
+        "how many ml have i had",
+        "what have i logged today",
+        "am i hydrated enough today",
+        "am i behind on my water",
+        "give me an update",
+        "how's my hydration going",
+        "what's my current intake",
+        "how much more until i hit my target",
+        "percent of goal",
+        "where do i stand today",
+        "did i drink enough today",
+        "how many glasses have i had",
+        "report my intake",
+        "today's total",
+        "show me my numbers",
+        "how much water so far",
+        "what's left to drink",
+    ],
+    TIP: [
+        "give me a tip",
+        "any tips",
+        "hydration tips",
+        "tip please",
+        "any advice",
+        "how can i drink more water",
+        "help me drink more water",
+        "how do i remember to drink water",
+        "suggest something to help me hydrate",
+        "ideas to drink more",
+        "i forget to drink water",
+        "i keep forgetting to drink",
+        "i don't like plain water what can i do",
+        "water is boring",
+        "how to make water taste better",
+        "how can i stay hydrated at work",
+        "advice for staying hydrated",
+        "tricks to drink more water",
+        "recommend a hydration habit",
+        "what should i do to hit my goal",
+        "motivate me",
+        "need some motivation to drink",
+        "give me a suggestion",
+        "how to build a water habit",
+        "best way to stay hydrated",
+        "tips for drinking more water",
+        "any hydration hacks",
+        "how do i drink water without forgetting",
+        "what can i do to drink more",
+        "help me stay on track with water",
+        "how do i make drinking water easier",
+        "suggestions for flavouring water",
+        "how can i reach my goal faster",
+        "i struggle to drink enough",
+        "what's a good hydration routine",
+        "how can i get my kids to drink more water",
+        "give me advice for hot days",
+        "remind me how to stay hydrated",
+        "can you give me some hydration advice",
+        "i need help drinking more",
+    ],
+    FACT: [
+        "tell me a fact",
+        "fun fact",
+        "water fact",
+        "give me a hydration fact",
+        "why is water important",
+        "why should i drink water",
+        "benefits of drinking water",
+        "what are the benefits of hydration",
+        "is water good for my health",
+        "how does water help my body",
+        "did you know something about water",
+        "teach me something about hydration",
+        "interesting fact about water",
+        "why does hydration matter",
+        "what happens when i'm dehydrated",
+        "effects of dehydration",
+        "signs of dehydration",
+        "how much of the body is water",
+        "does water help my brain",
+        "health benefits of water",
+        "importance of hydration",
+        "tell me something interesting",
+        "share a fact",
+        "why do we need water",
+        "give me a water fact",
+        "what are the benefits of water",
+        "why is hydration good for you",
+        "why is staying hydrated important",
+        "how does dehydration affect me",
+        "what does water do for skin",
+        "tell me a hydration fact",
+        "something i don't know about water",
+        "facts about hydration",
+        "why is drinking water healthy",
+        "how does water affect my mood",
+        "why does my body need water",
+        "random fact",
+        "educate me about hydration",
+        "what are the symptoms of dehydration",
+    ],
+    LOG: [
+        "add",
+        "add water",
+        "add 250ml",
+        "add 300 ml",
+        "add a glass",
+        "add a glass of water",
+        "add 2 glasses",
+        "add one bottle",
+        "add 1 bottle of water",
+        "250",
+        "500ml",
+        "i drank a glass of water",
+        "i just drank 300ml",
+        "just had a bottle of water",
+        "drank 2 cups",
+        "had a cup of water",
+        "log 200ml",
+        "log a glass",
+        "record 400 ml",
+        "i had some water",
+        "finished my water bottle",
+        "another glass",
+        "one more cup",
+        "add 750",
+        "glass of water",
+        "drink 250 ml",
+        "i drank 500ml",
+        "add 1 cup",
+        "add two glasses",
+        "put in 250ml",
+        "log water",
+        "i had a glass",
+        "drank a bottle",
+        "add 100",
+        "i just finished a glass of water",
+        "had 2 bottles of water",
+        "add half a litre",
+        "record a cup",
+        "track 300ml",
+        "add my water",
+    ],
+    OPEN: [
+        "hello",
+        "hi there",
+        "good morning",
+        "who are you",
+        "what can you do",
+        "thanks",
+        "thank you so much",
+        "can i count coffee towards my water",
+        "does tea count as water",
+        "is sparkling water as good as still water",
+        "should i drink more when it's hot outside",
+        "how much water should a marathon runner drink",
+        "is it possible to drink too much water",
+        "i'm pregnant how much should i drink",
+        "can drinking water help me lose weight",
+        "what about electrolytes after a workout",
+        "is tap water safe to drink",
+        "i have a headache what should i do",
+        "can you explain how my goal was calculated",
+        "why is my goal so high",
+        "what's the weather like",
+        "tell me a joke",
+        "i feel tired all the time is it dehydration",
+        "should kids drink the same amount",
+        "does alcohol dehydrate you",
+        "write me a poem about water",
+        "what's the difference between mineral and distilled water",
+        "i work night shifts when should i drink",
+        "how much water should i drink if i have kidney problems",
+        "how much water does a dog need",
+        "how much coffee is too much",
+        "how much caffeine is in tea",
+        "is it bad to drink water right before bed",
+        "should i drink water during meals",
+        "is cold water better than warm water",
+        "can i drink water from a river",
+        "is bottled water better than tap",
+        "do sports drinks hydrate better",
+        "what's the best water filter",
+        "why does water taste weird sometimes",
+        "can you help me plan my meals",
+        "what should i eat before running",
+        "can i change my goal",
+        "how do i reset my password",
+        "what does this app do",
+        "are you a real person",
+        "how are you",
+        "good night",
+        "ok",
+        "cool",
+        "i'm going for a hike tomorrow",
+        "i have a fever should i drink more",
+        "is milk hydrating",
+        "can fruit juice count",
+        "how is my goal calculated from my weight",
+        "my doctor told me to limit fluids",
+        "i am training for a marathon",
+        "what is hyponatremia",
+        "can you set a reminder for me",
+        "explain the calendar",
+        "what do the badges mean",
+        "how long does it take to rehydrate",
+        "is coconut water good",
+        "do i need more water at high altitude",
+        "what time is it",
+        "tell me about yourself",
+        # Near misses: they mention tips, facts, drinking or intake, but need Gemini
+        "what's a fun fact about space",
+        "tell me something interesting about cats",
+        "give me a tip for studying",
+        "any advice on getting to sleep",
+        "tips for running faster",
+        "what is an electrolyte",
+        "how does alcohol affect hydration",
+        "does caffeine dehydrate you",
+        "how does salt affect my thirst",
+        "how does exercise change how much i need",
+        "how much did i drink last monday",
+        "what did i drink on friday",
+        "show me last week's intake",
+        "i just had breakfast",
+        "i ate a sandwich",
+        "i went for a run",
+        "what is my name",
+        "what's my weight",
+    ],
+}
+
+
+def tokenize(text):
+    """Character n-grams of the padded, normalized text plus whole words"""
+    text = re.sub(r'\d+', '0', text.lower())
+    text = ' ' + re.sub(r"[^a-z0' ]+", ' ', text).strip() + ' '
+    text = re.sub(r' +', ' ', text)
+    features = ['w:' + word for word in text.split()]
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        features.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return features
+
+
+def train(examples=TRAINING_EXAMPLES, threshold=DEFAULT_THRESHOLD, temperature=TEMPERATURE):
+    """
+    Fit the naive Bayes model.
+
+    Returns:
+        The compiled model as a JSON-serializable dict
+    """
+    counts = {intent: Counter() for intent in examples}
+    for intent, messages in examples.items():
+        for message in messages:
+            counts[intent].update(tokenize(message))
+
+    vocabulary = set()
+    for counter in counts.values():
+        vocabulary.update(counter)
+
+    total_examples = sum(len(messages) for messages in examples.values())
+    model = {
+        'version': MODEL_VERSION,
+        'threshold': threshold,
+        'temperature': temperature,
+        'priors': {},
+        'unseen': {},
+        'log_probs': {},
+    }
+    for intent, counter in counts.items():
+        denominator = sum(counter.values()) + SMOOTHING * len(vocabulary)
+        model['priors'][intent] = math.log(len(examples[intent]) / total_examples)
+        model['unseen'][intent] = math.log(SMOOTHING / denominator)
+        model['log_probs'][intent] = {
+            feature: round(math.log((count + SMOOTHING) / denominator), 5)
+            for feature, count in counter.items()
+        }
+    return model
+
+
+class IntentClassifier:
+    """Scores messages against a compiled model from train()"""
+
+    def __init__(self, model):
+        self.threshold = model['threshold']
+        self.temperature = model['temperature']
+        self.priors = model['priors']
+        self.unseen = model['unseen']
+        self.log_probs = model['log_probs']
+        self.vocabulary = set()
+        for table in self.log_probs.values():
+            self.vocabulary.update(table)
+
+    def scores(self, message):
+        """Posterior probability of each intent"""
+        features = [feature for feature in tokenize(message) if feature in self.vocabulary]
+        scale = self.temperature / max(1, len(features))
+        log_scores = {}
+        for intent, table in self.log_probs.items():
+            unseen = self.unseen[intent]
+            likelihood = sum(table.get(feature, unseen) for feature in features)
+            log_scores[intent] = self.priors[intent] + scale * likelihood
+
+        top = max(log_scores.values())
+        exp_scores = {intent: math.exp(score - top) for intent, score in log_scores.items()}
+        total = sum(exp_scores.values())
+        return {intent: value / total for intent, value in exp_scores.items()}
+
+    def classify(self, message):
+        """
+        Pick the intent for a chat message.
+
+        Returns:
+            (intent, probability); intent is OPEN unless a local intent clears the threshold
+        """
+        scores = self.scores(message)
+        intent = max(scores, key=scores.get)
+        if intent != OPEN and scores[intent] < self.threshold:
+            return OPEN, scores[intent]
+        return intent, scores[intent]
+
+
+_classifier = None
+
+
+def get_classifier():
+    """The process-wide classifier, loaded from intent_model.json on first use"""
+    global _classifier
+    if _classifier is None:
+        try:
+            with open(MODEL_PATH) as f:
+                model = json.load(f)
+            if model.get('version') != MODEL_VERSION:
+                raise ValueError(f"unsupported model version {model.get('version')}")
+        except (OSError, ValueError) as e:
+            print(f"Intent model unavailable ({str(e)}), training from built-in examples")
+            model = train()
+        _classifier = IntentClassifier(model)
+    return _classifier
+
+
+def classify(message):
+    return get_classifier().classify(message)
+
+
+def cross_validate(examples=TRAINING_EXAMPLES, folds=5):
+    """Accuracy per intent with k-fold cross-validation over the training examples"""
+    correct, seen = Counter(), Counter()
+    for fold in range(folds):
+        train_set = defaultdict(list)
+        test_set = []
+        for intent, messages in examples.items():
+            for i, message in enumerate(messages):
+                if i % folds == fold:
+                    test_set.append((intent, message))
+                else:
+                    train_set[intent].append(message)
+        classifier = IntentClassifier(train(train_set))
+        for intent, message in test_set:
+            seen[intent] += 1
+            correct[intent] += classifier.classify(message)[0] == intent
+    return {intent: correct[intent] / seen[intent] for intent in examples}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WaterBuddy chat intent classifier')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='rebuild intent_model.json')
+    train_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    classify_parser = subparsers.add_parser('classify', help='classify messages with the saved model')
+    classify_parser.add_argument('messages', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'train':
+        for intent, accuracy in cross_validate().items():
+            print(f"  {intent:<9} {accuracy:6.1%} (5-fold)")
+        model = train(threshold=args.threshold)
+        with open(MODEL_PATH, 'w') as f:
+            json.dump(model, f, separators=(',', ':'), sort_keys=True)
+        features = sum(len(table) for table in model['log_probs'].values())
+        print(f"Wrote {MODEL_PATH} ({features} features, threshold {args.threshold})")
+    else:
+        for message in args.messages:
+            intent, probability = classify(message)
+            print(f"{intent:<9} {probability:.2f}  {message}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
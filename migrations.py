@@ -0,0 +1,87 @@
+"""
+Schema and data migrations for WaterBuddy
+db.create_all() only creates missing tables, so new columns on existing tables are added here
+"""
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import inspect, text
+
+from database import db, IntakeEvent, bump_data_version
+from timezones import to_local_date
+from write_buffer import apply_intake_deltas
+
+# (table, column, column DDL) added after the table was first created
+SCHEMA_ADDITIONS = [
+    ('users', 'timezone', 'timezone VARCHAR(64)'),
+    ('users', 'data_version', 'data_version INTEGER NOT NULL DEFAULT 0'),
+    ('water_intakes', 'version', 'version INTEGER NOT NULL DEFAULT 0'),
+    ('water_reminders', 'next_reminder_at', 'next_reminder_at DATETIME'),
+]
+
+# (table, index name, indexed columns) added after the table was first created
+SCHEMA_INDEXES = [
+    ('water_intakes', 'ix_water_intakes_user_date', 'user_id, date'),
+]
+
+
+def upgrade_schema():
+    """Add any columns from SCHEMA_ADDITIONS and indexes from SCHEMA_INDEXES that any shard is missing"""
+    added = []
+    for shard_id, engine in db.shard_engines().items():
+        inspector = inspect(engine)
+        tables = set(inspector.get_table_names())
+        for table, column, ddl in SCHEMA_ADDITIONS:
+            if table not in tables:
+                continue
+            if column not in {col['name'] for col in inspector.get_columns(table)}:
+                db.execute_on(shard_id, text(f'ALTER TABLE {table} ADD COLUMN {ddl}'))
+                added.append(f'{table}.{column}')
+        for table, index, columns in SCHEMA_INDEXES:
+            if table not in tables:
+                continue
+            if index not in {idx['name'] for idx in inspector.get_indexes(table)}:
+                db.execute_on(shard_id, text(f'CREATE INDEX {index} ON {table} ({columns})'))
+                added.append(index)
+    db.session.commit()
+    return list(dict.fromkeys(added))
+
+
+def change_user_timezone(user, tz_name):
+    """
+    Set a user's timezone and re-bucket their history into the new local dates.
+
+    Only intake logged as timestamped events (device batches) can be moved;
+    daily totals entered through the web UI have no time of day and keep their date.
+    Events whose old or new date is archived keep their date too: archived
+    totals cannot be reduced, and taking intake out of the hot table would
+    leave a negative row there.
+
+    Returns:
+        The number of events whose day changed
+    """
+    old_tz = user.timezone
+    if old_tz == tz_name:
+        return 0
+
+    archive = current_app.extensions.get('intake_archive')
+    archived_before = archive.newest_cutoff() if archive is not None else None
+
+    deltas = defaultdict(int)
+    moved = 0
+    for event in IntakeEvent.query.filter_by(user_id=user.id):
+        old_date = to_local_date(old_tz, event.recorded_at)
+        new_date = to_local_date(tz_name, event.recorded_at)
+        if archived_before is not None and min(old_date, new_date) < archived_before:
+            continue
+        if old_date != new_date:
+            deltas[(user.id, old_date)] -= event.amount
+            deltas[(user.id, new_date)] += event.amount
+            moved += 1
+
+    if deltas:
+        apply_intake_deltas(deltas, commit=False)
+    user.timezone = tz_name
+    bump_data_version(user.id)
+    db.session.commit()
+    return moved
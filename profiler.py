@@ -0,0 +1,273 @@
+"""
+Sampling profiler for WaterBuddy
+This module samples the stacks of in-flight requests and background tasks so slow routes can be diagnosed in production
+
+Nothing runs until an admin starts a session (see the /admin/profiler routes).
+While a session is active, a daemon thread wakes every interval, reads the
+current frame of every thread with sys._current_frames() and records the
+stacks of threads that are serving a request or running a task. Each sample is
+attributed to its Flask endpoint (or task) and to what it was doing: waiting on
+SQL (SQLAlchemy or sqlite3 frames on the stack), on Gemini, or running Python.
+
+Output is in the collapsed-stack format read by flamegraph.pl and speedscope:
+    endpoint:main.insights;sql;flask.app.Flask.full_dispatch_request;...;sqlalchemy.orm.query.Query.all;... 42
+
+Overhead: each tick holds the GIL while the sampler walks stacks, about
+100 us at the default 10 ms interval (1% of one CPU, measured with
+`benchmark.py profile`; request latency changed by less than the run-to-run
+noise). The sampler measures its own CPU time and doubles its interval whenever
+that exceeds PROFILER_MAX_OVERHEAD (default 2%) of wall time, and sessions are
+capped at PROFILER_MAX_SECONDS. While a session runs the GIL switch interval is
+lowered to 0.5 ms so samples are not taken only when a thread blocks; even so,
+calls that release the GIL (sqlite3, network I/O) are somewhat over-represented,
+so read the sql and gemini shares as upper bounds. With no session active the
+only cost is one attribute check per request.
+"""
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+# Deepest stack recorded per sample; deeper stacks keep their innermost frames
+MAX_DEPTH = 64
+# The interval never backs off beyond this
+MAX_INTERVAL = 0.1
+# GIL switch interval while sampling (CPython's default is 5 ms)
+SWITCH_INTERVAL = 0.0005
+
+# Module name prefixes identifying what a sample is waiting on, checked innermost frame first
+CATEGORIES = [
+    ('gemini', ('gemini_api', 'google.generativeai', 'google.ai.')),
+    ('sql', ('sqlalchemy.', 'sqlite3')),
+]
+
+
+def frame_label(frame):
+    """module.qualified_name of the function a frame is running"""
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def categorize(labels):
+    """'gemini', 'sql' or 'python' for a stack, given its frame labels innermost first"""
+    for label in labels:
+        for category, prefixes in CATEGORIES:
+            if label.startswith(prefixes):
+                return category
+    return 'python'
+
+
+class _Session:
+    """Samples collected between start() and the deadline or stop()"""
+
+    def __init__(self, seconds, interval, endpoint, fraction):
+        self.started = time.time()
+        self.deadline = time.monotonic() + seconds
+        self.seconds = seconds
+        self.interval = interval
+        self.endpoint = endpoint
+        self.fraction = fraction
+        self.stacks = Counter()
+        self.totals = Counter()
+        self.seconds_by_root = Counter()
+        self.ticks = 0
+        self.cpu = 0.0
+        self.wall = 0.0
+        self.stopped = threading.Event()
+
+    def overhead(self):
+        return self.cpu / self.wall if self.wall else 0.0
+
+
+class SamplingProfiler:
+    """
+    Flask extension sampling request and task stacks on demand.
+
+    start() begins a session for a number of seconds, either for every request
+    or for a sampled fraction of requests to one endpoint; background tasks are
+    sampled only in the first case. The last finished session is kept until the
+    next one starts, for collapsed() and summary().
+    """
+
+    def __init__(self, app=None, interval_ms=10, max_seconds=300, max_overhead=0.02):
+        self.interval_ms = interval_ms
+        self.max_seconds = max_seconds
+        self.max_overhead = max_overhead
+        self.session = None
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        # The process's switch interval from before sampling, while it is lowered
+        self._switch_interval = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval_ms = app.config.get('PROFILER_INTERVAL_MS', self.interval_ms)
+        self.max_seconds = app.config.get('PROFILER_MAX_SECONDS', self.max_seconds)
+        self.max_overhead = app.config.get('PROFILER_MAX_OVERHEAD', self.max_overhead)
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['profiler'] = self
+
+    @property
+    def active(self):
+        session = self.session
+        return session is not None and not session.stopped.is_set()
+
+    def _before_request(self):
+        session = self.session
+        if session is None or session.stopped.is_set():
+            return
+        if session.endpoint is not None and request.endpoint != session.endpoint:
+            return
+        if session.fraction < 1 and random.random() >= session.fraction:
+            return
+        self._requests[threading.get_ident()] = f"endpoint:{request.endpoint}"
+
+    def _teardown_request(self, exc):
+        self._requests.pop(threading.get_ident(), None)
+
+    def start(self, seconds=30, interval_ms=None, endpoint=None, fraction=1.0):
+        """
+        Start a profiling session, replacing the results of the previous one.
+
+        Args:
+            seconds: How long to sample, capped at PROFILER_MAX_SECONDS
+            interval_ms: Time between samples (default PROFILER_INTERVAL_MS)
+            endpoint: Only profile requests to this endpoint, e.g. 'main.insights'
+            fraction: Share of matching requests to profile, from 0 to 1
+
+        Returns:
+            False if a session is already running
+        """
+        with self._lock:
+            if self.active:
+                return False
+            if self._sampler is not None:
+                # The last session ran out; its sampler may still be restoring the switch interval
+                self._sampler.join()
+            interval = max(1, interval_ms or self.interval_ms) / 1000
+            session = _Session(min(seconds, self.max_seconds), interval, endpoint, fraction)
+            self._requests.clear()
+            self.session = session
+            # A sampler waiting for the GIL only gets it when the running thread
+            # blocks (e.g. in sqlite3) or after the switch interval, which skews
+            # samples towards I/O; a short interval makes the sample points fair
+            if self._switch_interval is None:
+                self._switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(self._switch_interval, SWITCH_INTERVAL))
+            self._sampler = threading.Thread(target=self._run, args=(session,), name='waterbuddy-profiler',
+                                             daemon=True)
+            self._sampler.start()
+        return True
+
+    def stop(self):
+        with self._lock:
+            session = self.session
+            if session is not None:
+                session.stopped.set()
+            if self._sampler is not None:
+                self._sampler.join()
+                self._sampler = None
+            self._restore_switch_interval()
+            self._requests.clear()
+
+    def _restore_switch_interval(self):
+        # Called with the lock held
+        if self._switch_interval is not None:
+            sys.setswitchinterval(self._switch_interval)
+            self._switch_interval = None
+
+    def _run(self, session):
+        own = threading.get_ident()
+        wall_start = time.monotonic()
+        while not session.stopped.is_set() and time.monotonic() < session.deadline:
+            cpu_start = time.thread_time()
+            self._sample(session, own)
+            session.cpu += time.thread_time() - cpu_start
+            session.wall = time.monotonic() - wall_start
+            session.ticks += 1
+
+            # Back off if sampling costs more than the overhead budget (judged after the first second)
+            if session.wall > 1 and session.overhead() > self.max_overhead and session.interval < MAX_INTERVAL:
+                session.interval = min(session.interval * 2, MAX_INTERVAL)
+            session.stopped.wait(session.interval)
+        session.wall = time.monotonic() - wall_start
+        session.stopped.set()
+        # Ran out without stop(): restore the switch interval now unless start()
+        # or stop() holds the lock, in which case it joins this thread and restores it
+        if self._lock.acquire(blocking=False):
+            try:
+                self._restore_switch_interval()
+            finally:
+                self._lock.release()
+
+    def _sample(self, session, own):
+        requests = self._requests
+        sample_tasks = session.endpoint is None
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            root = requests.get(ident)
+            if root is None and not sample_tasks:
+                continue
+
+            labels = []
+            while frame is not None:
+                code = frame.f_code
+                if root is None and code.co_name == '_run' and frame.f_globals.get('__name__') == 'task_queue':
+                    # The frame just inside TaskQueue._run is the task function
+                    if labels:
+                        root = f"task:{labels[-1].rsplit('.', 1)[-1]}"
+                    break
+                if code.co_name == 'wsgi_app' and root is not None:
+                    break  # everything outside Flask is the server's
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            if root is None:
+                continue  # idle or unrelated thread
+
+            category = categorize(labels)
+            stack = ';'.join([root, category] + labels[:MAX_DEPTH][::-1])
+            session.stacks[stack] += 1
+            session.totals[(root, category)] += 1
+            # Each sample stands for about one interval of that thread's time
+            session.seconds_by_root[root] += session.interval
+
+    def collapsed(self):
+        """Samples of the current or last session in collapsed-stack format, one stack per line"""
+        session = self.session
+        if session is None:
+            return ''
+        return ''.join(f"{stack} {count}\n" for stack, count in session.stacks.most_common())
+
+    def summary(self):
+        """State of the current or last session, with samples and estimated time per endpoint and category"""
+        session = self.session
+        if session is None:
+            return {'active': False}
+
+        endpoints = {}
+        for (root, category), count in session.totals.items():
+            entry = endpoints.setdefault(root, {'samples': 0, 'categories': {}})
+            entry['samples'] += count
+            entry['categories'][category] = count
+        for root, entry in endpoints.items():
+            entry['estimated_ms'] = round(session.seconds_by_root[root] * 1000)
+
+        return {
+            'active': not session.stopped.is_set(),
+            'started': session.started,
+            'seconds': session.seconds,
+            'endpoint': session.endpoint,
+            'fraction': session.fraction,
+            'interval_ms': round(session.interval * 1000, 2),
+            'ticks': session.ticks,
+            'samples': sum(session.stacks.values()),
+            'overhead': round(session.overhead(), 4),
+            'endpoints': endpoints,
+        }
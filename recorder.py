@@ -0,0 +1,202 @@
+"""
+Traffic recorder for WaterBuddy
+This module logs the shape of production requests to JSONL so they can be replayed against a new build with replay.py
+
+Recording is off unless TRAFFIC_LOG names a file. Each request handled by the
+app becomes one line:
+
+    {"t": 1700000000.123, "method": "POST", "endpoint": "main.add_water", "path": "/add_water",
+     "query": {}, "body_type": "json", "body": {"amount": 250}, "status": 200, "ms": 3.1, "user": 417}
+
+Nothing identifying is kept. Numbers, booleans and numeric strings (form
+fields) are recorded as they are, since amounts and intervals shape the work a
+request does, except profile measurements (BUCKETED_NUMBERS: age, weight,
+height), which are rounded to a coarse step. Other strings become
+{"$text": length} unless their key is in SAFE_STRINGS, chat messages also keep
+the intent the classifier gives them, and users are reduced to one of
+TRAFFIC_USER_BUCKETS buckets by a hash keyed with TRAFFIC_HASH_KEY, so a
+replay keeps each user's sequence of requests without knowing who they were.
+Without TRAFFIC_HASH_KEY each process draws a random key when recording
+starts; set it when several workers record, so a user (or a retried event)
+hashes the same in all of them, and keep it out of the repository. Sync events keep what the server checks: a timestamp becomes
+{"$time": seconds relative to the request, "format": "iso" or "unix"}, and an
+event id becomes {"$id": keyed hash}, so replay.py can send current timestamps
+and fresh ids while retried events stay duplicates of each other.
+Requests carrying secrets (API keys, admin tokens) are not recorded.
+
+Files rotate at TRAFFIC_LOG_MAX_BYTES, keeping TRAFFIC_LOG_BACKUPS old files
+(traffic.jsonl.1, .2, ...). The cost per recorded request is one JSON dump and
+one buffered write.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import re
+import secrets
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import g, request, session
+
+# Strings safe to keep verbatim, when short: timezone names and enum-like fields
+SAFE_STRINGS = {'timezone', 'unit', 'state'}
+MAX_SAFE_LENGTH = 64
+NUMBER = re.compile(r'-?\d+(\.\d+)?')
+# Numbers that describe a person, recorded rounded to the nearest multiple of their step
+BUCKETED_NUMBERS = {'age': 10, 'weight': 10, 'height': 10}
+
+# Endpoints never recorded because their requests carry secrets
+SKIPPED_ENDPOINTS = {'main.set_gemini_api_key', 'main.test_gemini'}
+SKIPPED_PREFIXES = ('/admin/',)
+
+
+def sanitize(value, key=None, now=None, id_key=b''):
+    """
+    A copy of a request payload with every free-text string replaced by its length.
+
+    Args:
+        value: The payload
+        key: The key the value was found under
+        now: Unix time of the request, which recorded timestamps are relative to
+        id_key: Secret for hashing event ids
+    """
+    if isinstance(value, dict):
+        return {k: sanitize(v, k, now, id_key) for k, v in value.items()}
+    if isinstance(value, list):
+        return [sanitize(item, key, now, id_key) for item in value]
+    if key == 'timestamp' and now is not None:
+        offset = timestamp_offset(value, now)
+        if offset is not None:
+            return offset
+    if key == 'event_id' and isinstance(value, str):
+        return {'$id': hmac.new(id_key, value.encode(), hashlib.sha256).hexdigest()[:16]}
+    if key in BUCKETED_NUMBERS:
+        bucketed = bucket_number(value, BUCKETED_NUMBERS[key])
+        if bucketed is not None:
+            return bucketed
+    if isinstance(value, str):
+        if NUMBER.fullmatch(value) or (key in SAFE_STRINGS and len(value) <= MAX_SAFE_LENGTH):
+            return value
+        if key == 'message':
+            from intents import classify
+            intent, _ = classify(value.lower())
+            return {'$text': len(value), 'intent': intent}
+        return {'$text': len(value)}
+    return value
+
+
+def bucket_number(value, step):
+    """A number, or numeric string, rounded to a multiple of step (a string stays a string); None if it is neither"""
+    if isinstance(value, str) and NUMBER.fullmatch(value):
+        return str(bucket_number(float(value), step))
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return step * round(value / step)
+    return None
+
+
+def timestamp_offset(value, now):
+    """{"$time": seconds from now, "format": ...} for an ISO 8601 or Unix timestamp, or None if it is neither"""
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return {'$time': round(value - now, 3), 'format': 'unix'}
+        if isinstance(value, str):
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return {'$time': round(parsed.timestamp() - now, 3), 'format': 'iso'}
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
+
+
+class TrafficRecorder:
+    """
+    Flask extension appending sanitized request records to a rotating JSONL file.
+
+    No hooks are registered unless TRAFFIC_LOG is set, so the recorder costs
+    nothing when it is off. TRAFFIC_SAMPLE_RATE records only a share of requests.
+    """
+
+    def __init__(self, app=None, max_bytes=50 * 1024 * 1024, backups=5, sample_rate=1.0, user_buckets=1024):
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self.user_buckets = user_buckets
+        self.path = None
+        self._key = b''
+        self._log = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get('TRAFFIC_LOG')
+        self.max_bytes = app.config.get('TRAFFIC_LOG_MAX_BYTES', self.max_bytes)
+        self.backups = app.config.get('TRAFFIC_LOG_BACKUPS', self.backups)
+        self.sample_rate = app.config.get('TRAFFIC_SAMPLE_RATE', self.sample_rate)
+        self.user_buckets = app.config.get('TRAFFIC_USER_BUCKETS', self.user_buckets)
+        app.extensions['traffic_recorder'] = self
+        if not self.path:
+            return
+
+        # Bucket and event id hashes are keyed so they cannot be matched to ids by enumeration;
+        # not with the secret key, which is in the repository
+        hash_key = app.config.get('TRAFFIC_HASH_KEY')
+        self._key = hash_key.encode() if hash_key else secrets.token_bytes(32)
+        handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                      encoding='utf-8', delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._log = logging.getLogger(f'waterbuddy.traffic.{self.path}')
+        self._log.handlers = [handler]
+        self._log.setLevel(logging.INFO)
+        self._log.propagate = False
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def user_bucket(self, user_id):
+        digest = hmac.new(self._key, str(user_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') % self.user_buckets
+
+    def _before_request(self):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if request.endpoint in SKIPPED_ENDPOINTS or request.path.startswith(SKIPPED_PREFIXES):
+            return
+        g.traffic_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.pop('traffic_started', None)
+        if started is None:
+            return response
+        try:
+            self._log.info(json.dumps(self.record(response, started), separators=(',', ':')))
+        except Exception as e:
+            print(f"Traffic recording failed: {str(e)}")
+        return response
+
+    def record(self, response, started):
+        """The sanitized record of the current request"""
+        now = time.time()
+        if request.is_json:
+            body_type, body = 'json', sanitize(request.get_json(silent=True), now=now, id_key=self._key)
+        elif request.form:
+            body_type, body = 'form', sanitize(request.form.to_dict(), now=now, id_key=self._key)
+        else:
+            body_type, body = None, None
+
+        # Paths with arguments (e.g. task ids) are recorded as their rule
+        path = request.url_rule.rule if request.url_rule and request.view_args else request.path
+        user_id = session.get('user_id')
+        return {
+            't': round(now, 3),
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'path': path,
+            'query': sanitize(request.args.to_dict()),
+            'body_type': body_type,
+            'body': body,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - started) * 1000, 2),
+            'user': self.user_bucket(user_id) if user_id is not None else None,
+        }
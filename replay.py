@@ -0,0 +1,351 @@
+"""
+Traffic replay for WaterBuddy
+Replays a capture from recorder.py against a copy of the database and compares latency and throughput between builds
+
+Usage:
+    python replay.py run traffic.jsonl [traffic.jsonl.1 ...] [--db water_tracker.db] [--speedup 10]
+                     [--concurrency 8] [--limit N] [--gemini-latency 1.0] [--app-dir .] [--out run.json]
+    python replay.py compare baseline.json candidate.json
+    python replay.py ab traffic.jsonl --baseline ../waterbuddy-main [--candidate .] [run options]
+
+`run` copies the database (water_tracker.db itself is never written), builds
+the app from --app-dir and sends each recorded request at its recorded offset
+divided by --speedup (0 sends as fast as the workers allow) through a pool of
+--concurrency threads standing in for the WSGI server's. Latency is measured
+from the request's scheduled time, so it includes any wait for a free thread
+(with --speedup 0, from when a thread picks the request up).
+
+Each recorded user bucket is replayed as one existing user of the copy (or a
+new user if the copy has none), free text is replaced by filler of the recorded
+length and chat messages by a sample of the recorded intent. Event timestamps
+are regenerated at the same offset from the moment the request is sent, in the
+recorded format, and each recorded event id gets a fresh unique id for the run
+(a retried event keeps its one id, so it is still deduplicated). Gemini is replaced
+by a stand-in that sleeps --gemini-latency seconds, so replays never call the API.
+
+`ab` runs the same capture against two checkouts, each in its own process,
+and prints the comparison.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Stand-in messages for recorded chat intents
+INTENT_MESSAGES = {
+    'progress': "how much water have i had so far today?",
+    'tip': "got any tips for drinking more?",
+    'fact': "tell me a fun fact about water",
+    'log': "i just drank a glass of water",
+    'open': "what should i drink before a long run?",
+}
+
+
+def load_capture(paths, limit=None):
+    """Records from one or more capture files (e.g. a file and its rotated backups), oldest first"""
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['t'])
+    return records[:limit] if limit else records
+
+
+def restore(value, now=None, event_ids=None):
+    """
+    A request payload with the sanitized values filled back in.
+
+    Args:
+        value: The recorded payload
+        now: Unix time the request is sent at (default: now), for recorded timestamps
+        event_ids: Recorded event id hash -> id used in this run, shared by every request of the run
+    """
+    if isinstance(value, dict):
+        if '$text' in value:
+            if 'intent' in value:
+                return INTENT_MESSAGES.get(value['intent'], INTENT_MESSAGES['open'])
+            return 'x' * value['$text']
+        if '$time' in value:
+            moment = (now or time.time()) + value['$time']
+            if value.get('format') == 'unix':
+                return moment
+            return datetime.fromtimestamp(moment, timezone.utc).isoformat().replace('+00:00', 'Z')
+        if '$id' in value:
+            if event_ids is None:
+                return uuid.uuid4().hex
+            return event_ids.setdefault(value['$id'], uuid.uuid4().hex)
+        return {k: restore(v, now, event_ids) for k, v in value.items()}
+    if isinstance(value, list):
+        return [restore(item, now, event_ids) for item in value]
+    return value
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2),
+    }
+
+
+@contextmanager
+def working_directory(path):
+    """Run the block in path, then go back to the current directory"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def load_app(app_dir, db_path):
+    """Import the app from app_dir and build it against db_path, with its tables up to date"""
+    sys.path.insert(0, app_dir)
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('TEMPLATE_CACHE_DIR', os.path.join(os.path.dirname(db_path), 'jinja_cache'))
+    os.environ['SESSION_DB'] = os.path.join(os.path.dirname(db_path), 'sessions.db')
+    # Background refreshes would compete with the replay for the database
+    os.environ.setdefault('COHORT_REFRESH_SECONDS', '0')
+    os.environ.setdefault('REMINDER_PLAN_SECONDS', '0')
+    os.environ.pop('TRAFFIC_LOG', None)
+    os.environ.pop('GEMINI_API_KEY', None)
+    with working_directory(app_dir):
+        import app as app_module
+        if hasattr(app_module, 'create_app'):
+            app = app_module.create_app()
+        else:
+            # Builds from before the app factory configure a module-level app when imported
+            app = app_module.app
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+        with app.app_context():
+            app_module.db.create_all()
+            if hasattr(app_module, 'upgrade_schema'):
+                app_module.upgrade_schema()
+    return app_module, app
+
+
+def replay_users(app_module, app, buckets):
+    """Map each recorded user bucket to a user id in the database copy"""
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in app_module.db.session.query(app_module.User.id).order_by(app_module.User.id)]
+        if not user_ids:
+            for bucket in buckets:
+                user = app_module.User(name=f'Replay {bucket}', age=30, weight=70.0, height=175.0, profession='developer')
+                app_module.db.session.add(user)
+                app_module.db.session.commit()
+                if hasattr(app_module, 'calculate_water_goal'):
+                    app_module.calculate_water_goal(user)
+                user_ids.append(user.id)
+    return {bucket: user_ids[i % len(user_ids)] for i, bucket in enumerate(sorted(buckets))}
+
+
+def run(args):
+    """Replay a capture against one build and write the results as JSON"""
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        print("capture is empty")
+        return 1
+
+    workdir = tempfile.mkdtemp(prefix='waterbuddy-replay-')
+    db_path = os.path.join(workdir, 'replay.db')
+    shutil.copyfile(os.path.abspath(args.db), db_path)
+    app_module, app = load_app(os.path.abspath(args.app_dir), db_path)
+
+    # Stand-in for the Gemini API: a slow network call
+    import gemini_helper
+    def slow_generate(prompt, enhance=True):
+        time.sleep(args.gemini_latency)
+        return "Stay hydrated!"
+    gemini_helper.generate = slow_generate
+
+    users = replay_users(app_module, app, {record['user'] for record in records if record['user'] is not None})
+    clients = {}
+    for bucket, user_id in users.items():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        clients[bucket] = client
+    anonymous = threading.local()
+    event_ids = {}
+
+    def send(record, scheduled):
+        scheduled = scheduled or time.perf_counter()
+        if record['user'] is None:
+            if not hasattr(anonymous, 'client'):
+                anonymous.client = app.test_client()
+            client = anonymous.client
+        else:
+            client = clients[record['user']]
+        path = re.sub(r'<[^>]+>', 'replay', record['path'])
+        now = time.time()
+        body = restore(record['body'], now, event_ids)
+        kwargs = {'query_string': restore(record['query'], now, event_ids)}
+        if record['body_type'] == 'json':
+            kwargs['json'] = body
+        elif record['body_type'] == 'form':
+            kwargs['data'] = body
+        response = client.open(path, method=record['method'], **kwargs)
+        latency = time.perf_counter() - scheduled
+        if record['endpoint'] == 'main.logout' and record['user'] is not None:
+            # Keep the bucket logged in for its later requests
+            with client.session_transaction() as sess:
+                sess['user_id'] = users[record['user']]
+        return record['endpoint'], response.status_code, latency
+
+    start_t = records[0]['t']
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as server:
+        started = time.perf_counter()
+        for record in records:
+            scheduled = None
+            if args.speedup:
+                scheduled = started + (record['t'] - start_t) / args.speedup
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(server.submit(send, record, scheduled))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    if hasattr(app_module, 'intake_buffer'):
+        app_module.intake_buffer.flush()
+
+    by_endpoint = {}
+    statuses = {}
+    for endpoint, status, latency in results:
+        by_endpoint.setdefault(endpoint, []).append(latency)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {
+        'build': os.path.abspath(args.app_dir),
+        'requests': len(results),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'speedup': args.speedup,
+        'concurrency': args.concurrency,
+        'statuses': statuses,
+        'latency': latency_summary([latency for _, _, latency in results]),
+        'endpoints': {endpoint: latency_summary(latencies) for endpoint, latencies in by_endpoint.items()},
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+def delta(before, after):
+    if not before:
+        return '     n/a'
+    return f"{100 * (after - before) / before:+7.1f}%"
+
+
+def print_comparison(baseline, candidate):
+    print(f"baseline:  {baseline['build']}")
+    print(f"candidate: {candidate['build']}")
+    print(f"{baseline['requests']} requests, speedup {baseline['speedup']}, concurrency {baseline['concurrency']}\n")
+    print(f"throughput: {baseline['throughput_rps']:.1f} -> {candidate['throughput_rps']:.1f} req/s "
+          f"({delta(baseline['throughput_rps'], candidate['throughput_rps'])})")
+    if baseline['statuses'] != candidate['statuses']:
+        print(f"statuses:   {baseline['statuses']} -> {candidate['statuses']}")
+
+    print(f"\n{'endpoint':<28}{'count':>7}  {'p50 ms':>17} {'delta':>8}  {'p95 ms':>17} {'delta':>8}")
+    rows = [('all', baseline['latency'], candidate['latency'])]
+    rows += [(endpoint, summary, candidate['endpoints'].get(endpoint))
+             for endpoint, summary in sorted(baseline['endpoints'].items(), key=lambda item: -item[1]['count'])]
+    for endpoint, before, after in rows:
+        if after is None:
+            print(f"{endpoint:<28}{before['count']:>7}  (not in candidate run)")
+            continue
+        print(f"{endpoint:<28}{before['count']:>7}  "
+              f"{before['p50_ms']:>8.2f}{after['p50_ms']:>9.2f} {delta(before['p50_ms'], after['p50_ms'])}  "
+              f"{before['p95_ms']:>8.2f}{after['p95_ms']:>9.2f} {delta(before['p95_ms'], after['p95_ms'])}")
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print_comparison(baseline, candidate)
+    return 0
+
+
+def ab(args):
+    """Replay the same capture against two builds, each in a fresh process, and compare them"""
+    reports = []
+    for build in (args.baseline, args.candidate):
+        out = tempfile.NamedTemporaryFile(prefix='waterbuddy-replay-', suffix='.json', delete=False).name
+        command = [sys.executable, os.path.join(HERE, 'replay.py'), 'run', *map(os.path.abspath, args.capture),
+                   '--db', os.path.abspath(args.db), '--app-dir', os.path.abspath(build),
+                   '--speedup', str(args.speedup), '--concurrency', str(args.concurrency),
+                   '--gemini-latency', str(args.gemini_latency), '--out', out]
+        if args.limit:
+            command += ['--limit', str(args.limit)]
+        print(f"replaying against {build}...", file=sys.stderr)
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(out) as f:
+            reports.append(json.load(f))
+        os.remove(out)
+    print_comparison(*reports)
+    return 0
+
+
+def add_run_options(parser):
+    parser.add_argument('capture', nargs='+', help='capture files written by the traffic recorder')
+    parser.add_argument('--db', default=os.path.join(HERE, 'water_tracker.db'), help='database to replay against (copied first)')
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay this many times faster than recorded (0: no waits)')
+    parser.add_argument('--concurrency', type=int, default=8, help='server threads')
+    parser.add_argument('--limit', type=int, help='replay only the first N requests')
+    parser.add_argument('--gemini-latency', type=float, default=1.0, help='seconds the Gemini stand-in takes per reply')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded WaterBuddy traffic')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='replay a capture against one build')
+    add_run_options(run_parser)
+    run_parser.add_argument('--app-dir', default=HERE, help='checkout of the build to replay against')
+    run_parser.add_argument('--out', help='write the results here instead of printing them')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare the results of two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.set_defaults(func=compare)
+
+    ab_parser = subparsers.add_parser('ab', help='replay a capture against two builds and compare them')
+    add_run_options(ab_parser)
+    ab_parser.add_argument('--baseline', required=True, help='checkout of the baseline build')
+    ab_parser.add_argument('--candidate', default=HERE, help='checkout of the candidate build')
+    ab_parser.set_defaults(func=ab)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Server-side sessions for WaterBuddy
+This module keeps session data on the server and caches a small context for each logged-in user
+
+The session cookie carries only a random session id; the session itself
+(user_id, gemini_api_key_set, ...) lives in a key-value store:
+- 'sqlite' (the default): a SQLite file at SESSION_DB, shared by every worker
+  process on the host,
+- 'memory': a dict in this process, standing in for a shared store such as
+  Redis when there is a single worker (the store API mirrors one: get, set,
+  add (set if absent, Redis's SET NX) and delete, with TTLs in seconds),
+- 'cookie': Flask's signed cookie sessions, with nothing cached.
+
+Next to the sessions, the store caches UserContext (profile, goal, timezone and
+data version) for USER_CONTEXT_TTL seconds, which is what most authenticated
+routes need before doing anything else; a miss loads it in one query instead of
+the User and DailyGoal lookups the routes used to make. invalidate_user() must
+follow every write to those fields (profile edits, calculate_water_goal(),
+timezone changes); data version bumps (database.bump_data_version()) invalidate
+the users they touch when their transaction commits. It leaves a short-lived
+tombstone, so a request that read the old row just before the write cannot put
+it back into the cache.
+
+Sessions expire SESSION_LIFETIME_DAYS after their last use; the expiry is
+pushed back (one write) at most once per half lifetime. The session id is
+replaced whenever the logged-in user changes, so an id handed out before
+login is never authenticated. Signed cookies from before server-side sessions
+are read once and moved into the store, so nobody is logged out.
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from flask import g, has_app_context, session
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin, session_json_serializer
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import CallbackDict
+
+from database import db, User, DailyGoal
+
+UserContext = namedtuple('UserContext', 'id name goal timezone data_version age weight height profession')
+
+SESSION_PREFIX = 'session:'
+USER_PREFIX = 'user:'
+# How long an invalidated context stays uncacheable; far longer than the gap between reading and caching it
+TOMBSTONE_SECONDS = 2
+# Expired entries are deleted at most this often
+PURGE_SECONDS = 600
+
+
+class MemoryStore:
+    """Key-value store with expiring entries in this process's memory"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._purged = time.time()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ex):
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (value, now + ex)
+            if now - self._purged > PURGE_SECONDS:
+                self._entries = {k: entry for k, entry in self._entries.items() if entry[1] > now}
+                self._purged = now
+
+    def add(self, key, value, ex):
+        """Set a key unless it holds an unexpired value; returns whether it was set"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return False
+            self._entries[key] = (value, time.time() + ex)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SqliteStore:
+    """Key-value store with expiring entries in a SQLite file, shared by processes on one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._purged = time.time()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        # One autocommit connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ex):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, now + ex))
+        if now - self._purged > PURGE_SECONDS:
+            self._purged = now
+            conn.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+
+    def add(self, key, value, ex):
+        """Set a key unless it holds an unexpired value; returns whether it was set"""
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO kv (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE kv.expires <= ?",
+            (key, value, now + ex, now)
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data loaded from the store, remembering the id and login it was loaded with"""
+
+    def __init__(self, initial=None, sid=None, expires=0.0, cookie=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.cookie = cookie
+        self.loaded_user_id = self.get('user_id')
+        self.modified = False
+
+
+class ServerSessions(SessionInterface):
+    """
+    Flask extension storing sessions server-side and caching each user's context.
+
+    Installs itself as the app's session interface unless SESSION_BACKEND is
+    'cookie'. current_user() returns the logged-in user's UserContext, cached
+    per request and in the store.
+    """
+
+    def __init__(self, app=None, backend='sqlite', path=None, lifetime_days=31, context_ttl=3600):
+        self.backend = backend
+        self.path = path
+        self.lifetime_days = lifetime_days
+        self.context_ttl = context_ttl
+        self.store = None
+        self._cookie_sessions = SecureCookieSessionInterface()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get('SESSION_BACKEND', self.backend)
+        self.path = app.config.get('SESSION_DB', self.path)
+        self.lifetime_days = app.config.get('SESSION_LIFETIME_DAYS', self.lifetime_days)
+        self.context_ttl = app.config.get('USER_CONTEXT_TTL', self.context_ttl)
+        app.extensions['server_sessions'] = self
+        if not self._listening:
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+        if self.backend == 'cookie':
+            self.store = None
+            return
+        if self.backend == 'memory':
+            self.store = MemoryStore()
+        elif self.backend == 'sqlite':
+            self.store = SqliteStore(self.path)
+        else:
+            raise ValueError(f"Unknown SESSION_BACKEND {self.backend!r} (expected 'sqlite', 'memory' or 'cookie')")
+        app.session_interface = self
+
+    # Session interface
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie and '.' in cookie:
+            # A signed cookie session from before the switch: move it into the store
+            legacy = self._cookie_sessions.open_session(app, request)
+            if legacy:
+                imported = ServerSession(dict(legacy), cookie=cookie)
+                imported.loaded_user_id = None
+                return imported
+        elif cookie:
+            raw = self.store.get(SESSION_PREFIX + cookie)
+            if raw is not None:
+                record = json.loads(raw)
+                return ServerSession(session_json_serializer.loads(record['data']), cookie,
+                                     record['expires'], cookie)
+        return ServerSession(cookie=cookie)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        response.vary.add('Cookie')
+
+        if not session:
+            if session.sid:
+                self.store.delete(SESSION_PREFIX + session.sid)
+            if session.cookie:
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app))
+            return
+
+        new_id = session.sid is None or session.get('user_id') != session.loaded_user_id
+        if new_id:
+            # A fresh id on every login and logout, so an id set beforehand is useless
+            if session.sid:
+                self.store.delete(SESSION_PREFIX + session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        now = time.time()
+        lifetime = self.lifetime_days * 86400
+        if not (new_id or session.modified or session.expires - now < lifetime / 2):
+            return
+
+        session.expires = now + lifetime
+        record = {'data': session_json_serializer.dumps(dict(session)), 'expires': session.expires}
+        self.store.set(SESSION_PREFIX + session.sid, json.dumps(record), lifetime)
+        if new_id or session.permanent:
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    # Cached user context
+
+    def current_user(self):
+        """UserContext of the logged-in user, or None if nobody is logged in or the user is gone"""
+        user_id = session.get('user_id')
+        if user_id is None:
+            return None
+        context = g.get('user_context')
+        if context is None or context.id != user_id:
+            context = g.user_context = self.user_context(user_id)
+        return context
+
+    def user_context(self, user_id):
+        """A user's id, name, daily goal (None if not set yet) and timezone, from the cache or one query"""
+        key = USER_PREFIX + str(user_id)
+        raw = self.store.get(key) if self.store is not None else None
+        if raw:
+            values = json.loads(raw)
+            # Entries cached by an older release have fewer fields and are reloaded
+            if len(values) == len(UserContext._fields):
+                return UserContext(*values)
+
+        row = db.session.query(
+            User.id, User.name, DailyGoal.amount, User.timezone, User.data_version,
+            User.age, User.weight, User.height, User.profession
+        ).outerjoin(
+            DailyGoal, DailyGoal.user_id == User.id
+        ).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        context = UserContext(*row)
+        if self.store is not None and raw != '':
+            # add() rather than set(): an invalidation since the query left a tombstone here
+            if raw is not None:
+                self.store.delete(key)
+            self.store.add(key, json.dumps(context), self.context_ttl)
+        return context
+
+    def invalidate_user(self, user_id):
+        """Drop a user's cached context after their name, goal or timezone changed (call after committing)"""
+        if has_app_context() and g.get('user_context') is not None and g.user_context.id == user_id:
+            g.pop('user_context')
+        if self.store is not None:
+            self.store.set(USER_PREFIX + str(user_id), '', TOMBSTONE_SECONDS)
+
+    def _after_commit(self, db_session):
+        for user_id in db_session.info.pop('bumped_users', ()):
+            self.invalidate_user(user_id)
+
+    def _after_rollback(self, db_session):
+        db_session.info.pop('bumped_users', None)
@@ -0,0 +1,397 @@
+"""
+Horizontal sharding for WaterBuddy
+This module spreads users and their data over several SQLite files so writes for different users never wait on the same lock
+
+With SHARD_COUNT = 1 (the default) nothing changes: every table lives in the
+database at SQLALCHEMY_DATABASE_URI and the session is Flask-SQLAlchemy's own.
+With more shards, the tables in SHARDED_TABLES are split by user: a user and
+all their intake, events, goal and reminder rows live in shard
+jump_hash(user_id, SHARD_COUNT). Shard 0 is the main database, which also
+keeps the tables that are not per user (the archive catalog and the user id
+sequence); shard i > 0 is SHARD_DIR/water_tracker-shard<i>.db, with its own
+engine and connection pool of SHARD_POOL_SIZE connections.
+
+The session is then a SQLAlchemy ShardedSession:
+- objects are written to their user's shard; new users first get an id from
+  the id_sequences table in the main database, so ids stay unique,
+- queries whose WHERE clause pins the user (user_id = x either way round, as
+  relationship loads write it, user_id IN (...), User.id = x, ANDed with
+  anything) only go to those users' shards; other
+  queries go to every shard and the rows are concatenated, so ORDER BY, LIMIT
+  and aggregates apply per shard (use db.fan_out() and combine the results),
+- text() and Core statements run on the main database unless given a shard
+  with db.execute_on(); db.bulk_insert() and db.bulk_update() replace the
+  session's bulk methods, which ShardedSession does not support.
+
+Jump consistent hashing means that going from N to M shards only moves the
+users whose shard changes (1 - N/M of them when growing); `flask reshard
+--count M` moves them while the app is stopped, and picks up where it left off
+if it is interrupted.
+
+`benchmark.py shards` runs eight writer processes. On a single CPU, the two
+UPDATEs behind /add_water went from 589 to 811 transactions/s with two shards,
+as commits on different files stop queueing for one lock; whole requests
+(about 11 ms of CPU each) did not speed up, since the CPU was already the
+limit. Write throughput keeps scaling with shards only while there are cores
+or disk wait left to overlap.
+"""
+import hashlib
+import os
+import threading
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, create_engine, delete, event, inspect, insert, select, text, update
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.util import find_tables
+
+# Per-user tables, in the order a user's rows are copied when resharding
+SHARDED_TABLES = ('users', 'daily_goals', 'water_reminders', 'water_intakes', 'intake_events')
+# Tables every shard has its own copy of, written with db.execute_on() (markers of applied write-buffer
+# batches, and of users copied in by `flask reshard` whose old rows are not deleted yet)
+SHARD_LOCAL_TABLES = ('journal_batches', 'shard_moves')
+MOVES_TABLE = 'shard_moves'
+USER_TABLE = 'users'
+MAIN_SHARD = 0
+
+NEXT_USER_ID_SQL = text("UPDATE id_sequences SET value = value + 1 WHERE name = 'users' RETURNING value")
+START_USER_IDS_SQL = text("INSERT INTO id_sequences (name, value) VALUES ('users', :value)")
+MAX_USER_ID_SQL = text("SELECT MAX(id) FROM users")
+
+
+def jump_hash(user_id, buckets):
+    """Jump consistent hash (Lamping and Veach) of a user id into one of `buckets` shards"""
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), 'big')
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+    return bucket
+
+
+def _user_column(column):
+    table = getattr(column, 'table', None)
+    if table is None:
+        return False
+    return (column.name == 'id' and table.name == USER_TABLE) or \
+        (column.name == 'user_id' and table.name in SHARDED_TABLES)
+
+
+def _column_and_bind(clause):
+    """The (column, bind parameter) of a comparison written either way round, or None"""
+    if isinstance(clause.right, BindParameter):
+        return clause.left, clause.right
+    if isinstance(clause.left, BindParameter) and clause.operator is operators.eq:
+        # Lazy loads such as user.water_intakes render as :param = water_intakes.user_id
+        return clause.right, clause.left
+    return None
+
+
+def user_criteria(statement, params=None):
+    """
+    The users a statement is restricted to by its WHERE clause.
+
+    Only comparisons ANDed at the top level count (user_id = x, x = user_id,
+    user_id IN (...), or users.id), so an OR never narrows a query to fewer
+    shards than it needs. Values come from the bound parameters or, for
+    primary key and relationship loads, from the execution parameters.
+
+    Returns:
+        A set of user ids, or None if the statement is not restricted to users
+    """
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return None
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = [where]
+
+    users = None
+    for clause in clauses:
+        pair = _column_and_bind(clause) if isinstance(clause, BinaryExpression) else None
+        if pair is None or not _user_column(pair[0]):
+            continue
+        bind = pair[1]
+        value = (params or {}).get(bind.key, bind.effective_value)
+        if value is None:
+            continue
+        if clause.operator is operators.eq:
+            found = {value}
+        elif clause.operator is operators.in_op:
+            found = set(value or ())
+        else:
+            continue
+        users = found if users is None else users & found
+    return users
+
+
+class ShardRouter:
+    """Engines and routing for one app's shards, kept in app.extensions['shard_router']"""
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.count = app.config['SHARD_COUNT']
+        self.directory = app.config['SHARD_DIR']
+        self.pool_size = app.config['SHARD_POOL_SIZE']
+        if self.count < 1:
+            raise ValueError('SHARD_COUNT must be at least 1')
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def shard_of(self, user_id, count=None):
+        return jump_hash(user_id, count or self.count)
+
+    def url(self, shard_id):
+        if shard_id == MAIN_SHARD:
+            return self.app.config['SQLALCHEMY_DATABASE_URI']
+        return f"sqlite:///{os.path.join(self.directory, f'water_tracker-shard{shard_id}.db')}"
+
+    def engine(self, shard_id):
+        """The engine for a shard; shard 0 is Flask-SQLAlchemy's own"""
+        with self._lock:
+            engine = self._engines.get(shard_id)
+            if engine is None:
+                if shard_id == MAIN_SHARD:
+                    engine = self.db.get_engine(self.app)
+                else:
+                    os.makedirs(self.directory, exist_ok=True)
+                    engine = create_engine(self.url(shard_id), poolclass=QueuePool, pool_size=self.pool_size,
+                                           connect_args={'check_same_thread': False})
+                self._engines[shard_id] = engine
+            return engine
+
+    def engines(self, count=None):
+        return {shard_id: self.engine(shard_id) for shard_id in range(count or self.count)}
+
+    def session(self, **options):
+        session = ShardedSession(
+            shard_chooser=self.shard_chooser,
+            id_chooser=self.id_chooser,
+            execute_chooser=self.execute_chooser,
+            shards=self.engines(),
+            **options
+        )
+        event.listen(session, 'before_flush', self._assign_user_ids)
+        return session
+
+    def shard_chooser(self, mapper, instance, clause=None, **kw):
+        table = mapper.local_table.name if mapper is not None else None
+        if table not in SHARDED_TABLES:
+            return MAIN_SHARD
+        if instance is None:
+            raise LookupError(f"no user to choose a shard for {table}; use db.execute_on()")
+        return self.shard_of(instance.id if table == USER_TABLE else instance.user_id)
+
+    def id_chooser(self, query, ident):
+        table = inspect(query.column_descriptions[0]['entity']).local_table.name
+        if table == USER_TABLE:
+            return [self.shard_of(ident[0])]
+        if table in SHARDED_TABLES:
+            return list(range(self.count))
+        return [MAIN_SHARD]
+
+    def execute_chooser(self, orm_context):
+        statement = orm_context.statement
+        tables = {getattr(table, 'name', None) for table in find_tables(statement, check_columns=True, include_crud=True)}
+        if not tables & set(SHARDED_TABLES):
+            return [MAIN_SHARD]
+        params = orm_context.parameters if isinstance(orm_context.parameters, dict) else None
+        users = user_criteria(statement, params)
+        if users is None:
+            return list(range(self.count))
+        return sorted({self.shard_of(user_id) for user_id in users}) or [MAIN_SHARD]
+
+    def _assign_user_ids(self, session, flush_context, instances):
+        for instance in session.new:
+            if inspect(instance).mapper.local_table.name == USER_TABLE and instance.id is None:
+                instance.id = self.next_user_id()
+
+    def next_user_id(self):
+        """Allocate a user id, unique across shards, from the main database in its own transaction"""
+        with self.engine(MAIN_SHARD).begin() as conn:
+            value = conn.execute(NEXT_USER_ID_SQL).scalar()
+            if value is None:
+                # First new user since sharding was enabled: continue after the highest existing id
+                highest = conn.execute(MAX_USER_ID_SQL).scalar() or 0
+                for shard_id in range(1, self.count):
+                    with self.engine(shard_id).connect() as shard:
+                        highest = max(highest, shard.execute(MAX_USER_ID_SQL).scalar() or 0)
+                value = highest + 1
+                conn.execute(START_USER_IDS_SQL, {'value': value})
+        return value
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with the per-user tables optionally sharded by user id.
+
+    Reads SHARD_COUNT, SHARD_DIR and SHARD_POOL_SIZE from the app config. The
+    helpers below work the same way whether or not the app is sharded.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_COUNT', 1)
+        app.config.setdefault('SHARD_DIR', app.instance_path)
+        app.config.setdefault('SHARD_POOL_SIZE', 5)
+        super().init_app(app)
+        app.extensions['shard_router'] = ShardRouter(self, app)
+
+    def create_session(self, options):
+        unsharded = super().create_session(options)
+
+        def session_factory(**kwargs):
+            router = self.router()
+            if router.count == 1:
+                return unsharded(**kwargs)
+            return router.session(**options, **kwargs)
+        return session_factory
+
+    def router(self, app=None):
+        return (app or self.get_app()).extensions['shard_router']
+
+    @property
+    def sharded(self):
+        return self.router().count > 1
+
+    def shard_ids(self):
+        return range(self.router().count)
+
+    def shard_of(self, user_id):
+        return self.router().shard_of(user_id)
+
+    def shard_engines(self):
+        """Engine of every shard, by shard id"""
+        return self.router().engines()
+
+    def partition(self, user_ids):
+        """Mapping of shard id to the given users in it"""
+        shards = {}
+        for user_id in user_ids:
+            shards.setdefault(self.shard_of(user_id), []).append(user_id)
+        return shards
+
+    def execute_on(self, shard_id, statement, params=None):
+        """Session.execute() on one shard"""
+        if not self.sharded:
+            return self.session.execute(statement, params)
+        return self.session.execute(statement, params, bind_arguments={'shard_id': shard_id})
+
+    def fan_out(self, statement, params=None):
+        """Rows of a statement run on every shard, e.g. a GROUP BY to be combined by the caller"""
+        return [row for shard_id in self.shard_ids() for row in self.execute_on(shard_id, statement, params)]
+
+    def _rows_by_shard(self, rows):
+        shards = {}
+        for row in rows:
+            shards.setdefault(self.shard_of(row['user_id']), []).append(row)
+        return shards
+
+    def bulk_insert(self, model, rows):
+        """Session.bulk_insert_mappings() for a per-user model (every row has a user_id)"""
+        if not self.sharded:
+            self.session.bulk_insert_mappings(model, rows)
+            return
+        for shard_id, shard_rows in self._rows_by_shard(rows).items():
+            self.execute_on(shard_id, insert(model.__table__), shard_rows)
+
+    def bulk_update(self, model, rows):
+        """Session.bulk_update_mappings() for a per-user model (every row has its id and user_id)"""
+        if not self.sharded:
+            self.session.bulk_update_mappings(model, rows)
+            return
+        table = model.__table__
+        for shard_id, shard_rows in self._rows_by_shard(rows).items():
+            columns = [key for key in shard_rows[0] if key not in ('id', 'user_id')]
+            statement = update(table).where(table.c.id == bindparam('_id')).values(
+                {column: bindparam(column) for column in columns})
+            self.execute_on(shard_id, statement, [dict(row, _id=row['id']) for row in shard_rows])
+
+    def create_all(self, bind='__all__', app=None):
+        """Create missing tables: all of them in the main database and the per-user and shard-local ones in the other shards"""
+        super().create_all(bind, app)
+        router = self.router(app)
+        tables = [self.Model.metadata.tables[name] for name in SHARDED_TABLES + SHARD_LOCAL_TABLES]
+        for shard_id in range(1, router.count):
+            self.Model.metadata.create_all(router.engine(shard_id), tables=tables)
+
+    def reshard(self, count, from_count=None, batch_users=500, echo=print):
+        """
+        Move users to their shards for a new shard count. Run with the app stopped.
+
+        Each batch is copied to its new shard together with a shard_moves
+        marker per user, in one transaction, and then deleted from the old
+        shard before the markers are cleared. A run that was interrupted in
+        between is finished first when the tool is rerun: users with a marker
+        are deleted from the shard it names, so nobody is left on two shards.
+
+        Args:
+            count: The new SHARD_COUNT
+            from_count: The current SHARD_COUNT (default: the app's)
+
+        Returns:
+            The number of users moved
+        """
+        router = self.router()
+        from_count = from_count or router.count
+        metadata = self.Model.metadata
+        tables = [metadata.tables[name] for name in SHARDED_TABLES]
+        moves = metadata.tables[MOVES_TABLE]
+        local_tables = [metadata.tables[name] for name in SHARD_LOCAL_TABLES]
+        for shard_id in range(count):
+            metadata.create_all(router.engine(shard_id), tables=tables + local_tables)
+        for target in range(count):
+            resumed = self._finish_moves(router, target, tables)
+            if resumed:
+                echo(f'  finished moving {resumed} users into shard {target} from an interrupted run')
+
+        moved = 0
+        for source in range(from_count):
+            with router.engine(source).connect() as conn:
+                user_ids = [user_id for (user_id,) in conn.execute(select(tables[0].c.id))]
+            leaving = [user_id for user_id in user_ids if router.shard_of(user_id, count) != source]
+            for start in range(0, len(leaving), batch_users):
+                batch = leaving[start:start + batch_users]
+                targets = {}
+                for user_id in batch:
+                    targets.setdefault(router.shard_of(user_id, count), []).append(user_id)
+                for target, ids in targets.items():
+                    with router.engine(source).connect() as src, router.engine(target).begin() as dst:
+                        for table in tables:
+                            owner = table.c.id if table.name == USER_TABLE else table.c.user_id
+                            rows = [dict(row) for row in src.execute(select(table).where(owner.in_(ids))).mappings()]
+                            if table.name != USER_TABLE:
+                                # Row ids are only unique within a shard
+                                for row in rows:
+                                    del row['id']
+                            dst.execute(delete(table).where(owner.in_(ids)))
+                            if rows:
+                                dst.execute(insert(table), rows)
+                        dst.execute(delete(moves).where(moves.c.user_id.in_(ids)))
+                        dst.execute(insert(moves), [{'user_id': user_id, 'source': source} for user_id in ids])
+                    self._finish_moves(router, target, tables)
+                moved += len(batch)
+                echo(f'  moved {moved}/{len(leaving)} users out of shard {source}')
+        return moved
+
+    def _finish_moves(self, router, target, tables):
+        """Delete the users marked in a shard's shard_moves from their old shards, then clear the markers"""
+        moves = self.Model.metadata.tables[MOVES_TABLE]
+        with router.engine(target).connect() as conn:
+            marked = conn.execute(select(moves.c.source, moves.c.user_id)).fetchall()
+        sources = {}
+        for source, user_id in marked:
+            sources.setdefault(source, []).append(user_id)
+        for source, ids in sources.items():
+            with router.engine(source).begin() as src:
+                for table in reversed(tables):
+                    owner = table.c.id if table.name == USER_TABLE else table.c.user_id
+                    src.execute(delete(table).where(owner.in_(ids)))
+        if marked:
+            with router.engine(target).begin() as dst:
+                dst.execute(delete(moves))
+        return len(marked)
@@ -0,0 +1,284 @@
+"""
+Background task queue for WaterBuddy
+This module runs slow side effects (goal recalculation, Gemini replies) off the request path
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sessions import MemoryStore
+
+# Durable rows are claimed by the process that runs them: its pid, plus a token that
+# tells it apart from an earlier process that had the same pid (e.g. pid 1 in a container)
+PROCESS_TOKEN = uuid.uuid4().hex[:12]
+
+TASK_PREFIX = 'task:'
+
+
+class QueueFullError(Exception):
+    """Raised when the queue already holds max_depth pending tasks"""
+
+
+class TaskQueue:
+    """
+    In-process task queue backed by a thread pool.
+
+    Tasks are registered by name with the task() decorator, so they can be
+    persisted to an optional SQLite file and picked up again after a restart.
+    Every worker process may share that file: each row is claimed by the
+    process running it, and at start-up a process only takes over rows whose
+    claimer is no longer running, so no task runs twice.
+    Failed tasks are retried with exponential backoff. Each task's record (state,
+    result, error) is kept in the ServerSessions store for TASK_RESULT_TTL seconds,
+    so a client polling for it may land on any worker; with the 'cookie' session
+    backend there is no shared store and records are kept in this process.
+    """
+
+    def __init__(self, app=None, max_workers=4, max_depth=100, max_retries=3,
+                 backoff_base=0.5, result_ttl=3600, durable_path=None):
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.result_ttl = result_ttl
+        self.durable_path = durable_path
+
+        self.app = None
+        self.store = MemoryStore()
+        self._tasks = {}
+        self._finishers = {}
+        self._records = {}  # tasks of this process that have not finished yet
+        self._timers = {}  # task id -> retry timer
+        self._closed = False
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind the queue to a Flask app and replay any durable tasks"""
+        self.app = app
+        self.max_workers = app.config.get('TASK_QUEUE_WORKERS', self.max_workers)
+        self.max_depth = app.config.get('TASK_QUEUE_MAX_DEPTH', self.max_depth)
+        self.max_retries = app.config.get('TASK_QUEUE_MAX_RETRIES', self.max_retries)
+        self.durable_path = app.config.get('TASK_QUEUE_DURABLE_PATH', self.durable_path)
+        self.result_ttl = app.config.get('TASK_RESULT_TTL', self.result_ttl)
+        sessions = app.extensions.get('server_sessions')
+        self.store = sessions.store if sessions is not None and sessions.store is not None else MemoryStore()
+
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='waterbuddy-task')
+        if self.durable_path:
+            self._init_store()
+            self._replay()
+
+    def task(self, name=None, on_finish=None):
+        """
+        Register a function so it can be enqueued by name.
+
+        Args:
+            name: Registered name (default: the function's name)
+            on_finish: Optional callback given the task's record once it is done or
+                has failed for good, i.e. after the last retry rather than after each attempt
+        """
+        def decorator(func):
+            self._tasks[name or func.__name__] = func
+            if on_finish is not None:
+                self._finishers[name or func.__name__] = on_finish
+            return func
+        return decorator
+
+    @property
+    def depth(self):
+        """Number of tasks waiting to run or currently running"""
+        return self._pending
+
+    def enqueue(self, name, *args, owner=None, **kwargs):
+        """
+        Schedule a registered task and return its id immediately.
+
+        Args:
+            name: The registered task name
+            owner: Optional user id allowed to read the result
+            *args, **kwargs: JSON-serialisable task arguments
+
+        Raises:
+            QueueFullError: if max_depth tasks are already pending
+        """
+        if name not in self._tasks:
+            raise KeyError(f"Unknown task: {name}")
+
+        payload = json.dumps({'args': args, 'kwargs': kwargs})
+        task_id = uuid.uuid4().hex
+
+        if self._pending >= self.max_depth:
+            raise QueueFullError(f"Task queue is full ({self.max_depth} pending)")
+
+        # Counted as pending only once it is stored, so a failed write never leaks a slot
+        record = {'state': 'queued', 'owner': owner, 'attempts': 0}
+        self._save(task_id, record)
+        if self.durable_path:
+            self._store(task_id, name, payload, owner)
+        with self._lock:
+            self._pending += 1
+            self._records[task_id] = record
+
+        self._submit(task_id, name, payload)
+        return task_id
+
+    def status(self, task_id):
+        """Return the record of a task (state, result, error) or None"""
+        raw = self.store.get(TASK_PREFIX + task_id)
+        return json.loads(raw) if raw else None
+
+    def shutdown(self, wait=True):
+        """Stop accepting work, drop pending retries and wait for running tasks to finish"""
+        with self._lock:
+            self._closed = True
+            timers, self._timers = self._timers, {}
+        for timer in timers.values():
+            timer.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def _submit(self, task_id, name, payload):
+        self._executor.submit(self._run, task_id, name, payload)
+
+    def _retry(self, task_id, name, payload):
+        with self._lock:
+            self._timers.pop(task_id, None)
+            if self._closed:
+                return  # a durable row is left for the next process to replay
+        self._submit(task_id, name, payload)
+
+    def _run(self, task_id, name, payload):
+        data = json.loads(payload)
+        with self._lock:
+            record = self._records[task_id]
+            record['state'] = 'running'
+            record['attempts'] += 1
+            attempts = record['attempts']
+        self._save(task_id, record)
+
+        try:
+            with self.app.app_context():
+                result = self._tasks[name](*data['args'], **data['kwargs'])
+        except Exception as e:
+            if attempts <= self.max_retries:
+                delay = self.backoff_base * (2 ** (attempts - 1))
+                record['state'] = 'retrying'
+                self._save(task_id, record)
+                timer = threading.Timer(delay, self._retry, (task_id, name, payload))
+                timer.daemon = True
+                with self._lock:
+                    if self._closed:
+                        return
+                    self._timers[task_id] = timer
+                timer.start()
+                return
+            print(f"Task {name} failed after {attempts} attempts: {str(e)}")
+            self._finish(task_id, name, {'state': 'failed', 'error': str(e)})
+            return
+
+        self._finish(task_id, name, {'state': 'done', 'result': result})
+
+    def _finish(self, task_id, name, update):
+        with self._lock:
+            self._pending -= 1
+            record = self._records.pop(task_id)
+        finished = dict(record, finished_at=time.time(), **update)
+        try:
+            self._save(task_id, finished)
+        except (TypeError, ValueError) as e:
+            print(f"Result of task {name} could not be stored: {str(e)}")
+            finished.update(state='failed', result=None, error='Task result is not JSON-serialisable')
+            self._save(task_id, finished)
+        if self.durable_path:
+            self._delete(task_id)
+        on_finish = self._finishers.get(name)
+        if on_finish is not None:
+            try:
+                on_finish(finished)
+            except Exception as e:
+                print(f"on_finish callback of task {name} failed: {str(e)}")
+
+    def _save(self, task_id, record):
+        self.store.set(TASK_PREFIX + task_id, json.dumps(record), self.result_ttl)
+
+    # Durable store: a plain SQLite file holding tasks that have not finished yet
+
+    @property
+    def claim_id(self):
+        return f"{os.getpid()}:{PROCESS_TOKEN}"
+
+    def _connect(self):
+        return sqlite3.connect(self.durable_path, timeout=10)
+
+    def _init_store(self):
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id TEXT PRIMARY KEY, name TEXT NOT NULL, payload TEXT NOT NULL, "
+                "owner INTEGER, created_at REAL NOT NULL, claimed_by TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+            if 'claimed_by' not in columns:
+                conn.execute("ALTER TABLE tasks ADD COLUMN claimed_by TEXT")
+
+    def _store(self, task_id, name, payload, owner):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO tasks (id, name, payload, owner, created_at, claimed_by) VALUES (?, ?, ?, ?, ?, ?)",
+                (task_id, name, payload, owner, time.time(), self.claim_id)
+            )
+
+    def _delete(self, task_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def _orphaned(self, claimed_by):
+        """Whether a claim belongs to a process that is no longer running"""
+        if claimed_by is None:
+            return True  # written before rows were claimed
+        pid, _, token = claimed_by.partition(':')
+        if token == PROCESS_TOKEN:
+            return False  # this process, already running it
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return True  # an earlier process with our pid
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            return False  # alive, but owned by another user
+        return False
+
+    def _replay(self):
+        """Claim and run the tasks of processes that exited before finishing them"""
+        rows = []
+        with self._connect() as conn:
+            claims = [claimed_by for (claimed_by,) in conn.execute("SELECT DISTINCT claimed_by FROM tasks")]
+            for claimed_by in filter(self._orphaned, claims):
+                # The UPDATE is atomic, so when several workers start together only one gets each row
+                rows += conn.execute(
+                    "UPDATE tasks SET claimed_by = ? WHERE claimed_by IS ? RETURNING id, name, payload, owner, created_at",
+                    (self.claim_id, claimed_by)
+                ).fetchall()
+        rows.sort(key=lambda row: row[4])
+
+        for task_id, name, payload, owner, _ in rows:
+            if name not in self._tasks:
+                continue
+            record = {'state': 'queued', 'owner': owner, 'attempts': 0}
+            self._save(task_id, record)
+            with self._lock:
+                self._pending += 1
+                self._records[task_id] = record
+            self._submit(task_id, name, payload)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a throwaway database, with background threads off"""
+    import app as app_module
+    app = app_module.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'SESSION_DB': str(tmp_path / 'sessions.db'),
+        'TEMPLATE_CACHE_DIR': str(tmp_path / 'jinja_cache'),
+        'ARCHIVE_DIR': str(tmp_path / 'archive'),
+        'SHARD_DIR': str(tmp_path),
+        'COHORT_REFRESH_SECONDS': 0,
+        'COHORT_SNAPSHOT': str(tmp_path / 'cohorts.json'),
+        'REMINDER_PLAN_SECONDS': 0,
+        'ADMISSION_ENABLED': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        app_module.db.create_all()
+    yield app
+    with app.app_context():
+        app_module.db.session.remove()
+        for engine in app_module.db.shard_engines().values():
+            engine.dispose()
+
+
+@pytest.fixture
+def make_user(app):
+    """Create a user with a daily goal and return its id"""
+    import app as app_module
+
+    def make_user(name='Test User', weight=70.0):
+        with app.app_context():
+            user = app_module.User(name=name, age=30, weight=weight, height=175.0, profession='developer')
+            app_module.db.session.add(user)
+            app_module.db.session.commit()
+            app_module.calculate_water_goal(user)
+            return user.id
+    return make_user
+
+
+@pytest.fixture
+def client_for(app):
+    """A test client logged in as the given user"""
+    def client_for(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        return client
+    return client_for
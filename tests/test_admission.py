@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+import app as app_module
+from admission import AdmissionControl, Overloaded
+
+
+@pytest.fixture
+def admission():
+    app = Flask(__name__)
+    app.config['ADMISSION_LIMITS'] = {
+        'chat': {'rate': 0.001, 'burst': 2, 'user_rate': 0.001, 'user_burst': 1, 'concurrency': 10}
+    }
+    return AdmissionControl(app)
+
+
+def test_global_rejection_does_not_spend_the_users_token(admission):
+    admission.acquire('chat', key='first')
+    admission.acquire('chat', key='second')
+
+    with pytest.raises(Overloaded) as rejected:
+        admission.acquire('chat', key='user')
+    assert rejected.value.reason == 'rate'
+    assert admission._user_buckets[('chat', 'user')].tokens == pytest.approx(1, abs=0.01)
+
+
+def test_user_rejection_does_not_spend_a_global_token(admission):
+    admission.acquire('chat', key='user')
+
+    with pytest.raises(Overloaded) as rejected:
+        admission.acquire('chat', key='user')
+    assert rejected.value.reason == 'user_rate'
+    admission.acquire('chat', key='someone else')
+
+
+def test_gemini_slot_is_held_across_retries_and_released_once(app, monkeypatch):
+    app_module.admission.enabled = True
+    in_flight = []
+    done = threading.Event()
+
+    def generate_response(*args):
+        in_flight.append(app_module.admission.stats()['gemini']['in_flight'])
+        if len(in_flight) == 1:
+            raise RuntimeError('Gemini timed out')
+        done.set()
+        return 'Drink up!'
+
+    monkeypatch.setattr(app_module, 'generate_response', generate_response)
+    with app.app_context():
+        app_module.admission.acquire('gemini', 1)
+        task_id = app_module.task_queue.enqueue('chatbot_reply', 'hi', {}, {})
+
+    assert done.wait(5)
+    deadline = time.monotonic() + 5
+    while app_module.admission.stats()['gemini']['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert in_flight == [1, 1]
+    assert app_module.task_queue.status(task_id)['state'] == 'done'
+    assert app_module.admission.stats()['gemini']['in_flight'] == 0
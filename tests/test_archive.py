@@ -0,0 +1,50 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app as app_module
+from archive import MIN_HORIZON_DAYS
+
+
+def log_days(app, user_id, ages, amount=1000):
+    """A daily total for each of the given days ago"""
+    with app.app_context():
+        app_module.db.session.add_all(
+            app_module.WaterIntake(user_id=user_id, date=date.today() - timedelta(days=age), amount=amount)
+            for age in ages
+        )
+        app_module.db.session.commit()
+
+
+def test_cli_rejects_a_horizon_below_the_minimum(app, make_user):
+    user_id = make_user()
+    log_days(app, user_id, [1, 40])
+
+    result = app.test_cli_runner().invoke(args=['archive-intake', '--horizon-days', str(MIN_HORIZON_DAYS - 1)])
+
+    assert result.exit_code != 0
+    assert f'{MIN_HORIZON_DAYS}' in result.output
+    with app.app_context():
+        assert app_module.WaterIntake.query.count() == 2
+
+
+def test_archive_refuses_a_recent_cutoff(app):
+    with app.app_context(), pytest.raises(ValueError):
+        app_module.intake_archive.archive(date.today() - timedelta(days=MIN_HORIZON_DAYS - 1))
+
+
+def test_archived_days_still_count_in_daily_totals(app, make_user):
+    user_id = make_user()
+    other_id = make_user(name='Other')
+    log_days(app, user_id, [1, 100, 400])
+    log_days(app, other_id, [200], amount=500)
+
+    result = app.test_cli_runner().invoke(args=['archive-intake', '--horizon-days', '90', '--compact'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Archived 3 rows' in result.output
+    with app.app_context():
+        assert [row.date for row in app_module.WaterIntake.query] == [date.today() - timedelta(days=1)]
+        totals = app_module.intake_archive.daily_totals(user_id)
+        assert totals == [(date.today() - timedelta(days=age), 1000) for age in (400, 100, 1)]
+        assert app_module.intake_archive.history(other_id) == [(date.today() - timedelta(days=200), 500)]
@@ -0,0 +1,85 @@
+import gzip
+import json
+import os
+
+import pytest
+from flask import Flask, render_template_string
+
+import build_assets
+from assets import IMMUTABLE_CACHE_CONTROL, Assets
+
+
+@pytest.fixture
+def build_root(tmp_path, monkeypatch):
+    """build_assets pointed at a scratch tree holding one script, one stylesheet and its font"""
+    (tmp_path / 'app.js').write_text('function add(a, b) {\n    // sum\n    return a + b;\n}\n')
+    (tmp_path / 'font.woff2').write_bytes(b'wOF2 font bytes')
+    (tmp_path / 'site.css').write_text('/* site */ .used { src: url("../fonts/font.woff2"); }\n.unused { color: red; }\n')
+    (tmp_path / 'page.html').write_text('<div class="used"></div><script src="app.js"></script>')
+    monkeypatch.setattr(build_assets, 'ROOT', str(tmp_path))
+    monkeypatch.setattr(build_assets, 'DIST_DIR', str(tmp_path / 'static' / 'dist'))
+    monkeypatch.setattr(build_assets, 'MANIFEST_PATH', str(tmp_path / 'static' / 'dist' / 'manifest.json'))
+    monkeypatch.setattr(build_assets, 'TEMPLATES', ['page.html'])
+    monkeypatch.setattr(build_assets, 'ASSET_SOURCES', {
+        'js/app.js': 'app.js', 'css/site.css': 'site.css', 'fonts/font.woff2': 'font.woff2'})
+    monkeypatch.setattr(build_assets, 'compile_tailwind', lambda: None)
+    return tmp_path
+
+
+def test_fingerprint_changes_with_the_content():
+    first = build_assets.fingerprint('js/app.js', b'one')
+    assert first == build_assets.fingerprint('js/app.js', b'one')
+    assert first.startswith('dist/js/app.') and first.endswith('.js')
+    assert first != build_assets.fingerprint('js/app.js', b'two')
+
+
+def test_build_writes_fingerprinted_files_and_manifest(build_root):
+    build_assets.build(allow_missing=True)
+
+    static = build_root / 'static'
+    manifest = json.loads((static / 'dist' / 'manifest.json').read_text())
+    assert set(manifest) == {'js/app.js', 'css/site.css', 'fonts/font.woff2'}
+    for name, path in manifest.items():
+        data = (static / path).read_bytes()
+        assert path == build_assets.fingerprint(name, data)
+
+    css = (static / manifest['css/site.css']).read_text()
+    font = os.path.basename(manifest['fonts/font.woff2'])
+    assert css == f'.used{{src:url("../fonts/{font}")}}'
+    assert gzip.decompress((static / (manifest['css/site.css'] + '.gz')).read_bytes()).decode() == css
+
+
+def make_app(static_folder, manifest):
+    app = Flask(__name__, static_folder=str(static_folder))
+    dist = static_folder / 'dist'
+    dist.mkdir(parents=True)
+    (dist / 'manifest.json').write_text(json.dumps(manifest))
+    Assets(app)
+    return app
+
+
+def test_asset_url_uses_the_manifest(tmp_path):
+    app = make_app(tmp_path / 'static', {'js/app.js': 'dist/js/app.0123456789.js'})
+
+    with app.test_request_context():
+        assert render_template_string("{{ asset_url('js/app.js') }}") == '/static/dist/js/app.0123456789.js'
+        assert render_template_string("{{ asset_url('js/other.js') }}") == '/static/js/other.js'
+
+
+def test_dist_files_are_served_precompressed_and_immutable(tmp_path):
+    app = make_app(tmp_path / 'static', {'js/app.js': 'dist/js/app.0123456789.js'})
+    built = tmp_path / 'static' / 'dist' / 'js'
+    built.mkdir()
+    (built / 'app.0123456789.js').write_text('var a=1;')
+    (built / 'app.0123456789.js.gz').write_bytes(gzip.compress(b'var a=1;'))
+    client = app.test_client()
+
+    compressed = client.get('/static/dist/js/app.0123456789.js', headers={'Accept-Encoding': 'gzip'})
+    plain = client.get('/static/dist/js/app.0123456789.js')
+
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == b'var a=1;'
+    assert 'Content-Encoding' not in plain.headers and plain.data == b'var a=1;'
+    assert compressed.headers['Cache-Control'] == plain.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    compressed.close()
+    plain.close()
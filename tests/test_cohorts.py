@@ -0,0 +1,44 @@
+import threading
+from datetime import date, timedelta
+
+from flask import Flask
+
+import app as app_module
+from cohorts import CohortStats
+
+
+def log_streaks(app, user_ids):
+    """User i meets their goal for the last i days"""
+    with app.app_context():
+        for streak, user_id in enumerate(user_ids):
+            goal = app_module.DailyGoal.query.filter_by(user_id=user_id).first().amount
+            app_module.db.session.add_all(
+                app_module.WaterIntake(user_id=user_id, date=date.today() - timedelta(days=day), amount=goal)
+                for day in range(streak)
+            )
+        app_module.db.session.commit()
+
+
+def test_no_refresh_thread_by_default(app):
+    assert not any(thread.name == 'waterbuddy-cohort-refresh' for thread in threading.enumerate())
+
+
+def test_workers_load_the_snapshot_written_by_refresh(app, make_user):
+    user_ids = [make_user(name=f'Peer {i}') for i in range(6)]
+    log_streaks(app, user_ids)
+    worker_app = Flask(__name__)
+    worker_app.config.update(COHORT_SNAPSHOT=app.config['COHORT_SNAPSHOT'], COHORT_REFRESH_SECONDS=0)
+    worker = CohortStats(worker_app)
+    assert worker.lookup(user_ids[0]) is None
+
+    with app.app_context():
+        assert app_module.cohort_stats.refresh() == 6
+
+    ranking = worker.lookup(user_ids[4])
+    assert ranking['size'] == 6 and ranking['streak'] == 4 and ranking['streak_rank'] == 2
+    assert ranking['leaderboard'][:3] == [
+        {'rank': 1, 'streak': 5, 'you': False},
+        {'rank': 2, 'streak': 4, 'you': True},
+        {'rank': 3, 'streak': 3, 'you': False},
+    ]
+    assert all(set(entry) == {'rank', 'streak', 'you'} for entry in ranking['leaderboard'])
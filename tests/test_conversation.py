@@ -0,0 +1,46 @@
+from flask import Flask
+
+from conversation import ConversationMemory, build_prompt
+from sessions import ServerSessions
+
+
+def memory_on(path):
+    """A worker's ConversationMemory on the shared SQLite session store"""
+    app = Flask(__name__)
+    app.config.update(SESSION_DB=str(path), CHAT_MEMORY_TURNS=4)
+    ServerSessions(app)
+    return ConversationMemory(app)
+
+
+def test_history_is_shared_between_workers(tmp_path):
+    first, second = memory_on(tmp_path / 'sessions.db'), memory_on(tmp_path / 'sessions.db')
+
+    first.add_exchange(1, 'how much water?', '2.5 liters')
+    second.add_exchange(1, 'and coffee?', 'it counts too')
+    second.add_exchange(1, 'tea?', 'also fine')
+
+    history = first.history(1)
+    assert history['turns'] == [['user', 'and coffee?'], ['assistant', 'it counts too'],
+                                ['user', 'tea?'], ['assistant', 'also fine']]
+    assert history['summary'] == '2 earlier messages. Earlier the user asked about: how much water?'
+    assert second.history(2) == {'summary': '', 'turns': []}
+
+    first.clear(1)
+    assert second.history(1)['turns'] == []
+
+
+def test_oversized_message_is_truncated_to_the_budget():
+    prompt, tokens = build_prompt('Be helpful.', 'x' * 100000, 'Be brief.', token_budget=200)
+
+    assert tokens <= 200
+    assert prompt.rstrip().endswith('...\n\nBe brief.')
+
+
+def test_oversized_chat_message_is_rejected(app, make_user, client_for):
+    user_id = make_user()
+    too_long = 'a' * (app.config['CHAT_MAX_MESSAGE_CHARS'] + 1)
+
+    response = client_for(user_id).post('/chatbot_message', json={'message': too_long})
+
+    assert response.status_code == 413
+    assert not response.get_json()['success']
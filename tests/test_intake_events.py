@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as app_module
+
+
+def events(*timestamps):
+    return [{'event_id': f'e{index}', 'amount': 100, 'timestamp': timestamp}
+            for index, timestamp in enumerate(timestamps)]
+
+
+def total(app, user_id):
+    with app.app_context():
+        return sum(intake.amount for intake in app_module.WaterIntake.query.filter_by(user_id=user_id))
+
+
+@pytest.mark.parametrize('timestamp', [1e20, -1e20, float('inf'), float('nan'), '99999-01-01T00:00:00', 'soon', None])
+def test_unparseable_timestamps_are_rejected_per_event(app, make_user, client_for, timestamp):
+    user_id = make_user()
+    now = datetime.now().isoformat()
+    response = client_for(user_id).post('/api/intake/batch', json={'events': events(now, timestamp)})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['accepted'] == 1
+    assert body['rejected'] == [{'index': 1, 'message': 'invalid timestamp'}]
+    assert total(app, user_id) == 100
+
+
+def test_timestamps_outside_the_window_are_rejected(app, make_user, client_for):
+    user_id = make_user()
+    now = datetime.now()
+    response = client_for(user_id).post('/api/sync', json={'version': 0, 'events': events(
+        (now - timedelta(days=2)).isoformat(),
+        (now + timedelta(days=1)).timestamp(),
+        (now - timedelta(days=app.config['INTAKE_EVENT_MAX_AGE_DAYS'] + 1)).timestamp(),
+    )})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['acked'] == ['e0']
+    assert [event['index'] for event in body['rejected']] == [1, 2]
+    assert body['rejected'][0]['message'] == 'timestamp is in the future'
+    assert 'days old' in body['rejected'][1]['message']
+
+
+def test_retried_events_are_counted_once(app, make_user, client_for):
+    user_id = make_user()
+    client = client_for(user_id)
+    batch = {'events': events(datetime.now().isoformat())}
+
+    assert client.post('/api/intake/batch', json=batch).get_json()['accepted'] == 1
+    assert client.post('/api/intake/batch', json=batch).get_json()['duplicates'] == 1
+    assert total(app, user_id) == 100
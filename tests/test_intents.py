@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+import app as app_module
+from intents import FACT, LOG, OPEN, PROGRESS, TIP, IntentClassifier, train
+
+
+@pytest.fixture(scope='module')
+def classifier():
+    return IntentClassifier(train())
+
+
+# Phrasings that are not in TRAINING_EXAMPLES
+@pytest.mark.parametrize('message, intent', [
+    ("how much water have i had today?", PROGRESS),
+    ("how many ml left?", PROGRESS),
+    ("am i on track today", PROGRESS),
+    ("any tips to drink more water?", TIP),
+    ("i always forget to drink, help", TIP),
+    ("tell me a fun fact about water", FACT),
+    ("share a hydration fact", FACT),
+    ("i just drank a glass of water", LOG),
+    ("log 250 ml", LOG),
+    # Near misses that need Gemini
+    ("what's a fun fact about the moon", OPEN),
+    ("give me a tip for sleeping better", OPEN),
+    ("how does caffeine affect hydration", OPEN),
+    ("how much did i drink yesterday", OPEN),
+    ("i just ate lunch", OPEN),
+    ("what's my name", OPEN),
+    ("is coffee dehydrating?", OPEN),
+    ("how much water should a pregnant woman drink", OPEN),
+])
+def test_messages_are_routed_to_their_intent(classifier, message, intent):
+    assert classifier.classify(message)[0] == intent
+
+
+def test_local_intents_below_the_threshold_go_to_gemini():
+    message = "how much more water do i need today?"
+    intent, probability = IntentClassifier(train()).classify(message)
+    assert intent == PROGRESS
+
+    strict = IntentClassifier(train(threshold=min(1.0, probability + 0.01)))
+    assert strict.classify(message) == (OPEN, pytest.approx(probability))
+
+
+def test_chat_answers_local_intents_and_queues_the_rest(app, make_user, client_for, monkeypatch):
+    monkeypatch.setattr(app_module, 'generate_response', lambda *args: 'From Gemini')
+    client = client_for(make_user())
+
+    local = client.post('/chatbot_message', json={'message': 'how much water have I had today?'}).get_json()
+    assert local['success'] and 'task_id' not in local and local['message']
+
+    queued = client.post('/chatbot_message', json={'message': 'is coffee dehydrating?'}).get_json()
+    assert queued['pending'] and 'message' not in queued
+    deadline = time.monotonic() + 5
+    record = None
+    while time.monotonic() < deadline:
+        record = client.get(f"/task_status/{queued['task_id']}").get_json()
+        if record['state'] == 'done':
+            break
+        time.sleep(0.01)
+    assert record['result']['message'].startswith('From Gemini')
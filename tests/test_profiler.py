@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from profiler import SWITCH_INTERVAL, SamplingProfiler
+
+
+@pytest.mark.parametrize('header, status', [('wrong', 404), ('wröng', 404), ('sécret', 200)])
+def test_profiler_token_check(app, header, status):
+    app.config['PROFILER_TOKEN'] = 'sécret'
+
+    response = app.test_client().get('/admin/profiler', headers={'X-Profiler-Token': header})
+
+    assert response.status_code == status
+
+
+def test_profiler_is_hidden_without_a_token(app):
+    app.config['PROFILER_TOKEN'] = None
+
+    assert app.test_client().get('/admin/profiler', headers={'X-Profiler-Token': ''}).status_code == 404
+
+from profiler import SWITCH_INTERVAL, SamplingProfiler
+
+
+@pytest.fixture
+def switch_interval():
+    original = sys.getswitchinterval()
+    sys.setswitchinterval(0.004)
+    yield 0.004
+    sys.setswitchinterval(original)
+
+
+def test_switch_interval_is_lowered_while_sampling_and_restored_by_stop(switch_interval):
+    profiler = SamplingProfiler()
+
+    assert profiler.start(seconds=30)
+    assert sys.getswitchinterval() == pytest.approx(SWITCH_INTERVAL)
+    profiler.stop()
+
+    assert not profiler.active
+    assert sys.getswitchinterval() == pytest.approx(switch_interval)
+
+
+def test_switch_interval_is_restored_when_a_session_runs_out(switch_interval):
+    profiler = SamplingProfiler(max_seconds=0.05)
+
+    assert profiler.start(interval_ms=1)
+    deadline = time.monotonic() + 5
+    while profiler.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    profiler._sampler.join(5)
+
+    assert sys.getswitchinterval() == pytest.approx(switch_interval)
+
+
+def test_racing_starts_and_stops_keep_the_original_switch_interval(switch_interval):
+    profiler = SamplingProfiler(max_seconds=0.01)
+
+    def churn():
+        for _ in range(50):
+            profiler.start(interval_ms=1)
+            profiler.stop()
+    threads = [threading.Thread(target=churn) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    profiler.stop()
+
+    assert sys.getswitchinterval() == pytest.approx(switch_interval)
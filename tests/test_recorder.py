@@ -0,0 +1,68 @@
+import json
+from datetime import datetime, timedelta
+
+import app as app_module
+from recorder import TrafficRecorder, sanitize
+from replay import restore
+
+
+def test_sync_events_are_recorded_without_ids_or_absolute_times():
+    now = 1700000000.0
+    body = sanitize({'events': [
+        {'event_id': 'a1b2', 'amount': 250, 'timestamp': datetime.fromtimestamp(now - 90).isoformat()},
+        {'event_id': 'a1b2', 'amount': 250, 'timestamp': now - 30},
+        {'event_id': 'c3d4', 'amount': 100, 'timestamp': 'yesterday'},
+    ]}, now=now, id_key=b'secret')
+
+    first, retry, other = body['events']
+    assert first['timestamp'] == {'$time': -90.0, 'format': 'iso'}
+    assert retry['timestamp'] == {'$time': -30.0, 'format': 'unix'}
+    assert other['timestamp'] == {'$text': 9}
+    assert first['event_id'] == retry['event_id'] != other['event_id']
+    assert 'a1b2' not in json.dumps(body)
+
+
+def test_replayed_sync_batches_are_accepted_once(app, make_user, client_for, tmp_path):
+    log = tmp_path / 'traffic.jsonl'
+    app.config['TRAFFIC_LOG'] = str(log)
+    app_module.traffic_recorder.init_app(app)
+    user_id = make_user()
+    batch = {'version': 0, 'events': [
+        {'event_id': 'e1', 'amount': 200, 'timestamp': (datetime.now() - timedelta(minutes=5)).isoformat()},
+        {'event_id': 'e2', 'amount': 300, 'timestamp': datetime.now().timestamp()},
+    ]}
+    assert client_for(user_id).post('/api/sync', json=batch).get_json()['acked'] == ['e1', 'e2']
+    app_module.traffic_recorder._log.handlers[0].flush()
+    recorded = json.loads(log.read_text().splitlines()[-1])
+
+    # Replayed against a database that already holds the original events
+    event_ids = {}
+    sent_at = datetime.now().timestamp()
+    replayed = restore(recorded['body'], sent_at, event_ids)
+    response = client_for(user_id).post('/api/sync', json=replayed).get_json()
+
+    assert response['rejected'] == []
+    assert len(response['acked']) == 2 and not {'e1', 'e2'} & set(response['acked'])
+    assert replayed['events'][1]['timestamp'] == sent_at + recorded['body']['events'][1]['timestamp']['$time']
+    retried = client_for(user_id).post('/api/sync', json=restore(recorded['body'], sent_at, event_ids)).get_json()
+    assert retried['acked'] == response['acked'] and retried['rejected'] == []
+    with app.app_context():
+        assert app_module.IntakeEvent.query.filter_by(user_id=user_id).count() == 4
+
+
+def test_profile_numbers_are_bucketed():
+    body = sanitize({'name': 'Ada Lovelace', 'age': '36', 'weight': '58.4', 'height': '166', 'profession': 'writer'})
+
+    assert body == {'name': {'$text': 12}, 'age': '40', 'weight': '60', 'height': '170', 'profession': {'$text': 6}}
+
+
+def test_hashes_are_not_keyed_with_the_secret_key(app, tmp_path):
+    app.config['TRAFFIC_LOG'] = str(tmp_path / 'traffic.jsonl')
+    first, second = TrafficRecorder(app), TrafficRecorder(app)
+    assert str(app.secret_key).encode() not in (first._key, second._key)
+    assert first._key != second._key  # random per capture when no key is configured
+
+    app.config['TRAFFIC_HASH_KEY'] = 'shared by the workers'
+    first, second = TrafficRecorder(app), TrafficRecorder(app)
+    assert first._key == second._key == b'shared by the workers'
+    assert first.user_bucket(417) == second.user_bucket(417)
@@ -0,0 +1,36 @@
+import threading
+from datetime import date, datetime, time, timedelta
+
+import app as app_module
+
+
+def enable_reminders(app, user_id, interval=90):
+    with app.app_context():
+        app_module.db.session.add(app_module.WaterReminder(
+            user_id=user_id, reminder_interval=interval, is_enabled=True,
+            last_reminder_time=datetime.combine(date.today(), time(8))))
+        app_module.db.session.commit()
+
+
+def next_reminder_at(app, user_id):
+    with app.app_context():
+        return app_module.WaterReminder.query.filter_by(user_id=user_id).one().next_reminder_at
+
+
+def test_no_planner_thread_by_default(app):
+    assert not any(thread.name == 'waterbuddy-reminder-planner' for thread in threading.enumerate())
+
+
+def test_due_users_are_not_rewritten_on_every_run(app, make_user):
+    behind = make_user(name='Behind')
+    enable_reminders(app, behind)
+    now = datetime.combine(date.today(), time(14))
+
+    with app.app_context():
+        assert app_module.reminder_planner.plan_all(now) == (1, 1)
+    assert next_reminder_at(app, behind) == now
+
+    for minutes in (5, 10, 30):
+        with app.app_context():
+            assert app_module.reminder_planner.plan_all(now + timedelta(minutes=minutes)) == (1, 0)
+    assert next_reminder_at(app, behind) == now
@@ -0,0 +1,62 @@
+import json
+
+import app as app_module
+import sessions
+from sessions import USER_PREFIX
+
+
+def test_dashboard_etag_changes_after_a_write(app, make_user, client_for):
+    client = client_for(make_user())
+
+    first = client.get('/api/dashboard')
+    assert first.status_code == 200
+    assert client.get('/api/dashboard', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    assert client.post('/add_water', json={'amount': 250}).get_json()['success']
+    second = client.get('/api/dashboard', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.get_json()['version'] == first.get_json()['version'] + 1
+
+
+def test_committed_data_version_bumps_invalidate_the_cached_context(app, make_user, monkeypatch):
+    monkeypatch.setattr(sessions, 'TOMBSTONE_SECONDS', 0)
+    user_id = make_user()
+    key = USER_PREFIX + str(user_id)
+    with app.app_context():
+        cached = app_module.server_sessions.user_context(user_id)
+        assert app_module.server_sessions.store.get(key)
+        assert cached.profession == 'developer' and cached.goal
+
+        app_module.bump_data_version(user_id)
+        app_module.db.session.rollback()
+        assert app_module.server_sessions.store.get(key)
+
+        app_module.bump_data_version(user_id)
+        app_module.db.session.commit()
+        assert not app_module.server_sessions.store.get(key)
+        assert app_module.server_sessions.user_context(user_id).data_version == cached.data_version + 1
+
+
+def test_deleted_user_is_logged_out_instead_of_erroring(app, make_user, client_for):
+    user_id = make_user()
+    client = client_for(user_id)
+    with app.app_context():
+        app_module.DailyGoal.query.filter_by(user_id=user_id).delete()
+        app_module.User.query.filter_by(id=user_id).delete()
+        app_module.db.session.commit()
+        app_module.server_sessions.invalidate_user(user_id)
+
+    assert client.get('/api/dashboard').status_code == 401
+    assert client.post('/api/sync', json={'version': 0, 'events': []}).status_code == 401
+    assert client.post('/chatbot_message', json={'message': 'hi'}).get_json()['success'] is False
+    assert client.get('/check_water_reminder').get_json()['success'] is False
+    assert client.get('/insights').status_code == 302
+
+
+def test_contexts_cached_by_an_older_release_are_reloaded(app, make_user):
+    user_id = make_user()
+    with app.app_context():
+        app_module.server_sessions.store.set(USER_PREFIX + str(user_id), json.dumps([user_id, 'Old', 2000, None]), 60)
+        context = app_module.server_sessions.user_context(user_id)
+
+    assert context.name == 'Test User' and context.data_version is not None
@@ -0,0 +1,143 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import literal, select, text
+
+import app as app_module
+from database import DailyGoal, User, WaterIntake
+from shards import ShardedSQLAlchemy, jump_hash, user_criteria
+
+
+def make_app(tmp_path, count):
+    app = app_module.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'SESSION_DB': str(tmp_path / 'sessions.db'),
+        'TEMPLATE_CACHE_DIR': str(tmp_path / 'jinja_cache'),
+        'ARCHIVE_DIR': str(tmp_path / 'archive'),
+        'SHARD_DIR': str(tmp_path),
+        'SHARD_COUNT': count,
+        'COHORT_SNAPSHOT': str(tmp_path / 'cohorts.json'),
+        'ADMISSION_ENABLED': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        app_module.db.create_all()
+    return app
+
+
+@pytest.fixture
+def shard_apps(tmp_path):
+    apps = []
+
+    def shard_app(count):
+        apps.append(make_app(tmp_path, count))
+        return apps[-1]
+    yield shard_app
+    for app in apps:
+        with app.app_context():
+            app_module.db.session.remove()
+            for engine in app_module.db.shard_engines().values():
+                engine.dispose()
+
+
+def add_users(count, intake=250):
+    ids = []
+    for index in range(count):
+        user = User(name=f'user {index}', age=30, weight=70.0, height=175.0, profession='developer')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()  # as /profile does; the id comes from the main database
+        app_module.db.session.add(WaterIntake(user_id=user.id, date=date.today(), amount=intake))
+        app_module.db.session.add(DailyGoal(user_id=user.id, amount=2000 + user.id))
+        app_module.db.session.commit()
+        ids.append(user.id)
+    return ids
+
+
+def user_rows(app, table, count=3):
+    """Mapping of shard id to the user ids with rows of a table in it"""
+    column = 'id' if table == 'users' else 'user_id'
+    engines = app.extensions['shard_router'].engines(count)
+    return {shard_id: {user_id for (user_id,) in engine.execute(text(f'SELECT {column} FROM {table}'))}
+            for shard_id, engine in engines.items()}
+
+
+def test_user_criteria_matches_either_order_and_in():
+    assert user_criteria(select(WaterIntake).where(WaterIntake.user_id == 7)) == {7}
+    assert user_criteria(select(WaterIntake).where(WaterIntake.user_id.in_([7]))) == {7}
+    assert user_criteria(select(User).where(User.id.in_([3, 4]), User.name == 'x')) == {3, 4}
+    assert user_criteria(select(DailyGoal).where(literal(5) == DailyGoal.user_id)) == {5}
+    assert user_criteria(select(WaterIntake).where((WaterIntake.user_id == 1) | (WaterIntake.amount > 0))) is None
+
+
+def test_relationship_loads_go_to_the_users_shard(shard_apps):
+    app = shard_apps(3)
+    router = app.extensions['shard_router']
+    with app.app_context():
+        ids = add_users(6)
+        app_module.db.session.remove()
+
+        chosen = []
+        choose = router.execute_chooser
+        router.execute_chooser = lambda context: chosen.append(choose(context)) or chosen[-1]
+        for user_id in ids:
+            user = User.query.get(user_id)
+            chosen.clear()
+            assert [intake.amount for intake in user.water_intakes] == [250]
+            assert user.daily_goal.amount == 2000 + user_id
+            assert chosen == [[router.shard_of(user_id)]] * 2
+
+
+def test_user_ids_are_unique_across_shards(shard_apps):
+    app = shard_apps(3)
+    with app.app_context():
+        # A user from before sharding was enabled, on a shard other than the main database
+        app_module.db.execute_on(2, text(
+            "INSERT INTO users (id, name, age, weight, height, profession, data_version) "
+            "VALUES (40, 'old', 30, 70, 175, 'developer', 0)"))
+        app_module.db.session.commit()
+
+        ids = add_users(12)
+
+        assert ids == list(range(41, 53))
+        assert len({jump_hash(user_id, 3) for user_id in ids}) == 3
+        assert app_module.db.session.execute(
+            text("SELECT value FROM id_sequences WHERE name = 'users'")).scalar() == 52
+    rows = user_rows(app, 'users')
+    assert sorted(user_id for users in rows.values() for user_id in users) == [40] + ids
+
+
+def test_reshard_resumes_after_an_interrupted_batch(shard_apps, monkeypatch):
+    app = shard_apps(1)
+    with app.app_context():
+        ids = add_users(20)
+
+    finish_moves = ShardedSQLAlchemy._finish_moves
+    killed = []
+
+    def killed_after_copy(self, router, target, tables):
+        with router.engine(target).connect() as conn:
+            if not killed and conn.execute(text('SELECT COUNT(*) FROM shard_moves')).scalar():
+                killed.append(target)
+                raise RuntimeError('killed')
+        return finish_moves(self, router, target, tables)
+    monkeypatch.setattr(ShardedSQLAlchemy, '_finish_moves', killed_after_copy)
+
+    with app.app_context(), pytest.raises(RuntimeError):
+        app_module.db.reshard(3, echo=lambda line: None)
+    copied = user_rows(app, 'users')
+    assert copied[0] & copied[killed[0]]  # the batch is on both shards until the rerun
+
+    with app.app_context():
+        moved = app_module.db.reshard(3, batch_users=5, echo=lambda line: None)
+    assert moved == sum(1 for user_id in ids if jump_hash(user_id, 3) != 0) - len(copied[killed[0]])
+
+    resharded = shard_apps(3)
+    for table in ('users', 'water_intakes', 'daily_goals'):
+        rows = user_rows(resharded, table)
+        assert {shard_id: users for shard_id, users in rows.items() if users} == \
+            {shard_id: {user_id for user_id in ids if jump_hash(user_id, 3) == shard_id} for shard_id in range(3)}
+    with resharded.app_context():
+        for shard_id in range(3):
+            assert not app_module.db.execute_on(shard_id, text('SELECT COUNT(*) FROM shard_moves')).scalar()
+        assert sum(intake.amount for intake in WaterIntake.query.all()) == 250 * len(ids)
+        assert User.query.get(ids[-1]).daily_goal.amount == 2000 + ids[-1]
@@ -0,0 +1,40 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use rather than by `import app` (see benchmark.py startup)
+DEFERRED_MODULES = ('google.generativeai', 'grpc', 'numpy')
+
+LOADED_SCRIPT = """
+import json, sys
+import app
+print(json.dumps(sorted(name for name in sys.modules if name.startswith({prefixes!r}))))
+"""
+
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def test_import_app_defers_heavy_modules(tmp_path):
+    # Stand-ins where a module is not installed, so an eager import would still show up
+    for name in DEFERRED_MODULES:
+        if not installed(name):
+            package = tmp_path.joinpath(*name.split('.'))
+            package.mkdir(parents=True)
+            (package / '__init__.py').write_text('')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path), os.environ.get('PYTHONPATH', '')]))
+
+    # From another directory, as `benchmark.py startup` may be run
+    script = LOADED_SCRIPT.format(prefixes=DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {ROOT!r})\n' + script],
+                            capture_output=True, text=True, env=env, cwd=tmp_path, check=True).stdout
+
+    assert json.loads(output.splitlines()[-1]) == []
@@ -0,0 +1,212 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+import task_queue
+from sessions import ServerSessions
+from task_queue import QueueFullError, TaskQueue
+
+
+def wait_for(queue, task_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        record = queue.status(task_id)
+        if record and record['state'] in ('done', 'failed'):
+            return record
+        time.sleep(0.01)
+    raise AssertionError(f"task {task_id} did not finish: {queue.status(task_id)}")
+
+
+def make_queue(**options):
+    queue = TaskQueue(**options)
+    queue.init_app(Flask(__name__))
+    return queue
+
+
+def test_failed_task_retries_with_exponential_backoff(monkeypatch):
+    delays = []
+
+    class ImmediateTimer:
+        def __init__(self, delay, function, args):
+            delays.append(delay)
+            self.function, self.args = function, args
+
+        def start(self):
+            self.function(*self.args)
+
+    monkeypatch.setattr(task_queue.threading, 'Timer', ImmediateTimer)
+    queue = make_queue(max_retries=3, backoff_base=0.5)
+    calls = []
+
+    @queue.task()
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError('try again')
+        return 'ok'
+
+    record = wait_for(queue, queue.enqueue('flaky'))
+    assert record['state'] == 'done' and record['result'] == 'ok'
+    assert record['attempts'] == 3
+    assert delays == [0.5, 1.0]
+    assert queue.depth == 0
+
+
+def test_task_fails_after_max_retries(monkeypatch):
+    monkeypatch.setattr(task_queue.threading, 'Timer', lambda delay, function, args: threading.Thread(
+        target=function, args=args))
+    queue = make_queue(max_retries=2, backoff_base=0)
+
+    @queue.task()
+    def broken():
+        raise RuntimeError('always')
+
+    record = wait_for(queue, queue.enqueue('broken'))
+    assert record['state'] == 'failed' and record['error'] == 'always'
+    assert record['attempts'] == 3
+    assert queue.depth == 0
+
+
+def test_on_finish_runs_once_after_the_last_retry(monkeypatch):
+    monkeypatch.setattr(task_queue.threading, 'Timer', lambda delay, function, args: threading.Thread(
+        target=function, args=args))
+    queue = make_queue(max_retries=2, backoff_base=0)
+    finished = []
+    called = threading.Event()
+
+    @queue.task(on_finish=lambda record: (finished.append(record), called.set()))
+    def broken():
+        raise RuntimeError('always')
+
+    queue.enqueue('broken')
+    assert called.wait(5)
+    time.sleep(0.05)
+    assert [(record['state'], record['attempts']) for record in finished] == [('failed', 3)]
+
+
+def test_enqueue_raises_queue_full_at_max_depth():
+    queue = make_queue(max_workers=1, max_depth=3)
+    release = threading.Event()
+
+    @queue.task()
+    def blocked():
+        release.wait(5)
+
+    ids = [queue.enqueue('blocked') for _ in range(3)]
+    with pytest.raises(QueueFullError):
+        queue.enqueue('blocked')
+
+    release.set()
+    for task_id in ids:
+        wait_for(queue, task_id)
+    queue.enqueue('blocked')  # room again once tasks finish
+
+
+def test_status_is_visible_to_every_worker(tmp_path):
+    def worker():
+        app = Flask(__name__)
+        app.config['SESSION_DB'] = str(tmp_path / 'sessions.db')
+        ServerSessions(app)
+        queue = TaskQueue()
+        queue.task('double')(lambda value: value * 2)
+        queue.init_app(app)
+        return queue
+    first, second = worker(), worker()
+
+    task_id = first.enqueue('double', 21, owner=7)
+    wait_for(first, task_id)
+
+    record = second.status(task_id)
+    assert (record['state'], record['result'], record['owner']) == ('done', 42, 7)
+
+
+def test_failed_store_write_does_not_hold_a_slot(tmp_path, monkeypatch):
+    queue = make_queue(max_depth=1, durable_path=str(tmp_path / 'tasks.db'))
+    queue.task('noop')(lambda: None)
+
+    def broken_store(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(queue, '_store', broken_store)
+    with pytest.raises(OSError):
+        queue.enqueue('noop')
+    assert queue.depth == 0
+
+    monkeypatch.undo()
+    wait_for(queue, queue.enqueue('noop'))
+
+
+def test_pending_retries_are_dropped_on_shutdown(monkeypatch):
+    queue = make_queue(max_retries=3, backoff_base=0.2)
+    submitted = []
+    called = threading.Event()
+
+    @queue.task()
+    def flaky():
+        called.set()
+        raise RuntimeError('try again')
+
+    task_id = queue.enqueue('flaky')
+    assert called.wait(5)
+    deadline = time.monotonic() + 5
+    while queue.status(task_id)['state'] != 'retrying' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    queue.shutdown()
+    monkeypatch.setattr(queue, '_submit', lambda *args: submitted.append(args))
+    time.sleep(0.4)
+    assert submitted == [] and queue.status(task_id)['attempts'] == 1
+
+
+def remaining_rows(queue):
+    with queue._connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_durable_tasks_of_an_exited_process_are_replayed_once(tmp_path):
+    path = str(tmp_path / 'tasks.db')
+    writer = TaskQueue(durable_path=path)
+    writer._init_store()
+    writer._store('left-behind', 'record', '{"args": ["crashed"], "kwargs": {}}', None)
+    with writer._connect() as conn:
+        conn.execute("UPDATE tasks SET claimed_by = ?", (f"{dead_pid()}:deadbeef0000",))
+
+    ran = []
+    first, second = TaskQueue(durable_path=path), TaskQueue(durable_path=path)
+    for queue in (first, second):
+        queue.task('record')(ran.append)
+    first.init_app(Flask(__name__))
+    second.init_app(Flask(__name__))
+
+    assert wait_for(first, 'left-behind')['state'] == 'done'
+    assert second.status('left-behind') is None
+    assert ran == ['crashed']
+    deadline = time.monotonic() + 5
+    while remaining_rows(first) and time.monotonic() < deadline:
+        time.sleep(0.01)  # the row is deleted just after the task is marked done
+    assert remaining_rows(first) == 0
+
+
+def test_durable_tasks_of_a_running_process_are_left_alone(tmp_path, monkeypatch):
+    path = str(tmp_path / 'tasks.db')
+    queue = TaskQueue(durable_path=path)
+    queue._init_store()
+    # A live worker (the test runner's parent) is still running this task
+    queue._store('in-flight', 'record', '{"args": [1], "kwargs": {}}', None)
+    with queue._connect() as conn:
+        conn.execute("UPDATE tasks SET claimed_by = ?", (f"{os.getppid()}:otherworker0",))
+
+    ran = []
+    queue.task('record')(ran.append)
+    queue.init_app(Flask(__name__))
+    time.sleep(0.2)
+    assert ran == [] and queue.status('in-flight') is None
@@ -0,0 +1,49 @@
+import os
+
+import app as app_module
+
+FRAGMENT = "{% cache 'greeting', name %}{{ name }} #{{ renders() }}{% endcache %}"
+
+
+def render_fragment(app, name, renders):
+    with app.test_request_context():
+        return app.jinja_env.from_string(FRAGMENT).render(name=name, renders=renders)
+
+
+def counter():
+    calls = []
+    return lambda: calls.append(1) or len(calls)
+
+
+def test_fragments_are_cached_by_key(app):
+    renders = counter()
+
+    assert render_fragment(app, 'Ada', renders) == 'Ada #1'
+    assert render_fragment(app, 'Ada', renders) == 'Ada #1'
+    assert render_fragment(app, 'Bob', renders) == 'Bob #2'
+    assert len(app.jinja_env.fragment_cache) == 2
+
+
+def test_fragments_are_not_cached_when_debug_is_turned_on_after_create_app(app):
+    # app.run(debug=True) sets debug only after create_app() has returned
+    app.debug = True
+    renders = counter()
+
+    assert render_fragment(app, 'Ada', renders) == 'Ada #1'
+    assert render_fragment(app, 'Ada', renders) == 'Ada #2'
+    assert len(app.jinja_env.fragment_cache) == 0
+
+
+def test_precompiled_templates_are_loaded_without_compiling(app, tmp_path, monkeypatch):
+    result = app.test_cli_runner().invoke(args=['precompile-templates'])
+    assert result.exit_code == 0, result.output
+    names = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    assert len(os.listdir(app.config['TEMPLATE_CACHE_DIR'])) == len(names)
+
+    # Another worker sharing the cache directory
+    worker = app_module.create_app(dict(app.config))
+    def compile(*args, **kwargs):
+        raise AssertionError('template was compiled again')
+    monkeypatch.setattr(worker.jinja_env, 'compile', compile)
+    for name in names:
+        worker.jinja_env.get_template(name)
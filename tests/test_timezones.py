@@ -0,0 +1,33 @@
+from datetime import date, datetime, time, timedelta
+
+import app as app_module
+from timezones import to_local_date
+
+
+def log_event(user_id, event_id, recorded_at, amount=100):
+    app_module.db.bulk_insert(app_module.IntakeEvent, [
+        {'user_id': user_id, 'event_id': event_id, 'amount': amount, 'recorded_at': recorded_at}
+    ])
+    app_module.apply_intake_deltas({(user_id, recorded_at.date()): amount}, commit=False)
+    app_module.db.session.commit()
+
+
+def test_timezone_change_leaves_archived_days_alone(app, make_user, client_for):
+    user_id = make_user()
+    old = datetime.combine(date.today() - timedelta(days=100), time(23, 30))
+    recent = datetime.combine(date.today() - timedelta(days=3), time(23, 30))
+    # Late evening server time is the next day somewhere east of here
+    timezone = next(name for name in ('Pacific/Kiritimati', 'Asia/Tokyo', 'Europe/Berlin')
+                    if to_local_date(name, recent) != recent.date())
+    with app.app_context():
+        log_event(user_id, 'old', old)
+        log_event(user_id, 'recent', recent)
+        app_module.intake_archive.archive(date.today() - timedelta(days=62))
+
+    body = client_for(user_id).post('/set_timezone', json={'timezone': timezone}).get_json()
+
+    assert body['success'] and body['rebucketed_events'] == 1
+    with app.app_context():
+        hot = {row.date: row.amount for row in app_module.WaterIntake.query.filter_by(user_id=user_id)}
+        assert hot == {recent.date(): 0, recent.date() + timedelta(days=1): 100}
+        assert dict(app_module.intake_archive.daily_totals(user_id, end=recent.date())) == {old.date(): 100}
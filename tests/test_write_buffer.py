@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+from datetime import date
+
+import pytest
+
+from write_buffer import IntakeBuffer, apply_intake_batch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A worker that logs sips through the buffer, then exits as told
+WORKER = textwrap.dedent("""
+    import os, sys
+    sys.path.insert(0, {root!r})
+    import app as app_module
+    app = app_module.create_app({{
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///{db}', 'SESSION_DB': {sessions!r},
+        'TEMPLATE_CACHE_DIR': {cache!r}, 'COHORT_REFRESH_SECONDS': 0, 'REMINDER_PLAN_SECONDS': 0,
+        'ADMISSION_ENABLED': False, 'WRITE_BUFFER_ENABLED': True, 'WRITE_BUFFER_FLUSH_MS': 600000,
+        'WRITE_BUFFER_MAX_EVENTS': 100000, 'WRITE_BUFFER_DURABILITY': {durability!r},
+        'WRITE_BUFFER_JOURNAL_PATH': {journal!r},
+    }})
+    with app.app_context():
+        app_module.db.create_all()
+        if not app_module.User.query.get(1):
+            user = app_module.User(name='Sipper', age=30, weight=70.0, height=175.0, profession='developer')
+            app_module.db.session.add(user)
+            app_module.db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+    for _ in range({sips}):
+        assert client.post('/add_water', json={{'amount': 10}}).get_json()['success']
+    print('ready', flush=True)
+    {exit}
+""")
+
+
+def run_worker(tmp_path, durability='journal', sips=100, exit='pass', wait=True):
+    script = WORKER.format(root=ROOT, db=tmp_path / 'test.db', sessions=str(tmp_path / 'sessions.db'),
+                           cache=str(tmp_path / 'jinja_cache'), durability=durability,
+                           journal=str(tmp_path / 'journal' / 'intake_buffer.journal'), sips=sips, exit=exit)
+    process = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               text=True, cwd=str(tmp_path))
+    for line in process.stdout:  # the app may print start-up notices first
+        if line.strip() == 'ready':
+            break
+    else:
+        raise AssertionError(f"worker exited with {process.wait()} before logging its sips")
+    if wait:
+        assert process.wait(60) == 0
+    return process
+
+
+def total(tmp_path):
+    with sqlite3.connect(tmp_path / 'test.db') as conn:
+        return conn.execute("SELECT COALESCE(SUM(amount), 0) FROM water_intakes").fetchone()[0]
+
+
+def journal_files(tmp_path):
+    directory = tmp_path / 'journal'
+    return sorted(os.listdir(directory)) if directory.exists() else []
+
+
+@pytest.mark.parametrize('durability', ['memory', 'journal'])
+def test_clean_exit_flushes_every_increment(tmp_path, durability):
+    run_worker(tmp_path, durability, sips=150)
+    assert total(tmp_path) == 1500
+    assert journal_files(tmp_path) == []
+
+
+def replaying_buffer(app, tmp_path):
+    buffer = IntakeBuffer()
+    app.config.update(WRITE_BUFFER_ENABLED=True, WRITE_BUFFER_DURABILITY='journal', WRITE_BUFFER_FLUSH_MS=600000,
+                      WRITE_BUFFER_JOURNAL_PATH=str(tmp_path / 'journal' / 'intake_buffer.journal'))
+    buffer.init_app(app)
+    return buffer
+
+
+def test_journal_of_a_crashed_process_is_replayed_once(app, tmp_path):
+    run_worker(tmp_path, sips=40, exit='os._exit(0)')
+    assert total(tmp_path) == 0
+
+    buffer = replaying_buffer(app, tmp_path)
+    assert total(tmp_path) == 400
+    buffer.close()
+    replaying_buffer(app, tmp_path).close()
+    assert total(tmp_path) == 400
+    assert journal_files(tmp_path) == []
+
+
+def test_journal_of_a_running_worker_is_left_alone(app, tmp_path):
+    worker = run_worker(tmp_path, sips=30, exit='sys.stdin.readline()', wait=False)
+    buffer = replaying_buffer(app, tmp_path)
+    buffer.close()
+    assert total(tmp_path) == 0  # still pending in the worker
+
+    worker.communicate('exit\n', timeout=60)
+    assert total(tmp_path) == 300
+
+
+def test_batch_committed_before_a_crash_is_not_applied_again(app, tmp_path, make_user):
+    user_id = make_user()
+    # The flush committed, then the process died before deleting the batch's journal
+    directory = tmp_path / 'journal'
+    directory.mkdir()
+    prefix = directory / 'intake_buffer.journal.999999'
+    (directory / 'intake_buffer.journal.999999.lock').touch()
+    flushing = directory / 'intake_buffer.journal.999999.feedface.flushing'
+    flushing.write_text(f"{user_id},{date.today().isoformat()},250\n")
+    prefix.write_text(f"{user_id},{date.today().isoformat()},50\n")  # logged after the rotation
+    with app.app_context():
+        apply_intake_batch('feedface', {(user_id, date.today()): 250})
+    assert total(tmp_path) == 250
+
+    replaying_buffer(app, tmp_path).close()
+    assert total(tmp_path) == 300
+    assert journal_files(tmp_path) == []
+
+
+
+@pytest.mark.parametrize('buffered', [False, True])
+@pytest.mark.parametrize('amount', ['250', 250.0, 0, -5, 5001, True, None])
+def test_invalid_amounts_are_rejected_before_the_buffer(app, tmp_path, make_user, client_for, monkeypatch,
+                                                        buffered, amount):
+    import app as app_module
+    if buffered:
+        monkeypatch.setattr(app_module, 'intake_buffer', replaying_buffer(app, tmp_path))
+    client = client_for(make_user())
+
+    response = client.post('/add_water', json={'amount': amount})
+    assert response.status_code == 400 and not response.get_json()['success']
+    assert client.post('/add_water', json={'amount': 250}).get_json()['current_amount'] == 250
+    if buffered:
+        app_module.intake_buffer.close()
+    assert total(tmp_path) == 250
@@ -0,0 +1,76 @@
+"""
+Timezone helpers for WaterBuddy
+This module resolves a user's local calendar date, caching day boundaries per timezone
+"""
+import time as time_module
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Timezone name -> (day start timestamp, next day start timestamp, local date).
+# None stands for the server's own timezone, used for users who never set one.
+_day_boundaries = {}
+
+
+@lru_cache(maxsize=None)
+def get_zone(tz_name):
+    """Return the ZoneInfo for an IANA name, or None for server-local time"""
+    if not tz_name:
+        return None
+    return ZoneInfo(tz_name)
+
+
+def is_valid_timezone(tz_name):
+    """Check whether a string names a known IANA timezone"""
+    if not isinstance(tz_name, str) or not tz_name or len(tz_name) > 64:
+        return False
+    try:
+        get_zone(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def local_today(tz_name, now=None):
+    """
+    Get today's date in the given timezone.
+
+    The first call for a zone computes the timestamps at which the local day
+    starts and ends; later calls on the same day only compare a timestamp.
+
+    Args:
+        tz_name: IANA timezone name, or None for server-local time
+        now: Optional Unix timestamp to use instead of the current time
+    """
+    ts = time_module.time() if now is None else now
+    cached = _day_boundaries.get(tz_name)
+    if cached and cached[0] <= ts < cached[1]:
+        return cached[2]
+
+    zone = get_zone(tz_name)
+    day = datetime.fromtimestamp(ts, zone).date()
+    start = datetime.combine(day, time.min, tzinfo=zone).timestamp()
+    end = datetime.combine(day + timedelta(days=1), time.min, tzinfo=zone).timestamp()
+    _day_boundaries[tz_name] = (start, end, day)
+    return day
+
+
+def local_now(tz_name):
+    """Current wall-clock time in the given timezone, as a naive datetime"""
+    return datetime.now(get_zone(tz_name)).replace(tzinfo=None)
+
+
+def to_local_date(tz_name, moment):
+    """
+    Get the calendar date of a moment in the given timezone.
+
+    Args:
+        tz_name: IANA timezone name, or None for server-local time
+        moment: A datetime; naive values are taken as server-local time
+    """
+    zone = get_zone(tz_name)
+    if moment.tzinfo is None:
+        if zone is None:
+            return moment.date()
+        moment = moment.astimezone()
+    return moment.astimezone(zone).date()
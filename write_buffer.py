@@ -0,0 +1,320 @@
+"""
+Write-behind buffer for WaterBuddy intake logging
+This module coalesces many small intake updates per (user, date) and writes them in one transaction
+"""
+import atexit
+import glob
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date as date_type, datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: the journal needs POSIX file locks
+    fcntl = None
+
+from database import db, WaterIntake, JournalBatch, bump_data_version
+
+# Batch markers only matter until a crashed process's journal has been replayed
+BATCH_MARKER_RETENTION = timedelta(days=1)
+
+
+def apply_intake_deltas(deltas, commit=True):
+    """
+    Add intake amounts to the stored daily totals in one transaction.
+
+    Args:
+        deltas: Mapping of (user_id, date) to the amount to add in milliliters
+        commit: Commit the session; pass False to let the caller commit
+    """
+    user_ids = {user_id for user_id, _ in deltas}
+    dates = {date for _, date in deltas}
+    existing = {
+        (intake.user_id, intake.date): intake
+        for intake in WaterIntake.query.filter(
+            WaterIntake.user_id.in_(user_ids),
+            WaterIntake.date.in_(dates)
+        )
+    }
+
+    versions = bump_data_version(*user_ids)
+    for (user_id, date), amount in deltas.items():
+        intake = existing.get((user_id, date))
+        if intake:
+            intake.amount += amount
+            intake.version = versions.get(user_id, 0)
+        else:
+            db.session.add(WaterIntake(user_id=user_id, date=date, amount=amount, version=versions.get(user_id, 0)))
+
+    if not commit:
+        return
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def apply_intake_batch(batch_id, deltas):
+    """
+    Apply a batch of intake deltas at most once.
+
+    Each shard's share of the batch commits together with a journal_batches
+    row for batch_id, and shares whose row already exists are skipped, so a
+    batch replayed after a crash (or retried after a partial failure) is not
+    counted twice.
+    """
+    markers = JournalBatch.__table__
+    for shard_id, user_ids in db.partition({user_id for user_id, _ in deltas}).items():
+        applied = db.execute_on(shard_id, markers.select().where(markers.c.batch_id == batch_id)).first()
+        if applied:
+            db.session.commit()
+            continue
+        members = set(user_ids)
+        try:
+            apply_intake_deltas({key: amount for key, amount in deltas.items() if key[0] in members}, commit=False)
+            db.execute_on(shard_id, markers.insert().values(batch_id=batch_id, applied_at=datetime.now()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def prune_batch_markers(before):
+    """Delete journal_batches rows applied before a time, in every shard"""
+    markers = JournalBatch.__table__
+    for shard_id in db.shard_ids():
+        db.execute_on(shard_id, markers.delete().where(markers.c.applied_at < before))
+    db.session.commit()
+
+
+def read_journal(path):
+    """Sum the deltas in a journal file, ignoring a partially written last line"""
+    deltas = defaultdict(int)
+    with open(path) as journal:
+        for line in journal:
+            try:
+                user_id, date, amount = line.strip().split(',')
+                deltas[(int(user_id), date_type.fromisoformat(date))] += int(amount)
+            except ValueError:
+                continue
+    return deltas
+
+
+class IntakeBuffer:
+    """
+    Opt-in write-behind buffer for water intake deltas.
+
+    Deltas are summed in memory per (user_id, date) and flushed every
+    flush_interval_ms milliseconds or after max_events additions, whichever
+    comes first. Readers add pending() to the stored amount to see the
+    current total. A final flush is registered with atexit.
+
+    Each flush is a batch with its own id, applied with apply_intake_batch(),
+    so retrying a batch never counts it twice; a failed batch is retried as
+    it was on the next flush.
+
+    Durability modes:
+        'memory':  pending deltas are lost if the process crashes
+        'journal': every delta is appended and fsync'd to this process's
+                   journal (journal_path.<pid>) before add() returns. Each
+                   process holds a lock on journal_path.<pid>.lock while it
+                   runs; at start-up the journals of processes whose lock is
+                   free (they exited) are replayed and deleted, so workers
+                   sharing a directory never replay each other's live journals.
+    """
+
+    def __init__(self, app=None, flush_interval_ms=500, max_events=50,
+                 durability='memory', journal_path='intake_buffer.journal'):
+        self.enabled = False
+        self.flush_interval_ms = flush_interval_ms
+        self.max_events = max_events
+        self.durability = durability
+        self.journal_path = journal_path
+
+        self.app = None
+        self._deltas = defaultdict(int)
+        self._events = 0
+        self._batches = []  # (batch_id, deltas, journal file) waiting to be applied
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._journal = None
+        self._lock_fd = None
+        self._pruned = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read buffer settings from the app config and start the flusher if enabled"""
+        self.app = app
+        self.enabled = app.config.get('WRITE_BUFFER_ENABLED', False)
+        self.flush_interval_ms = app.config.get('WRITE_BUFFER_FLUSH_MS', self.flush_interval_ms)
+        self.max_events = app.config.get('WRITE_BUFFER_MAX_EVENTS', self.max_events)
+        self.durability = app.config.get('WRITE_BUFFER_DURABILITY', self.durability)
+        self.journal_path = app.config.get('WRITE_BUFFER_JOURNAL_PATH', self.journal_path)
+
+        if self.durability not in ('memory', 'journal'):
+            raise ValueError(f"Unknown write buffer durability mode: {self.durability}")
+
+        if not self.enabled:
+            return
+
+        if self.durability == 'journal':
+            if fcntl is None:
+                raise ValueError("WRITE_BUFFER_DURABILITY=journal needs POSIX file locks (fcntl)")
+            os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+            self._replay_orphans()
+            self._lock_fd = os.open(f"{self._own_prefix}.lock", os.O_CREAT | os.O_RDWR)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._journal = open(self._own_prefix, 'a')
+
+        flusher = threading.Thread(target=self._run, name='waterbuddy-intake-flusher', daemon=True)
+        flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def _own_prefix(self):
+        return f"{self.journal_path}.{os.getpid()}"
+
+    def add(self, user_id, date, amount):
+        """
+        Buffer an intake delta.
+
+        Returns:
+            The total pending (not yet flushed) amount for this user and date
+        """
+        with self._lock:
+            if self._journal is not None:
+                self._journal.write(f"{user_id},{date.isoformat()},{amount}\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            key = (user_id, date)
+            self._deltas[key] += amount
+            self._events += 1
+            pending = self._deltas[key] + sum(deltas.get(key, 0) for _, deltas, _ in self._batches)
+            full = self._events >= self.max_events
+
+        if full:
+            self._wakeup.set()
+        return pending
+
+    def pending(self, user_id, date):
+        """Amount buffered for this user and date that is not in the database yet"""
+        if not self.enabled:
+            return 0
+        key = (user_id, date)
+        with self._lock:
+            return self._deltas.get(key, 0) + sum(deltas.get(key, 0) for _, deltas, _ in self._batches)
+
+    def flush(self):
+        """Apply batches that failed before, then all pending deltas as a new batch"""
+        with self._flush_lock:
+            with self._lock:
+                if self._deltas:
+                    batch_id = uuid.uuid4().hex
+                    self._batches.append((batch_id, self._deltas, self._rotate_journal(batch_id)))
+                    self._deltas = defaultdict(int)
+                    self._events = 0
+                batches, self._batches = self._batches, []
+
+            flushed = 0
+            for i, (batch_id, deltas, path) in enumerate(batches):
+                try:
+                    with self.app.app_context():
+                        apply_intake_batch(batch_id, deltas)
+                except Exception as e:
+                    # Keep this batch and the ones after it, in order, for the next flush
+                    with self._lock:
+                        self._batches[:0] = batches[i:]
+                    print(f"Error flushing intake buffer: {str(e)}")
+                    break
+                if path:
+                    os.remove(path)
+                flushed += len(deltas)
+
+            if batches and time.time() - self._pruned > 3600:
+                self._pruned = time.time()
+                try:
+                    with self.app.app_context():
+                        prune_batch_markers(datetime.now() - BATCH_MARKER_RETENTION)
+                except Exception as e:
+                    print(f"Error pruning intake batch markers: {str(e)}")
+            return flushed
+
+    def close(self):
+        """Flush whatever is left; called automatically at interpreter exit"""
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            if not self._batches and os.path.getsize(self._own_prefix) == 0:
+                # Nothing left to replay; a failed final flush leaves the files for the next start
+                os.remove(self._own_prefix)
+                os.remove(f"{self._own_prefix}.lock")
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval_ms / 1000.0)
+            self._wakeup.clear()
+            self.flush()
+
+    def _rotate_journal(self, batch_id):
+        # Called with self._lock held: deltas written after this point go to a fresh journal
+        if self._journal is None:
+            return None
+        self._journal.close()
+        flushing_path = f"{self._own_prefix}.{batch_id}.flushing"
+        os.replace(self._own_prefix, flushing_path)
+        self._journal = open(self._own_prefix, 'a')
+        return flushing_path
+
+    def _replay_orphans(self):
+        """Apply and delete the journals of processes that exited without flushing them"""
+        # Journals written before they were per process: whoever renames one first replays it
+        for legacy in (self.journal_path + '.flushing', self.journal_path):
+            try:
+                os.replace(legacy, f"{self._own_prefix}.legacy-{uuid.uuid4().hex}")
+            except FileNotFoundError:
+                pass
+
+        for lock_path in glob.glob(f"{glob.escape(self.journal_path)}.*.lock"):
+            try:
+                fd = os.open(lock_path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # its process is still running
+                if os.fstat(fd).st_nlink == 0:
+                    continue  # another worker replayed it first
+                self._replay_files(lock_path[:-len('.lock')])
+                os.remove(lock_path)
+            finally:
+                os.close(fd)
+        self._replay_files(self._own_prefix)
+
+    def _replay_files(self, prefix):
+        # Batches that were being flushed keep their id, so any shard that committed one is skipped
+        for path in sorted(glob.glob(f"{glob.escape(prefix)}.*.flushing")):
+            batch_id = os.path.basename(path)[:-len('.flushing')].rsplit('.', 1)[-1]
+            self._replay_file(path, batch_id)
+        for path in glob.glob(f"{glob.escape(prefix)}.legacy-*") + [prefix]:
+            if os.path.exists(path):
+                self._replay_file(path, uuid.uuid4().hex)
+
+    def _replay_file(self, path, batch_id):
+        deltas = read_journal(path)
+        if deltas:
+            with self.app.app_context():
+                apply_intake_batch(batch_id, deltas)
+        os.remove(path)